@@ -14,6 +14,8 @@ builddir=_build
 reportdir=_build/report
 tempdir=_build/_temp
 statsdir=_build/_stats
+# per-file stats, reused by lulua-write if input files did not change
+cachedir=_build/_cache
 datadir=lulua/data
 corpusdir=${corpusdir}
 wikiextractor=3rdparty/wikiextractor/WikiExtractor.py
@@ -23,12 +25,14 @@ optrounds=100000
 # pin layers, keep hand-optimized numbers, keep top row free
 optpins=0;1;2;0,B*;3,*
 optmodel=mod01
+# limit lulua-write workers’ memory usage by writing partial results (MB)
+writeflush=512
 
 ### pools ###
-# lulua-write uses internal parallelization and should not be run more than
-# once concurrently. It also uses alot of memory, so…
+# lulua-write uses internal parallelization, so running a few of them
+# concurrently is enough. Memory usage is bounded by \$writeflush.
 pool write
-    depth = 1
+    depth = 2
 
 ### rules ###
 rule opt
@@ -49,62 +53,51 @@ rule render-svg-heat
 rule render-xmodmap
     command = lulua-render -l \$layout xmodmap \$out
 
-rule analyze-heat
-    command = lulua-analyze -l \$layout keyheatmap < \$in > \$out
-
 rule write-bbcarabic
-    command = find \$in | lulua-write \$layout file brotli tar bbcarabic | lulua-analyze combine > \$out
+    command = find \$in | lulua-write -f columnar --flush-memory \$writeflush --cache \$cachedir \$layout file brotli tar bbcarabic > \$out
     pool = write
 
 rule write-aljazeera
-    command = find \$in | lulua-write \$layout file brotli tar aljazeera | lulua-analyze combine > \$out
+    command = find \$in | lulua-write -f columnar --flush-memory \$writeflush --cache \$cachedir \$layout file brotli tar aljazeera > \$out
     pool = write
 
 rule write-epub
-    command = find \$in | lulua-write \$layout epub | lulua-analyze combine > \$out
+    command = find \$in | lulua-write -f columnar --flush-memory \$writeflush --cache \$cachedir \$layout epub > \$out
     pool = write
 
 rule write-tanzil
-    command = find \$in | lulua-write \$layout file text | lulua-analyze combine > \$out
+    command = find \$in | lulua-write -f columnar --flush-memory \$writeflush --cache \$cachedir \$layout file text > \$out
     pool = write
 
 rule write-tei2
-    command = find \$in | lulua-write \$layout file brotli tar xml tei2 | lulua-analyze combine > \$out
+    command = find \$in | lulua-write -f columnar --flush-memory \$writeflush --cache \$cachedir \$layout file brotli tar tei2 > \$out
     pool = write
 
 rule write-opensubtitles
-    command = find \$in | lulua-write \$layout file brotli tar xml opensubtitles | lulua-analyze combine > \$out
+    command = find \$in | lulua-write -f columnar --flush-memory \$writeflush --cache \$cachedir \$layout file brotli tar opensubtitles > \$out
     pool = write
 
 rule write-arwiki
-    command = \$wikiextractor -ns 0 --json -o - \$in 2>/dev/null | jq .text | lulua-write \$layout json | lulua-analyze combine > \$out
+    command = \$wikiextractor -ns 0 --json -o - \$in 2>/dev/null | jq .text | lulua-write -f columnar --flush-memory \$writeflush --batch-items 1000 \$layout json > \$out
     pool = write
 
 rule write-osm
-    command = \$osmconvert --csv='name:ar' \$in | sort -u | lulua-write \$layout lines | lulua-analyze combine > \$out
+    command = \$osmconvert --csv='name:ar' \$in | sort -u | lulua-write -f columnar --flush-memory \$writeflush --batch-items 1000 \$layout lines > \$out
     pool = write
 
 rule combine
-    command = cat \$in | lulua-analyze combine > \$out
+    command = cat \$in | lulua-analyze combine -f columnar > \$out
 
 rule mkdir
     command = mkdir -p \$out
 
-rule letterfreq
-    command = lulua-analyze -l ar-lulua letterfreq < \$in > \$out
-
-rule analyze-layoutstats
-    command = lulua-analyze -l \$layout layoutstats < \$in > \$out
+# run multiple analyze subcommands, loading the stats only once
+rule analyze-batch
+    command = lulua-analyze batch \$outputs < \$in
 
 rule analyze-corpusstats
     command = lulua-analyze -l ar-lulua corpusstats \$metadata < \$stats > \$out
 
-rule wordlist
-    command = lulua-analyze -l ar-lulua latinime < \$in > \$out
-
-rule analyze-triadeffortdata
-    command = lulua-analyze -l \$layout triadeffortdata < \$in > \$out
-
 rule analyze-triadeffortplot
     command = cat \$in | lulua-analyze -l ar-lulua triadeffortplot > \$out
 
@@ -136,11 +129,9 @@ rule ninjaC
 build \$reportdir: mkdir
 build \$reportdir/fonts: mkdir
 build \$tempdir: mkdir
-build \$reportdir/letterfreq.json: letterfreq \$statsdir/ar-lulua/all.pickle || \$reportdir
 build \$reportdir/style.css: cp \$datadir/report/style.css || \$reportdir
 build \$reportdir/lulua-logo.svg: cp \$datadir/report/lulua-logo.svg || \$reportdir
-# wordlist
-build \$tempdir/lulua.combined: wordlist \$statsdir/ar-lulua/all.pickle || \$tempdir
+# wordlist, see analyze-batch below
 build \$reportdir/lulua.combined.gz: gz \$tempdir/lulua.combined || \$reportdir
 
 
@@ -189,43 +180,47 @@ hindawifiles=`find $corpusdir/hindawi/ -type f -name '*.epub' | tr '\n' ' '`
 
 # targets for every layout
 for l in $layouts; do
+# outputs for the report, which only use ar-lulua’s stats
+batchextra=""
+batchextraoutputs=""
+if [ "$l" = "ar-lulua" ]; then
+    batchextra=" \$reportdir/letterfreq.json \$tempdir/lulua.combined"
+    batchextraoutputs=" -o letterfreq ${l} \$reportdir/letterfreq.json -o latinime ${l} \$tempdir/lulua.combined"
+fi
 cat <<EOF
 build \$statsdir/${l}: mkdir
 
-build \$statsdir/${l}/bbcarabic.pickle: write-bbcarabic $bbcarabicfiles || \$statsdir/${l}
+build \$statsdir/${l}/bbcarabic.stats: write-bbcarabic $bbcarabicfiles || \$statsdir/${l}
     layout = ${l}
 
-build \$statsdir/${l}/aljazeera.pickle: write-aljazeera $aljazeerafiles || \$statsdir/${l}
+build \$statsdir/${l}/aljazeera.stats: write-aljazeera $aljazeerafiles || \$statsdir/${l}
     layout = ${l}
 
-build \$statsdir/${l}/hindawi.pickle: write-epub $hindawifiles || \$statsdir/${l}
+build \$statsdir/${l}/hindawi.stats: write-epub $hindawifiles || \$statsdir/${l}
     layout = ${l}
 
-build \$statsdir/${l}/tanzil-quaran.pickle: write-tanzil \$corpusdir/tanzil-quaran/plain.txt || \$statsdir/${l}
+build \$statsdir/${l}/tanzil-quaran.stats: write-tanzil \$corpusdir/tanzil-quaran/plain.txt || \$statsdir/${l}
     layout = ${l}
 
-build \$statsdir/${l}/arwiki.pickle: write-arwiki \$corpusdir/arwiki/arwiki-20190701-pages-articles.xml.bz2 || \$statsdir/${l}
+build \$statsdir/${l}/arwiki.stats: write-arwiki \$corpusdir/arwiki/arwiki-20190701-pages-articles.xml.bz2 || \$statsdir/${l}
     layout = ${l}
 
-build \$statsdir/${l}/osm.pickle: write-osm \$corpusdir/osm/planet-191104.osm.pbf || \$statsdir/${l} \$osmconvert
+build \$statsdir/${l}/osm.stats: write-osm \$corpusdir/osm/planet-191104.osm.pbf || \$statsdir/${l} \$osmconvert
     layout = ${l}
 
-build \$statsdir/${l}/un-v1.0-tei.pickle: write-tei2 $unfiles || \$statsdir/${l}
+build \$statsdir/${l}/un-v1.0-tei.stats: write-tei2 $unfiles || \$statsdir/${l}
     layout = ${l}
 
-build \$statsdir/${l}/opensubtitles-2018.pickle: write-opensubtitles $opensubtitlesfiles || \$statsdir/${l}
+build \$statsdir/${l}/opensubtitles-2018.stats: write-opensubtitles $opensubtitlesfiles || \$statsdir/${l}
     layout = ${l}
 
-build \$statsdir/${l}/all.pickle: combine \$statsdir/${l}/bbcarabic.pickle \$statsdir/${l}/aljazeera.pickle \$statsdir/${l}/tanzil-quaran.pickle \$statsdir/${l}/arwiki.pickle \$statsdir/${l}/osm.pickle \$statsdir/${l}/hindawi.pickle \$statsdir/${l}/un-v1.0-tei.pickle \$statsdir/${l}/opensubtitles-2018.pickle || \$statsdir/${l}
+build \$statsdir/${l}/all.stats: combine \$statsdir/${l}/bbcarabic.stats \$statsdir/${l}/aljazeera.stats \$statsdir/${l}/tanzil-quaran.stats \$statsdir/${l}/arwiki.stats \$statsdir/${l}/osm.stats \$statsdir/${l}/hindawi.stats \$statsdir/${l}/un-v1.0-tei.stats \$statsdir/${l}/opensubtitles-2018.stats || \$statsdir/${l}
 
 build \$reportdir/${l}.svg: render-svg || \$reportdir
     layout = ${l}
 
-build \$tempdir/${l}-heat.yaml: analyze-heat \$statsdir/${l}/all.pickle || \$tempdir
-    layout = ${l}
-
-build \$tempdir/${l}-triadeffort.pickle: analyze-triadeffortdata \$statsdir/${l}/all.pickle || \$tempdir
-    layout = ${l}
+build \$tempdir/${l}-heat.yaml \$tempdir/${l}-triadeffort.pickle \$tempdir/${l}-layoutstats.pickle${batchextra}: analyze-batch \$statsdir/${l}/all.stats || \$tempdir \$reportdir
+    outputs = -o keyheatmap ${l} \$tempdir/${l}-heat.yaml -o triadeffortdata ${l} \$tempdir/${l}-triadeffort.pickle -o layoutstats ${l} \$tempdir/${l}-layoutstats.pickle${batchextraoutputs}
 
 build \$reportdir/${l}-heat.svg: render-svg-heat \$tempdir/${l}-heat.yaml || \$reportdir
     layout = ${l}
@@ -235,9 +230,6 @@ build \$tempdir/${l}-print.svg: render-svg-print || \$tempdir
 
 build \$reportdir/${l}.pdf: svg2pdf \$tempdir/${l}-print.svg || \$reportdir
 
-build \$tempdir/${l}-layoutstats.pickle: analyze-layoutstats \$statsdir/${l}/all.pickle || \$tempdir
-    layout = ${l}
-
 EOF
 # included by index.html and thus must be its dependencies
 layoutstatsfiles+=" \$tempdir/${l}-layoutstats.pickle"
@@ -256,9 +248,9 @@ done
 metafiles=""
 for c in $corpora; do
 cat <<EOF
-build \$tempdir/metadata-$c.yaml: analyze-corpusstats \$statsdir/ar-lulua/$c.pickle \$corpusdir/$c/metadata.yaml || \$tempdir \$corpusdir/$c/metadata.yaml
+build \$tempdir/metadata-$c.yaml: analyze-corpusstats \$statsdir/ar-lulua/$c.stats \$corpusdir/$c/metadata.yaml || \$tempdir \$corpusdir/$c/metadata.yaml
     metadata = \$corpusdir/$c/metadata.yaml
-    stats = \$statsdir/ar-lulua/$c.pickle
+    stats = \$statsdir/ar-lulua/$c.stats
 
 EOF
 metafiles+=" \$tempdir/metadata-$c.yaml"
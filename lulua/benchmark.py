@@ -0,0 +1,112 @@
+# Copyright (c) 2019 lulua contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Benchmarks for performance-critical parts of lulua
+"""
+
+import argparse, sys, time, subprocess, re
+
+def bestOf (func, repeat):
+    """ Best wall clock time of repeat calls to func and its last result """
+    best = None
+    for i in range (repeat):
+        start = time.perf_counter ()
+        result = func ()
+        t = time.perf_counter () - start
+        best = t if best is None else min (best, t)
+    return best, result
+
+def normalize (args):
+    """ Character normalization throughput """
+    from .text import CharNormalizer, charMap, mapChars
+
+    def naive (text):
+        """ Reference implementation, one character at a time """
+        return ''.join (map (lambda x: charMap.get (x, x), text)).replace ('\r\n', '\n')
+
+    # a single pass over the text, with line endings folded into the map
+    regexMap = dict (charMap, **{'\r\n': '\n'})
+    pattern = re.compile ('|'.join (sorted (map (re.escape, regexMap), key=len, reverse=True)))
+    regex = lambda text: pattern.sub (lambda m: regexMap[m.group ()], text)
+
+    text = args.input.read ()
+    normalizer = CharNormalizer ()
+    expect = None
+    translate = lambda text: mapChars (text, charMap).replace ('\r\n', '\n')
+    for name, func in (('naive', naive), ('translate', translate),
+            ('regex', regex), ('normalizer', normalizer)):
+        t, result = bestOf (lambda: func (text), args.repeat)
+        if expect is None:
+            expect = result
+        elif result != expect:
+            print (f'{name}: result differs', file=sys.stderr)
+            return 1
+        print (f'{name}: {len (text)/t/1e6:.1f} Mchar/s')
+    return 0
+
+def entryPoints ():
+    """ Console scripts of this package, as (name, module) """
+    from importlib.metadata import distribution
+    for ep in distribution (__package__).entry_points:
+        if ep.group == 'console_scripts':
+            yield ep.name, ep.value.split (':', 1)[0]
+
+def startup (args):
+    """ Cold-start cost of each console script, i.e. importing its module """
+    def run (code):
+        return bestOf (lambda: subprocess.run ([sys.executable, '-c', code],
+                check=True), args.repeat)[0]
+
+    # the interpreter’s own startup is not our business
+    base = run ('pass')
+    print (f'python: {base*1000:.0f} ms')
+    ret = 0
+    for name, module in sorted (entryPoints ()):
+        if args.script and name not in args.script:
+            continue
+        t = run (f'import {module}') - base
+        print (f'{name}: {t*1000:.0f} ms ({module})')
+        if args.limit is not None and t*1000 > args.limit:
+            ret = 1
+    return ret
+
+def main ():
+    parser = argparse.ArgumentParser(description='Benchmark lulua components.')
+    parser.add_argument('-n', '--repeat', metavar='NUM', type=int, default=5,
+            help='Run each benchmark NUM times, report the best')
+    subparsers = parser.add_subparsers()
+    sp = subparsers.add_parser('normalize', help='Character normalization')
+    sp.add_argument('input', metavar='FILE', nargs='?', default=sys.stdin,
+            type=argparse.FileType ('r'), help='Text to normalize (default: stdin)')
+    sp.set_defaults (func=normalize)
+    sp = subparsers.add_parser('startup', help='Import time of console scripts')
+    sp.add_argument('-l', '--limit', metavar='MS', type=float,
+            help='Fail if any script takes longer than MS milliseconds')
+    sp.add_argument('script', nargs='*', help='Only these scripts (default: all)')
+    sp.set_defaults (func=startup)
+
+    args = parser.parse_args()
+    if not hasattr (args, 'func'):
+        parser.error ('missing subcommand')
+    return args.func (args)
+
+if __name__ == '__main__':
+    sys.exit (main ())
@@ -33,7 +33,7 @@ Optimized for pypy, not cpython
 
 from collections import defaultdict, namedtuple
 from itertools import chain, product
-from typing import List, Tuple, Callable, Mapping, Dict
+from typing import List, Tuple, Callable, Mapping, Dict, Optional
 
 from .layout import LEFT, RIGHT, THUMB, INDEX, MIDDLE, RING, LITTLE, ButtonCombination
 from .writer import Writer
@@ -240,12 +240,270 @@ def madd (a, b):
         s += a[i] * b[i]
     return s
 
-class Carpalx:
-    __slots__ = ('absEffort', 'N', 'params', '_cache', 'writer')
+class CarpalxTables:
+    """
+    Precompiled, integer-coded effort tables for a single layout
+
+    Every button and every combination the layout can produce gets a small
+    integer id. Base effort, penalty, row and hand/finger are stored in dense
+    per-button lists, base effort and penalty are also summed up per
+    combination. The stroke path is memoized per button triple in a flat
+    list, so computing a triad’s effort is array indexing only.
+    """
+
+    __slots__ = ('params', 'buttons', 'buttonId', 'combinations',
+            'combinationId', 'baseEffort', 'penalty', 'row', 'handFinger',
+            'combBaseEffort', 'combPenalty', 'combButtons', '_stroke', '_arrays')
 
     def __init__ (self, params: ModelParams, writer: Writer):
+        self.params = params
+        layout = writer.layout
+        keyboard = layout.keyboard
+        bmap = params.baselineEffort
+
+        # buttons, which have all properties required by the model
+        self.buttons : List[Button] = []
+        self.buttonId : Dict[Button, int] = dict ()
+        self.baseEffort : List[float] = []
+        self.penalty : List[float] = []
+        self.row : List[int] = []
+        self.handFinger : List[Tuple] = []
+        for btn in keyboard.keys ():
+            try:
+                base = bmap[btn.name]
+                hand, finger = writer.getHandFinger (btn)
+            except KeyError:
+                continue
+            self.buttonId[btn] = len (self.buttons)
+            self.buttons.append (btn)
+            self.baseEffort.append (base)
+            row = keyboard.getRow (btn)
+            self.row.append (row)
+            self.handFinger.append ((hand, finger))
+            self.penalty.append (madd (params.w0HRF, (1, params.pHand[hand],
+                    params.pRow[row], params.pFinger[hand][finger])))
+
+        # every combination on every layer, including buttons that are not
+        # used by the layout right now (the optimizer may move them there)
+        kS = params.k123S[3]
+        self.combinations : List[ButtonCombination] = []
+        self.combinationId : Dict[ButtonCombination, int] = dict ()
+        self.combBaseEffort : List[float] = []
+        self.combPenalty : List[float] = []
+        self.combButtons : List[Tuple[int]] = []
+        for l in layout.layers:
+            for m in l.modifier:
+                if any (b not in self.buttonId for b in m):
+                    continue
+                for btn in self.buttons:
+                    comb = ButtonCombination (m, frozenset ([btn]))
+                    if comb in self.combinationId:
+                        continue
+                    ids = tuple (self.buttonId[b] for b in comb)
+                    self.combinationId[comb] = len (self.combinations)
+                    self.combinations.append (comb)
+                    # extra effort for hitting multiple buttons, see
+                    # Carpalx._baseEffort
+                    simultaneousPenalty = (len (ids)-1)*kS
+                    self.combBaseEffort.append (sum (self.baseEffort[i] for i in ids) + simultaneousPenalty)
+                    self.combPenalty.append (sum (self.penalty[i] for i in ids) + simultaneousPenalty)
+                    self.combButtons.append (ids)
+
+        n = len (self.buttons)
+        self._stroke : List[Optional[float]] = [None]*(n*n*n)
+        # numpy versions of the tables above, see .batchEffort ()
+        self._arrays = None
+
+    def __len__ (self):
+        return len (self.combinations)
+
+    def triadToIds (self, triad: Tuple[ButtonCombination]) -> Tuple[int, int, int]:
+        """ Convert a triad of combinations to combination ids """
+        combinationId = self.combinationId
+        return (combinationId[triad[0]], combinationId[triad[1]], combinationId[triad[2]])
+
+    def _strokeEffort (self, a: int, b: int, c: int) -> float:
+        """ Weighted stroke path for button ids a, b and c """
+        n = len (self.buttons)
+        k = (a*n+b)*n+c
+        ret = self._stroke[k]
+        if ret is None:
+            fingers = [self.handFinger[x] for x in (a, b, c)]
+            hands = [f[0] for f in fingers]
+            rows = [self.row[x] for x in (a, b, c)]
+            s = (Carpalx._strokePathHand (hands),
+                    Carpalx._strokePathRow (rows),
+                    Carpalx._strokePathFinger (fingers, (a, b, c)))
+            ret = self._stroke[k] = madd (self.params.fHRF, s)
+        return ret
+
+    def triadEffort (self, a: int, b: int, c: int) -> float:
+        """ Compute effort for triad of combination ids a, b and c, e_i """
+        params = self.params
+        k1, k2, k3, _ = params.k123S
+        be = self.combBaseEffort
+        pe = self.combPenalty
+
+        b0 = k1 * be[a] * (1 + k2 * be[b] * (1 + k3 * be[c]))
+        p0 = k1 * pe[a] * (1 + k2 * pe[b] * (1 + k3 * pe[c]))
+
+        # see Carpalx._triadEffort
+        strokeEffort = self._strokeEffort
+        combButtons = self.combButtons
+        s = min (strokeEffort (x, y, z) for x in combButtons[a] \
+                for y in combButtons[b] for z in combButtons[c])
+
+        kB, kP, kS = params.kBPS
+        return kB*b0 + kP*p0 + kS*s
+
+    def encodeTriads (self, triads: Mapping[Tuple[ButtonCombination], float]):
+        """
+        Convert a triad→weight mapping to an (N, 3) array of combination ids
+        and a weight vector, both in the mapping’s iteration order
+        """
+        import numpy as np
+
+        ids = np.fromiter (chain.from_iterable (map (self.triadToIds, triads.keys ())),
+                dtype=np.intp, count=len (triads)*3).reshape (-1, 3)
+        weights = np.fromiter (triads.values (), dtype=np.float64, count=len (triads))
+        return ids, weights
+
+    def _getArrays (self):
+        import numpy as np
+
+        if self._arrays is None:
+            # combination’s buttons, padded with -1
+            width = max (map (len, self.combButtons), default=1)
+            combButtons = np.full ((len (self.combButtons), width), -1, dtype=np.intp)
+            for i, ids in enumerate (self.combButtons):
+                combButtons[i, :len (ids)] = ids
+            # same finger numbering as Carpalx._strokePathFinger
+            fingers = [int (f[1]) if f[0] == LEFT else 6+(5-f[1]) for f in self.handFinger]
+            self._arrays = dict (
+                    combBaseEffort=np.array (self.combBaseEffort, dtype=np.float64),
+                    combPenalty=np.array (self.combPenalty, dtype=np.float64),
+                    combButtons=combButtons,
+                    hand=np.array ([int (f[0]) for f in self.handFinger], dtype=np.intp),
+                    row=np.array (self.row, dtype=np.intp),
+                    finger=np.array (fingers, dtype=np.intp),
+                    )
+        return self._arrays
+
+    @staticmethod
+    def _strokePathHandArray (h0, h1, h2):
+        """ Vectorized Carpalx._strokePathHand """
+        import numpy as np
+
+        alternating = (h0 == h2) & (h0 != h1)
+        same = (h0 == h1) & (h1 == h2)
+        return np.select ([alternating, same], [1, 2], 0)
+
+    @staticmethod
+    def _strokePathRowArray (r0, r1, r2):
+        """ Vectorized Carpalx._strokePathRow """
+        import numpy as np
+
+        d0 = r0-r1
+        d1 = r1-r2
+        d2 = r0-r2
+        # order matters, the first matching condition wins
+        conditions = [
+            (d0 == 0) & (d1 == 0),
+            ((r0 == r1) & (r2 > r1)) | ((r1 > r0) & (r1 == r2)),
+            ((r0 == r1) & (r2 < r1)) | ((r1 < r0) & (r1 == r2)),
+            np.maximum (np.maximum (abs (d0), abs (d1)), abs (d2)) <= 1,
+            (d0 < 0) & (d1 < 0),
+            (d0 > 0) & (d1 > 0),
+            np.minimum (d0, d1) < -1,
+            np.maximum (d0, d1) > 1,
+            ]
+        ret = np.select (conditions, [0, 1, 2, 3, 4, 6, 5, 7], -1)
+        assert (ret >= 0).all ()
+        return ret
+
+    @staticmethod
+    def _strokePathFingerArray (f0, f1, f2, t0, t1, t2):
+        """
+        Vectorized Carpalx._strokePathFinger, with fingers already numbered
+        and buttons t
+        """
+        import numpy as np
+
+        same = (f0 == f1) & (f1 == f2)
+        allDifferent = (f0 != f1) & (f1 != f2) & (f0 != f2)
+        someDifferent = ~same & ~allDifferent
+        keyRepeat = (t0 == t1) | (t1 == t2) | (t0 == t2)
+        rolling = ((f0 > f2) & (f2 > f1)) | ((f0 < f2) & (f2 < f1))
+        monotonic = ((f0 <= f1) & (f1 <= f2)) | ((f0 >= f1) & (f1 >= f2))
+        conditions = [
+            same & keyRepeat,
+            same,
+            rolling,
+            allDifferent & monotonic,
+            allDifferent,
+            someDifferent & monotonic & keyRepeat,
+            someDifferent & monotonic,
+            someDifferent,
+            ]
+        return np.select (conditions, [5, 7, 2, 0, 3, 1, 6, 4], -1)
+
+    def batchEffort (self, triads, weights):
+        """
+        Compute effort for many triads at once
+
+        triads is an (N, 3) array of combination ids (see .encodeTriads) and
+        weights a vector of length N. Returns the total weighted effort and
+        the effort per triad.
+        """
+        import numpy as np
+
+        triads = np.asarray (triads, dtype=np.intp).reshape (-1, 3)
+        weights = np.asarray (weights, dtype=np.float64)
+        arrays = self._getArrays ()
+        params = self.params
+        a = triads[:, 0]
+        b = triads[:, 1]
+        c = triads[:, 2]
+
+        k1, k2, k3, _ = params.k123S
+        be = arrays['combBaseEffort']
+        pe = arrays['combPenalty']
+        b0 = k1 * be[a] * (1 + k2 * be[b] * (1 + k3 * be[c]))
+        p0 = k1 * pe[a] * (1 + k2 * pe[b] * (1 + k3 * pe[c]))
+
+        # minimum stroke path of all single-button triads, see
+        # Carpalx._triadEffort
+        combButtons = arrays['combButtons']
+        hand = arrays['hand']
+        row = arrays['row']
+        finger = arrays['finger']
+        fH, fR, fF = params.fHRF
+        s = np.full (len (triads), np.inf)
+        width = combButtons.shape[1]
+        for i, j, k in product (range (width), repeat=3):
+            x = combButtons[a, i]
+            y = combButtons[b, j]
+            z = combButtons[c, k]
+            valid = (x >= 0) & (y >= 0) & (z >= 0)
+            if not valid.any ():
+                continue
+            e = fH * self._strokePathHandArray (hand[x], hand[y], hand[z]) \
+                    + fR * self._strokePathRowArray (row[x], row[y], row[z]) \
+                    + fF * self._strokePathFingerArray (finger[x], finger[y], finger[z], x, y, z)
+            s = np.where (valid, np.minimum (s, e), s)
+
+        kB, kP, kS = params.kBPS
+        effort = kB*b0 + kP*p0 + kS*s
+        return float (np.dot (weights, effort)), effort
+
+class Carpalx:
+    __slots__ = ('absEffort', 'N', 'params', '_cache', 'writer', 'tables')
+
+    def __init__ (self, params: ModelParams, writer: Writer, tables: Optional[CarpalxTables] = None):
         self.params = params
         self.writer = writer
+        # precompiled tables replace the cache, if available
+        self.tables = tables
         # reset should not reset the cache
         self._cache : Dict[Tuple[ButtonCombination], float] = dict ()
         self.reset ()
@@ -266,16 +524,24 @@ class Carpalx:
         self.N -= n
 
     def addTriads (self, triads: Mapping[Tuple[ButtonCombination], float]) -> None:
-        for t, n in triads.items ():
-            self.addTriad (t, n)
+        tables = self.tables
+        if tables is not None:
+            # vectorized
+            ids, weights = tables.encodeTriads (triads)
+            total, _ = tables.batchEffort (ids, weights)
+            self.absEffort += total
+            self.N += float (weights.sum ())
+        else:
+            for t, n in triads.items ():
+                self.addTriad (t, n)
 
     def reset (self) -> None:
         self.absEffort = 0.0
         self.N = 0.0
 
     def copy (self):
-        """ Create a copy of this instance, sharing the cache """
-        c = Carpalx (self.params, self.writer)
+        """ Create a copy of this instance, sharing the cache and tables """
+        c = Carpalx (self.params, self.writer, self.tables)
         c._cache = self._cache
         c.absEffort = self.absEffort
         c.N = self.N
@@ -401,6 +667,10 @@ class Carpalx:
 
     def _triadEffort (self, triad: Tuple[ButtonCombination]) -> float:
         """ Compute effort for a single triad t, e_i """
+        tables = self.tables
+        if tables is not None:
+            return tables.triadEffort (*tables.triadToIds (triad))
+
         ret = self._cache.get (triad)
         if ret is not None:
             return ret
@@ -0,0 +1,41 @@
+# Copyright (c) 2019 lulua contributors
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os, shutil, tempfile
+
+# Keep the on-disk cache (see util.cacheDir) out of the user’s home. Layouts
+# and keyboards are already loaded while collecting tests, so fixtures are
+# too late. Subprocesses inherit it.
+_cacheHome = None
+_oldCacheHome = None
+
+def pytest_configure (config):
+    global _cacheHome, _oldCacheHome
+    _oldCacheHome = os.environ.get ('XDG_CACHE_HOME')
+    _cacheHome = tempfile.mkdtemp (prefix='lulua-test-cache-')
+    os.environ['XDG_CACHE_HOME'] = _cacheHome
+
+def pytest_unconfigure (config):
+    if _oldCacheHome is None:
+        os.environ.pop ('XDG_CACHE_HOME', None)
+    else:
+        os.environ['XDG_CACHE_HOME'] = _oldCacheHome
+    shutil.rmtree (_cacheHome, ignore_errors=True)
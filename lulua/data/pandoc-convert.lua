@@ -0,0 +1,25 @@
+-- Persistent mediawiki to markdown converter for lulua-write, run with
+-- `pandoc lua`. Each request is the document’s length in bytes on a line of
+-- its own, followed by the document. Replies use the same framing, prefixed
+-- with a status, which is either ok or error.
+
+local function reply (status, data)
+    io.write (status, ' ', #data, '\n', data)
+    io.flush ()
+end
+
+while true do
+    local header = io.read ('l')
+    if header == nil then
+        break
+    end
+    local text = io.read (tonumber (header)) or ''
+    local ok, result = pcall (function ()
+        return pandoc.write (pandoc.read (text, 'mediawiki'), 'markdown') .. '\n'
+    end)
+    if ok then
+        reply ('ok', result)
+    else
+        reply ('error', tostring (result))
+    end
+end
@@ -18,7 +18,6 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import pkg_resources
 from itertools import chain
 from typing import Text, Dict, Iterator, List
 
@@ -67,6 +66,19 @@ class Button:
     def name (self):
         return Button._idToName[self.i]
 
+    def __getstate__ (self):
+        # ids are only valid within a process, so pickle the name instead
+        return dict (name=self.name, width=self.width, isMarked=self.isMarked,
+                scancode=self.scancode)
+
+    def __setstate__ (self, state):
+        if isinstance (state, tuple):
+            # old pickles with (None, slots), including the id
+            for k, v in state[1].items ():
+                setattr (self, k, v)
+        else:
+            self.__init__ (**state)
+
     @classmethod
     def deserialize (self, data: Dict):
         kindMap = dict (map (lambda x: (x.serializedName, x),
@@ -123,18 +135,43 @@ class MultiRowButton (Button):
         d['span'] = self.span
         return d
 
+    def __getstate__ (self):
+        d = super ().__getstate__ ()
+        d['span'] = self.span
+        return d
+
 class PhysicalKeyboard:
-    __slots__ = ('name', 'description', 'rows', '_buttonToRow')
+    __slots__ = ('name', 'description', 'rows', '_buttonToRow', '_nameToButton', 'digest')
 
     def __init__ (self, name: Text, description: Text, rows):
         self.name = name
         self.description = description
         self.rows = rows
+        # content digest, see YamlLoader
+        self.digest = None
+        self._index ()
 
+    def _index (self):
         self._buttonToRow = dict ()
-        for i, (l, r) in enumerate (rows):
+        self._nameToButton = dict ()
+        for i, (l, r) in enumerate (self.rows):
             for btn in chain (l, r):
                 self._buttonToRow[btn] = i
+                self._nameToButton[btn.name] = btn
+
+    def __getstate__ (self):
+        return dict (name=self.name, description=self.description,
+                rows=self.rows, digest=self.digest)
+
+    def __setstate__ (self, state):
+        if isinstance (state, tuple):
+            # old pickles with (None, slots)
+            state = state[1]
+        self.name = state['name']
+        self.description = state['description']
+        self.rows = state['rows']
+        self.digest = state.get ('digest')
+        self._index ()
 
     def __iter__ (self):
         return iter (self.rows)
@@ -147,11 +184,10 @@ class PhysicalKeyboard:
 
     def __getitem__ (self, name: Text) -> Button:
         """ Find button by name """
-        # XXX: speed up
-        for k in self.keys ():
-            if k.name == name:
-                return k
-        raise KeyError (f'{name} is not a valid button name')
+        try:
+            return self._nameToButton[name]
+        except KeyError:
+            raise KeyError (f'{name} is not a valid button name') from None
 
     def keys (self) -> Iterator[Button]:
         """ Iterate over all keys """
@@ -25,10 +25,9 @@ from itertools import chain
 from typing import Text, FrozenSet, Iterator, List, Dict, Any, Tuple
 
 from pygtrie import CharTrie
-import pkg_resources
 import yaml
 
-from .util import first, YamlLoader
+from .util import first, YamlLoader, cacheKey, loadCached
 
 @unique
 class Direction(IntEnum):
@@ -87,12 +86,30 @@ class Finger:
 from .keyboard import Button
 
 class ButtonCombination:
-    __slots__ = ('modifier', 'buttons', '_hash')
-
-    def __init__ (self, modifier: FrozenSet[Button], buttons: FrozenSet[Button]):
-        self.modifier = modifier
-        self.buttons = buttons
-        self._hash = hash ((self.modifier, self.buttons))
+    """
+    Modifier and buttons pressed at the same time
+
+    Combinations are interned, i.e. equal combinations are the same object,
+    and numbered by the small integer i, which is only valid within a
+    process, like Button.i.
+    """
+
+    __slots__ = ('modifier', 'buttons', 'i')
+    _interned : Dict[Tuple[FrozenSet[Button], FrozenSet[Button]], 'ButtonCombination'] = {}
+
+    def __new__ (cls, modifier: FrozenSet[Button] = None, buttons: FrozenSet[Button] = None):
+        if modifier is None and buttons is None:
+            # unpickling pickles written before interning, see __setstate__
+            return super ().__new__ (cls)
+        key = (modifier, buttons)
+        self = cls._interned.get (key)
+        if self is None:
+            self = super ().__new__ (cls)
+            self.modifier = modifier
+            self.buttons = buttons
+            self.i = len (cls._interned)
+            cls._interned[key] = self
+        return self
 
     def __len__ (self) -> int:
         return len (self.modifier) + len (self.buttons)
@@ -104,18 +121,26 @@ class ButtonCombination:
         return f'ButtonCombination({self.modifier!r}, {self.buttons!r})'
 
     def __hash__ (self):
-        return self._hash
+        return self.i
 
     def __eq__ (self, other: Any) -> bool:
+        if self is other:
+            return True
         if not isinstance (other, ButtonCombination):
             return NotImplemented
-        return self.buttons == other.buttons and self.modifier == other.modifier
+        return self.i == other.i
 
-    def __getstate__ (self):
-        return (self.modifier, self.buttons)
+    def __reduce__ (self):
+        # ids are process-specific, so store the buttons, which are pickled
+        # by name. The pickler’s memo stores each combination only once.
+        return (ButtonCombination, (self.modifier, self.buttons))
 
     def __setstate__ (self, state):
-        self.__init__ (modifier=state[0], buttons=state[1])
+        # old pickles, which cannot be mapped to the interned object
+        interned = ButtonCombination (*state)
+        self.modifier = interned.modifier
+        self.buttons = interned.buttons
+        self.i = interned.i
 
 Layer = namedtuple ('Layer', ['modifier', 'layout'])
 
@@ -187,11 +212,13 @@ class KeyboardLayout:
 class GenericLayout:
     """ Layout for _any_ kind of keyboard, i.e. not specialized """
 
-    __slots__ = ('name', 'layers')
+    __slots__ = ('name', 'layers', 'digest')
 
     def __init__ (self, name: Text, layers: List):
         self.name = name
         self.layers = layers
+        # content digest, see YamlLoader
+        self.digest = None
 
     def __eq__ (self, other):
         return self.layers == other.layers
@@ -221,6 +248,16 @@ class GenericLayout:
 
     def specialize (self, keyboard: PhysicalKeyboard) -> KeyboardLayout:
         """ Adapt this layout to an actual keyboard """
+        if self.digest is not None and keyboard.digest is not None:
+            # the keyboard and its buttons are not part of the cached layout
+            key = cacheKey ('specialize', self.digest, keyboard.digest)
+            shared = dict ((f'button:{b.name}', b) for b in keyboard.keys ())
+            shared['keyboard'] = keyboard
+            return loadCached (key, lambda: self._specialize (keyboard),
+                    shared=shared)
+        return self._specialize (keyboard)
+
+    def _specialize (self, keyboard: PhysicalKeyboard) -> KeyboardLayout:
         def findButton (args):
             name, value = args
             return keyboard.find (name), value
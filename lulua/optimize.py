@@ -18,14 +18,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import pickle, sys, random, time, logging, argparse
+import pickle, sys, random, logging, argparse, queue
 from fnmatch import fnmatch
-from copy import deepcopy
 from typing import List, Tuple, Optional, Text, FrozenSet
 from abc import abstractmethod
 from operator import itemgetter
-from collections import defaultdict
-from itertools import chain
+from multiprocessing import Process, Queue, cpu_count
 
 from tqdm import tqdm
 # work around pypy bug https://bitbucket.org/pypy/pypy/issues/2953/deadlock
@@ -33,50 +31,69 @@ tqdm.get_lock().locks = []
 import yaml
 
 from .layout import defaultLayouts, ButtonCombination, Layer, KeyboardLayout, GenericLayout
-from .carpalx import Carpalx, models, ModelParams
+from .carpalx import Carpalx, CarpalxTables, models, ModelParams
 from .writer import Writer
 from .util import first
 from .keyboard import defaultKeyboards, LetterButton
+from .stats import loadStats
 
 class Annealer:
     """
     Simulated annealing.
 
-    Override .mutate() to suit your needs. Uses exponential cooling (10^(-progress*factor))
+    Override .mutate() and .reject() to suit your needs. Moves must be
+    reversible, since the state is never copied, except for snapshots of the
+    best state found so far. Uses exponential cooling (10^(-progress*factor))
 
     Inspired by https://github.com/perrygeo/simanneal
     """
 
-    __slots__ = ('state', 'best', 'coolingFactor')
+    __slots__ = ('state', 'best', 'coolingFactor', 'energyDiffMax')
 
     def __init__ (self, state):
         self.state = state
         self.best = None
         self.coolingFactor = 6
+        # figure out the max mutation impact, so we can gradually reduce the
+        # amount of allowed changes (i.e. simulated annealing). Kept across
+        # runs, see runChains().
+        self.energyDiffMax = 0
 
     @abstractmethod
     def mutate (self):
-        """ Modify current state, returns energy change """
+        """
+        Modify current state, returns energy change and an undo token for
+        .reject()
+        """
         raise NotImplementedError ()
 
-    def run (self, steps=10000):
+    @abstractmethod
+    def reject (self, undo):
+        """ Revert the last mutation using the token returned by .mutate() """
+        raise NotImplementedError ()
+
+    def acceptDiff (self, progress, temperature=1):
+        """ Max relative energy difference accepted at progress [0, 1] """
+        return temperature*10**-(progress*self.coolingFactor)
+
+    def run (self, steps=10000, offset=0, total=None, temperature=1, progress=True):
+        """
+        Run steps iterations. A run can be part of a longer cooling schedule
+        with total steps, starting at offset. temperature scales the accepted
+        energy difference, see .acceptDiff()
+        """
+        total = total or steps
         # this is not the absolute energy, but relative
         energy = 0
         energyMax = energy
-        # figure out the max mutation impact, so we can gradually reduce the
-        # amount of allowed changes (i.e. simulated annealing)
-        energyDiffMax = 0
+        energyDiffMax = self.energyDiffMax
 
         self.best = (self.state.copy (), energy)
-        bar = tqdm (total=steps, unit='mut', smoothing=0.1)
+        bar = tqdm (total=steps, unit='mut', smoothing=0.1, disable=not progress)
         for i in range (steps):
-            start = time.time ()
+            acceptDiff = self.acceptDiff ((offset+i)/total, temperature)
 
-            progress = i/steps
-            acceptDiff = 10**-(progress*self.coolingFactor)
-
-            prev = (self.state.copy (), energy)
-            energyDiff = self.mutate ()
+            energyDiff, undo = self.mutate ()
             newEnergy = energy+energyDiff
             energyMax = max (newEnergy, energyMax)
             energyDiffAbs = abs (energyDiff)
@@ -92,14 +109,21 @@ class Annealer:
                 energy = newEnergy
             else:
                 # restore
-                self.state, energy = prev
+                self.reject (undo)
 
             bar.set_description (desc=f'{energy:5.4f}{energyDiff:+5.4f}{relDiff:+5.4f}({acceptDiff:5.4f}) [{self.best[1]:5.4f},{energyMax:5.4f}{energyDiffMax:+5.4f}]', refresh=False)
             bar.update ()
+        bar.close ()
+        self.energyDiffMax = energyDiffMax
 
         return self.best
 
 def mapButton (layout, buttonMap, b : ButtonCombination) -> ButtonCombination:
+    """
+    Map combination b of layout to its new location according to buttonMap
+    (see LayoutOptimizer.buttonMap). The optimizer works on slot ids
+    instead, this is the straightforward reference for checking its results.
+    """
     (layerNum, _) = layout.modifierToLayer (b.modifier)
     assert len (b.buttons) == 1
     button = first (b.buttons)
@@ -110,132 +134,304 @@ def mapButton (layout, buttonMap, b : ButtonCombination) -> ButtonCombination:
     return ret
 
 class LayoutOptimizerState:
-    __slots__ = ('carpalx', 'buttonMap')
+    __slots__ = ('perm', 'absEffort')
 
-    def __init__ (self, carpalx, buttonMap):
-        self.carpalx = carpalx
-        self.buttonMap = buttonMap
+    def __init__ (self, perm, absEffort=0.0):
+        self.perm = perm
+        self.absEffort = absEffort
 
     def copy (self):
-        carpalx = self.carpalx.copy ()
-        buttonMap = self.buttonMap.copy ()
-        return LayoutOptimizerState (carpalx, buttonMap)
+        return LayoutOptimizerState (self.perm.copy (), self.absEffort)
 
 class LayoutOptimizer (Annealer):
     """
     Optimize a keyboard layout.
 
-    The state here is
-    a) a carpalx instance which knows the current state’s effort/energy
-    b) a map (layerNumber: int, button: Button) → (layerNumber: int,
-       button: Button)
+    Every (layerNumber: int, button: Button) pair available for mutation is a
+    slot with an integer id. The state here is
+    a) a permutation of slot ids, i.e. the original slot i is moved to slot
+       perm[i], which is equivalent to the map (layerNumber, button) →
+       (layerNumber, button) used by optimize()
+    b) the current layout’s absolute effort (see Carpalx.absEffort)
 
-    b can be used to map each ButtonCombination for each triad to the new
-    layout. And these mapped triads can then be fed into carpalx again to
-    compute a new effort/energy.
+    All triads are converted to slot ids upfront and each slot’s combination
+    is looked up in precompiled CarpalxTables, so evaluating a triad in the
+    current layout does not create any objects.
 
     Since the whole process is pretty slow with lots of triads (and we want to
     have alot) only those affected by a mutation (self.stateToTriad) are
-    recomputed via carpalx. This gives a nice speedup of about 10x with 200k
-    triads (“it takes a day” → “it takes one (long) coffee break”).
+    recomputed. This gives a nice speedup of about 10x with 200k triads (“it
+    takes a day” → “it takes one (long) coffee break”).
     """
 
-    __slots__ = ('triads', 'allButtons', 'best', 'layout', 'pins', 'stateToTriad')
+    __slots__ = ('triads', 'slots', 'slotToComb', 'N', 'tables', 'pinned',
+            'pinnedLayers', 'stateToTriad')
 
     def __init__ (self,
             buttonMap,
-            triads: List[Tuple[ButtonCombination]],
+            triads: List[Tuple[Tuple[ButtonCombination], float]],
             layout: KeyboardLayout,
             pins: FrozenSet[Tuple[int, Optional[Text]]],
             writer: Writer,
             model: ModelParams):
-        carpalx = Carpalx (model, writer)
-        super ().__init__ (LayoutOptimizerState (carpalx, buttonMap))
-
-        self.triads = triads
-        self.layout = layout
-        self.pins = pins
-        self.allButtons = list (buttonMap.keys ())
-
-        # which triads are affected by which state?
-        self.stateToTriad = defaultdict (set)
-        for i, (t, v) in enumerate (self.triads):
+        self.tables = tables = CarpalxTables (model, writer)
+
+        self.slots = list (buttonMap.keys ())
+        slotId = dict ((s, i) for i, s in enumerate (self.slots))
+        perm = [slotId[buttonMap[s]] for s in self.slots]
+        super ().__init__ (LayoutOptimizerState (perm))
+
+        # combination id of each slot, using the layer’s first modifier
+        # XXX: this might not be correct for layer changes! use a Writer()
+        # instead
+        self.slotToComb = []
+        for layer, button in self.slots:
+            comb = ButtonCombination (layout.layers[layer].modifier[0], frozenset ([button]))
+            self.slotToComb.append (tables.combinationId[comb])
+
+        self.pinned = [s in pins for s in self.slots]
+        self.pinnedLayers = frozenset (layer for layer, button in pins if button is None)
+
+        # triads as (slot, slot, slot, weight) and which triads are affected
+        # by which slot
+        self.triads = []
+        self.stateToTriad = [[] for s in self.slots]
+        self.N = 0
+        for t, v in triads:
+            ids = []
             for comb in t:
                 layer, _ = layout.modifierToLayer (comb.modifier)
                 assert len (comb.buttons) == 1
-                button = first (comb.buttons)
-                self.stateToTriad[(layer, button)].add (i)
-
-    def _acceptMutation (self, state, a, b) -> bool:
+                ids.append (slotId[(layer, first (comb.buttons))])
+            triad = (ids[0], ids[1], ids[2], v)
+            self.triads.append (triad)
+            self.N += v
+            for i in frozenset (ids):
+                self.stateToTriad[i].append (triad)
+
+    def _acceptMutation (self, perm, a, b) -> bool:
         if a == b:
             return False
 
-        newa = state[b]
-        newb = state[a]
-
         # respect pins
-        if a in self.pins or b in self.pins or \
-                (a[0], None) in self.pins and newa[0] != a[0] or \
-                (b[0], None) in self.pins and newb[0] != b[0]:
+        if self.pinned[a] or self.pinned[b]:
+            return False
+        slots = self.slots
+        pinnedLayers = self.pinnedLayers
+        layera = slots[a][0]
+        layerb = slots[b][0]
+        if layera in pinnedLayers and slots[perm[b]][0] != layera or \
+                layerb in pinnedLayers and slots[perm[a]][0] != layerb:
             return False
 
         return True
 
+    def _affectedEffort (self, perm, a, b) -> float:
+        """ Absolute effort of all triads affected by swapping slots a and b """
+        triadEffort = self.tables.triadEffort
+        c = self.slotToComb
+        effort = 0
+        for s0, s1, s2, v in self.stateToTriad[a]:
+            effort += v*triadEffort (c[perm[s0]], c[perm[s1]], c[perm[s2]])
+        for s0, s1, s2, v in self.stateToTriad[b]:
+            # already counted above
+            if s0 == a or s1 == a or s2 == a:
+                continue
+            effort += v*triadEffort (c[perm[s0]], c[perm[s1]], c[perm[s2]])
+        return effort
+
     def mutate (self, withEnergy=True):
         """ Single step to find a neighbor """
-        buttonMap = self.state.buttonMap
+        state = self.state
+        perm = state.perm
+        n = len (perm)
         while True:
-            a = random.choice (self.allButtons)
-            b = random.choice (self.allButtons)
-            if self._acceptMutation (self.state.buttonMap, a, b):
+            a = random.randrange (n)
+            b = random.randrange (n)
+            if self._acceptMutation (perm, a, b):
                 break
         if not withEnergy:
-            buttonMap[b], buttonMap[a] = buttonMap[a], buttonMap[b]
+            perm[b], perm[a] = perm[a], perm[b]
             return
 
-        carpalx = self.state.carpalx
-        oldEffort = carpalx.effort
-        #logging.info (f'old effort is {oldEffort}')
+        # only triads containing one of the original slots are affected by the
+        # change, so compute their effort before and after the swap
+        oldEffort = self._affectedEffort (perm, a, b)
+        perm[b], perm[a] = perm[a], perm[b]
+        newEffort = self._affectedEffort (perm, a, b)
+        diff = newEffort-oldEffort
+        state.absEffort += diff
 
-        # see which *original* buttons are affected by the change, then map all
-        # triads according to state, remove them and re-add them after the swap
-        affected = set (chain (self.stateToTriad[a], self.stateToTriad[b]))
-        for i in affected:
-            t, v = self.triads[i]
-            newTriad = tuple (mapButton (self.layout, buttonMap, x) for x in t)
-            carpalx.removeTriad (newTriad, v)
-            #logging.info (f'removing triad {newTriad} {v}')
-
-        #logging.info (f'swapping {buttonMap[a]} and {buttonMap[b]}')
-        buttonMap[b], buttonMap[a] = buttonMap[a], buttonMap[b]
+        return diff/self.N if self.N else 0, (a, b, diff)
 
-        for i in affected:
-            t, v = self.triads[i]
-            newTriad = tuple (mapButton (self.layout, buttonMap, x) for x in t)
-            carpalx.addTriad (newTriad, v)
-        newEffort = carpalx.effort
-        #logging.info (f'new effort is {newEffort}')
-
-        return newEffort-oldEffort
+    def reject (self, undo):
+        """ Swap back """
+        a, b, diff = undo
+        state = self.state
+        perm = state.perm
+        perm[b], perm[a] = perm[a], perm[b]
+        state.absEffort -= diff
 
     def energy (self):
         """ Current system energy """
-        return self.state.carpalx.effort
+        return self.state.absEffort/self.N if self.N else 0
+
+    def buttonMap (self, state=None):
+        """
+        Get map (layerNumber, button) → (layerNumber, button) for state,
+        defaulting to the current one
+        """
+        state = state or self.state
+        slots = self.slots
+        return dict ((s, slots[state.perm[i]]) for i, s in enumerate (slots))
 
     def _resetEnergy (self):
         # if the user calls mutate(withEnergy=False) (for speed) the initial
         # energy is wrong. thus, we need to recalculate it here.
-        carpalx = self.state.carpalx
-        buttonMap = self.state.buttonMap
-        carpalx.reset ()
-        for t, v in self.triads:
-            newTriad = tuple (mapButton (self.layout, buttonMap, x) for x in t)
-            carpalx.addTriad (newTriad, v)
-        logging.info (f'initial effort is {carpalx.effort}')
-
-    def run (self, steps=10000):
+        triadEffort = self.tables.triadEffort
+        c = self.slotToComb
+        perm = self.state.perm
+        absEffort = 0
+        for s0, s1, s2, v in self.triads:
+            absEffort += v*triadEffort (c[perm[s0]], c[perm[s1]], c[perm[s2]])
+        self.state.absEffort = absEffort
+        logging.info (f'initial effort is {self.energy ()}')
+
+    def run (self, steps=10000, **kwargs):
         self._resetEnergy ()
-        return super().run (steps)
+        return super().run (steps, **kwargs)
+
+def replicaExchange (energies, thresholds, parity):
+    """
+    Replica exchange: Decide which neighboring chains (by temperature)
+    should exchange their states, starting with chain parity (0 or 1).
+
+    Annealer.run does not use Metropolis acceptance, but a deterministic
+    threshold: An energy increase is accepted if it is smaller than the
+    chain’s current threshold (.acceptDiff() scaled by the largest
+    difference seen). Exchanges use the same rule: One of the chains
+    always gets a lower or equal energy. The exchange is accepted if the
+    other chain would accept the increase under its own threshold. A better
+    state thus easily moves to a colder chain, but rarely the other way
+    around. Returns list of index pairs.
+    """
+    swaps = []
+    for i in range (parity, len (energies)-1, 2):
+        j = i+1
+        # only the chain whose energy increases has to accept
+        diff = energies[j]-energies[i]
+        increase, k = (diff, i) if diff > 0 else (-diff, j)
+        if increase == 0 or increase < thresholds[k]:
+            swaps.append ((i, j))
+    return swaps
+
+def _chainResult (p, outq):
+    """ Get next result of chain worker p, fail if it died """
+    while True:
+        try:
+            item = outq.get (timeout=1)
+            break
+        except queue.Empty:
+            if not p.is_alive ():
+                # it may have sent its result just before exiting
+                try:
+                    item = outq.get (timeout=1)
+                    break
+                except queue.Empty:
+                    raise RuntimeError (f'{p.name} died with exit code {p.exitcode}') from None
+    if isinstance (item, Exception):
+        raise item
+    return item
+
+def chainWorker (opt, seed, randomize, inq, outq):
+    """ A single annealing chain, controlled by runChains() """
+    try:
+        random.seed (seed)
+        if randomize:
+            for i in range (len (opt.slots)*2):
+                opt.mutate (withEnergy=False)
+        opt._resetEnergy ()
+
+        while True:
+            item = inq.get ()
+            if item is None:
+                break
+            state, offset, steps, total, temperature = item
+            if state is not None:
+                opt.state = state
+            best, relEnergy = Annealer.run (opt, steps, offset=offset,
+                    total=total, temperature=temperature, progress=False)
+            outq.put ((opt.state, best, opt.energyDiffMax))
+    except Exception as e:
+        # async exceptions
+        outq.put (e)
+
+def runChains (opt: LayoutOptimizer, chains, steps, exchange=0, randomize=False,
+        maxTemperature=10, seed=None):
+    """
+    Run multiple annealing chains of opt in parallel and return the best state
+    found.
+
+    Chains are independent (multi-start), unless exchange > 0. Then every
+    exchange steps neighboring chains, which run at temperatures between 1
+    and maxTemperature, may swap their states (replica exchange, see
+    replicaExchange()).
+    """
+    rand = random.Random (seed)
+    if exchange > 0 and chains > 1:
+        temperatures = [maxTemperature**(i/(chains-1)) for i in range (chains)]
+        interval = exchange
+    else:
+        temperatures = [1]*chains
+        interval = steps
+
+    # the optimizer, including all triads, is shared with the workers
+    workers = []
+    for i in range (chains):
+        inq = Queue ()
+        outq = Queue ()
+        p = Process (target=chainWorker,
+                args=(opt, rand.randrange (2**32), randomize, inq, outq),
+                daemon=True,
+                name=f'chain-{i}')
+        p.start ()
+        workers.append ((p, inq, outq))
+
+    states = [None]*chains
+    best = None
+    offset = 0
+    bar = tqdm (total=steps, unit='mut', smoothing=0.1)
+    try:
+        while offset < steps:
+            n = min (interval, steps-offset)
+            for (p, inq, outq), state, temperature in zip (workers, states, temperatures):
+                inq.put ((state, offset, n, steps, temperature))
+            results = [_chainResult (p, outq) for p, inq, outq in workers]
+            offset += n
+
+            states = [state for state, chainBest, energyDiffMax in results]
+            for state, chainBest, energyDiffMax in results:
+                if best is None or chainBest.absEffort < best.absEffort:
+                    best = chainBest
+
+            if exchange > 0:
+                energies = [state.absEffort/opt.N if opt.N else 0 for state in states]
+                # absolute acceptance threshold of each chain, see Annealer.run
+                thresholds = [opt.acceptDiff (offset/steps, t)*energyDiffMax \
+                        for t, (state, chainBest, energyDiffMax) in zip (temperatures, results)]
+                for i, j in replicaExchange (energies, thresholds, (offset//interval)%2):
+                    states[i], states[j] = states[j], states[i]
+
+            bar.set_description (desc=f'{min (s.absEffort for s in states)/opt.N if opt.N else 0:5.4f} [{best.absEffort/opt.N if opt.N else 0:5.4f}]', refresh=False)
+            bar.update (n)
+    finally:
+        bar.close ()
+        for p, inq, outq in workers:
+            inq.put (None)
+        for p, inq, outq in workers:
+            p.join ()
+
+    return best
 
 def parsePin (s: Text):
     """
@@ -266,6 +462,27 @@ def parseMutation (s: Text):
     b1, b2 = b.split (',')
     return (int (a1), a2), (int (b1), b2)
 
+def makeButtonMap (layout: KeyboardLayout):
+    """ Create identity map of all mutable layer+button combinations """
+    # map layer+button combinations, because a layer may have multiple modifier
+    # keys (→ can’t use ButtonCombination)
+    keyboard = layout.keyboard
+    keys = []
+    values = []
+    for i, l in enumerate (layout.layers):
+        # get all available keys from the keyboard instead the layout, so
+        # currently unused keys are considered as well
+        for k in keyboard.keys ():
+            # ignore buttons that are not letter keys for now. Also do not
+            # mutate modifier key positions.
+            # XXX: only works for single-button-modifier
+            if not isinstance (k, LetterButton) or layout.isModifier (frozenset ([k])):
+                logging.info (f'not mutating {k}')
+                continue
+            keys.append ((i, k))
+            values.append ((i, k))
+    return dict (zip (keys, values))
+
 def optimize ():
     parser = argparse.ArgumentParser(description='Optimize keyboard layout.')
     parser.add_argument('-l', '--layout', metavar='LAYOUT', help='Keyboard layout name')
@@ -278,12 +495,19 @@ def optimize ():
     parser.add_argument('-p', '--pin', default=[], type=parsePin, help='Pin these layers/buttons')
     parser.add_argument('-m', '--model', choices=list (models.keys()), default='mod01', help='Carpalx model')
     parser.add_argument('-s', '--mutate', type=parseMutation, default=[], action='append', help='Apply these mutations')
+    parser.add_argument('-c', '--chains', metavar='NUM', type=int, default=1,
+            help=f'Number of parallel annealing chains (e.g. {cpu_count ()})')
+    parser.add_argument('-x', '--exchange', metavar='STEPS', type=int, default=0,
+            help='Exchange states between chains (replica exchange) every STEPS iterations')
+    parser.add_argument('--max-temperature', dest='maxTemperature', type=float,
+            default=10, help='Temperature of the hottest chain with --exchange')
+    parser.add_argument('--seed', type=int, help='Random seed')
 
     args = parser.parse_args()
 
     logging.basicConfig (level=logging.INFO)
 
-    stats = pickle.load (sys.stdin.buffer)
+    stats = loadStats (sys.stdin.buffer, defaultKeyboards[args.keyboard])
 
     keyboard = defaultKeyboards[args.keyboard]
     layout = defaultLayouts[args.layout].specialize (keyboard)
@@ -298,24 +522,8 @@ def optimize ():
     if args.triadLimit > 0:
         triads = triads[:args.triadLimit]
 
-    # map layer+button combinations, because a layer may have multiple modifier
-    # keys (→ can’t use ButtonCombination)
-    keys = []
-    values = []
-    for i, l in enumerate (layout.layers):
-        # get all available keys from the keyboard instead the layout, so
-        # currently unused keys are considered as well
-        for k in keyboard.keys ():
-            # ignore buttons that are not letter keys for now. Also do not
-            # mutate modifier key positions.
-            # XXX: only works for single-button-modifier
-            if not isinstance (k, LetterButton) or layout.isModifier (frozenset ([k])):
-                logging.info (f'not mutating {k}')
-                continue
-            keys.append ((i, k))
-            values.append ((i, k))
-    buttonMap = dict (zip (keys, values))
-    
+    buttonMap = makeButtonMap (layout)
+
     # apply mutation
     for (i, a), (j, b) in args.mutate:
         logging.info (f'mutating {i},{a} to {j},{b}')
@@ -336,14 +544,23 @@ def optimize ():
                 logging.info (f'pinning layer {layer} {k}')
 
     opt = LayoutOptimizer (buttonMap, triads, layout, pins, writer, model=models[args.model])
-    if args.randomize:
-        logging.info ('randomizing initial layout')
-        for i in range (len (buttonMap)*2):
-            opt.mutate (withEnergy=False)
     try:
-        state, relEnergy = opt.run (steps=args.steps)
+        if args.chains > 1:
+            logging.info (f'running {args.chains} chains')
+            state = runChains (opt, args.chains, args.steps,
+                    exchange=args.exchange, randomize=args.randomize,
+                    maxTemperature=args.maxTemperature, seed=args.seed)
+            # continue with the best state found
+            opt.state = state
+        else:
+            random.seed (args.seed)
+            if args.randomize:
+                logging.info ('randomizing initial layout')
+                for i in range (len (buttonMap)*2):
+                    opt.mutate (withEnergy=False)
+            state, relEnergy = opt.run (steps=args.steps)
         energy = opt.energy ()
-        optimalButtonMap = state.buttonMap
+        optimalButtonMap = opt.buttonMap (state)
     except KeyboardInterrupt:
         logging.info ('interrupted')
         return 1
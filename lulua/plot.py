@@ -25,7 +25,8 @@ from .layout import *
 from .keyboard import defaultKeyboards
 from .util import limit, displayText
 from .writer import Writer
-from .carpalx import Carpalx, models
+from .carpalx import CarpalxTables, models
+from .stats import readStats
 
 def setPlotStyle (p):
     """ Set common plot styles """
@@ -55,7 +56,7 @@ def letterfreq (args):
     # show unicode class "letters other" only
     whitelistCategory = {'Lo'}
 
-    stats = pickle.load (sys.stdin.buffer)
+    stats = readStats (args)
 
     # XXX: add layout to stats?
     keyboard = defaultKeyboards['ibmpc105']
@@ -119,37 +120,51 @@ def letterfreq (args):
 
     return 0
 
+def binTriads (triads, layout, writer):
+    """
+    Letter-based binning of triads, in case multiple buttons are mapped to the
+    same letter. Returns the bins and the total weight.
+    """
+    # score all triads in one go
+    tables = CarpalxTables (models['mod01'], writer)
+    ids, weights = tables.encodeTriads (triads)
+    _, effort = tables.batchEffort (ids, weights)
+
+    binned = defaultdict (lambda: dict (weight=0, absEffort=0, textTriad=None))
+    weightSum = 0
+    for (triad, weight), e in zip (triads.items (), effort):
+        textTriad = tuple (layout.getText (t) for t in triad)
+        data = binned[textTriad]
+        data['weight'] += weight
+        data['absEffort'] += weight*float (e)
+        data['textTriad'] = textTriad
+        data['layers'] = tuple (layout.modifierToLayer (x.modifier)[0] for x in triad)
+        weightSum += weight
+    for data in binned.values ():
+        data['effort'] = data['absEffort']/data['weight'] if data['weight'] else 0
+    return binned, weightSum
+
 def triadfreq (args):
     """ Dump triad frequency stats to stdout """
     sorter = dict (
         weight=lambda x: x['weight'],
-        effort=lambda x: x['effort'].effort,
+        effort=lambda x: x['effort'],
         # increase impact of extremely “bad” triads using math.pow
-        combined=lambda x: (x['weight']/weightSum)*math.pow (x['effort'].effort, 2)
+        combined=lambda x: (x['weight']/weightSum)*math.pow (x['effort'], 2)
         )
     def noLimit (l, n):
         yield from l
     limiter = limit if args.limit > 0 else noLimit
 
-    stats = pickle.load (sys.stdin.buffer)
+    stats = readStats (args)
 
     # XXX: add layout to stats?
     keyboard = defaultKeyboards['ibmpc105']
     layout = defaultLayouts[args.layout].specialize (keyboard)
     writer = Writer (layout)
 
-    # letter-based binning, in case multiple buttons are mapped to the same
-    # letter.
-    binned = defaultdict (lambda: dict (weight=0, effort=Carpalx (models['mod01'], writer), textTriad=None))
-    weightSum = 0
-    for triad, weight in stats['triads'].triads.items ():
-        textTriad = tuple (layout.getText (t) for t in triad)
-        data = binned[textTriad]
-        data['weight'] += weight
-        data['effort'].addTriad (triad, weight)
-        data['textTriad'] = textTriad
-        data['layers'] = tuple (layout.modifierToLayer (x.modifier)[0] for x in triad)
-        weightSum += weight
+    triads = stats['triads'].triads
+    binned, weightSum = binTriads (triads, layout, writer)
 
     # triads that contribute to x% of the weight
     topTriads = list ()
@@ -159,13 +174,13 @@ def triadfreq (args):
             topTriads.append (data)
             topTriadsWeight += data['weight']
 
-    logging.info (f'{len (topTriads)}/{len (stats["triads"].triads)} triads '
+    logging.info (f'{len (topTriads)}/{len (triads)} triads '
             f'contribute to {args.cutoff*100}% of the typing')
 
     # final output
     sortByEffort = sorted (iter (topTriads), key=sorter[args.sort], reverse=args.reverse)
     for data in limiter (sortByEffort, args.limit):
-        print (''.join (map (displayText, data['textTriad'])), data['weight'], data['effort'].effort)
+        print (''.join (map (displayText, data['textTriad'])), data['weight'], data['effort'])
 
     return 0
 
@@ -180,25 +195,14 @@ def triadEffortData (args):
 
     import numpy as np
 
-    stats = pickle.load (sys.stdin.buffer)
+    stats = readStats (args)
 
     # XXX: add layout to stats?
     keyboard = defaultKeyboards['ibmpc105']
     layout = defaultLayouts[args.layout].specialize (keyboard)
     writer = Writer (layout)
 
-    # letter-based binning, in case multiple buttons are mapped to the same
-    # letter.
-    binned = defaultdict (lambda: dict (weight=0, effort=Carpalx (models['mod01'], writer), textTriad=None))
-    weightSum = 0
-    for triad, weight in stats['triads'].triads.items ():
-        textTriad = tuple (layout.getText (t) for t in triad)
-        data = binned[textTriad]
-        data['weight'] += weight
-        data['effort'].addTriad (triad, weight)
-        data['textTriad'] = textTriad
-        data['layers'] = tuple (layout.modifierToLayer (x.modifier)[0] for x in triad)
-        weightSum += weight
+    binned, weightSum = binTriads (stats['triads'].triads, layout, writer)
 
     # Now bin into equally-sized buckets to reduce amount of data
     nBins = 200
@@ -209,7 +213,7 @@ def triadEffortData (args):
     y = []
     for data in sorted (binned.values (), key=lambda x: x['weight'], reverse=True):
         cumulativeWeight += data['weight']
-        cumulativeEffort += data['effort'].effort * data['weight']
+        cumulativeEffort += data['absEffort']
         if not x or x[-1] + binWidth <= cumulativeWeight:
             x.append (cumulativeWeight)
             y.append (cumulativeEffort)
@@ -18,20 +18,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import argparse, sys, logging, pkg_resources, base64, unicodedata
+import argparse, sys, logging, base64, unicodedata
 from collections import namedtuple, defaultdict
 from itertools import chain
 from operator import attrgetter
 from datetime import datetime
 from xml.etree import ElementTree as ET
 
-import svgwrite
 import yaml
 
 from .layout import LITTLE, RING, MIDDLE, INDEX, THUMB, GenericLayout, defaultLayouts
 from .writer import Writer
 from .keyboard import defaultKeyboards, LetterButton
-from .util import first, displayText
+from .util import first, displayText, resourcePath, openResource
 from .winkbd import qwertyScancodeToVk, VirtualKey, WChar, makeDriverSources
 
 RendererSettings = namedtuple ('RendererSetting', ['buttonMargin', 'middleGap', 'buttonWidth', 'rounded', 'shadowOffset', 'markerStroke'])
@@ -39,7 +38,7 @@ RendererSettings = namedtuple ('RendererSetting', ['buttonMargin', 'middleGap',
 class Renderer:
     """ Keyboard to SVG renderer """
 
-    __slots__ = ('keyboard', 'layout', 'settings', 'writer', 'keyHighlight')
+    __slots__ = ('keyboard', 'layout', 'settings', 'writer', 'keyHighlight', 'svg')
 
     defaultSettings = RendererSettings (
             buttonMargin=20,
@@ -56,9 +55,13 @@ class Renderer:
         self.writer = writer
         self.settings = settings or self.defaultSettings
         self.keyHighlight = keyHighlight or {}
+        # svgwrite module, imported by .render (), which is slow to import
+        self.svg = None
 
     def render (self):
         """ Render the entire layout, return single SVG <g> container and its (width, height) """
+        import svgwrite
+        self.svg = svgwrite
         settings = self.settings
 
         btnToPos, (width, height) = self._calcDimensions (self.keyboard)
@@ -157,7 +160,7 @@ class Renderer:
     def _drawCapShadow (self, width, position, extraClass=''):
         xoff, yoff = position
         settings = self.settings
-        return svgwrite.shapes.Rect (
+        return self.svg.shapes.Rect (
                 insert=((xoff+settings.shadowOffset), (yoff+settings.shadowOffset)),
                 size=(width, settings.buttonWidth),
                 rx=settings.rounded,
@@ -167,7 +170,7 @@ class Renderer:
     def _drawCap (self, width, position):
         xoff, yoff = position
         settings = self.settings
-        return svgwrite.shapes.Rect (
+        return self.svg.shapes.Rect (
                 insert=(xoff, yoff),
                 size=(width, settings.buttonWidth),
                 rx=settings.rounded,
@@ -177,20 +180,20 @@ class Renderer:
         xoff, yoff = position
         settings = self.settings
 
-        g = svgwrite.container.Group ()
+        g = self.svg.container.Group ()
         g.attribs['class'] = 'marker'
 
         start = (xoff+width*0.3, yoff+settings.buttonWidth*0.9)
         end = (xoff+width*0.7, yoff+settings.buttonWidth*0.9)
         # its shadow
-        l = svgwrite.shapes.Line (
+        l = self.svg.shapes.Line (
                 map (lambda x: (x+settings.shadowOffset), start),
                 map (lambda x: (x+settings.shadowOffset), end),
                 stroke_width=settings.markerStroke,
                 class_='shadow')
         g.add (l)
         # the marker itself
-        l = svgwrite.shapes.Line (
+        l = self.svg.shapes.Line (
                 start,
                 end,
                 stroke_width=settings.markerStroke)
@@ -202,13 +205,13 @@ class Renderer:
         settings = self.settings
         # make the circle slight smaller to reduce overlap
         r = min (width, settings.buttonWidth)/2*0.9
-        return svgwrite.shapes.Circle (
+        return self.svg.shapes.Circle (
                 center=(xoff+width/2, yoff+settings.buttonWidth/2),
                 r=r,
                 style=f'opacity: {highlight}')
 
     def _drawLabel (self, buttonText, width, position):
-        g = svgwrite.container.Group ()
+        g = self.svg.container.Group ()
         xoff, yoff = position
         settings = self.settings
 
@@ -230,24 +233,24 @@ class Renderer:
                 tyoff = tyoff*settings.buttonWidth + moreyoff
                 # actual text must be inside tspan, so we can apply smaller font size
                 # without affecting element position
-                t = svgwrite.text.Text ('',
+                t = self.svg.text.Text ('',
                         insert=((xoff+width/2+txoff), (yoff+settings.buttonWidth/2+tyoff)),
                         text_anchor='middle',
                         direction='rtl',
                         class_=' '.join (class_))
                 if text.startswith ('[') and text.endswith (']'):
                     # XXX: should find us a font which has glyphs for control chars
-                    t.add (svgwrite.text.TSpan (text[1:-1],
+                    t.add (self.svg.text.TSpan (text[1:-1],
                             class_='controlchar',
                             direction='ltr'))
-                    g.add (svgwrite.shapes.Rect (
+                    g.add (self.svg.shapes.Rect (
                             insert=((xoff+width/2+txoff-40), (yoff+settings.buttonWidth/2+tyoff-40)),
                             size=(80, 50),
                             stroke_width=2,
                             stroke_dasharray='15,8',
                             class_=' '.join (controlclass_)))
                 else:
-                    t.add (svgwrite.text.TSpan (text, class_=style))
+                    t.add (self.svg.text.TSpan (text, class_=style))
                 g.add (t)
         return g
 
@@ -270,7 +273,7 @@ def renderSvg (args):
 
     r = Renderer (keyboard, layout=layout, writer=writer, keyHighlight=keyHeat)
     rendered, (w, h) = r.render ()
-    d = svgwrite.Drawing(args.output, size=(w, h), profile='full')
+    d = r.svg.Drawing(args.output, size=(w, h), profile='full')
 
     # using fonts via url() only works in stand-alone documents, not when
     # embedding into a website
@@ -475,7 +478,7 @@ def renderWinKbd (args):
         logging.error (f'due to the delicate relationship between virtual keys and text output this command will probably not produce working files for your layout. Please have a look at renderWinKbd() in {__file__} and fix the code.')
         return
 
-    resPath = pkg_resources.resource_filename (__package__, 'data/winkbd')
+    resPath = resourcePath ('data/winkbd')
 
     with open (args.output, 'w') as fd:
         fd.write (f'/* This header was auto-generated by {__package__}. Do not modify directly. */\n\n')
@@ -600,8 +603,8 @@ def render ():
     sp = subparsers.add_parser('svg')
     sp.add_argument('-s', '--style',
             metavar='FILE',
-            default=pkg_resources.resource_stream (__package__, 'data/render-svg.css'),
-            # pkg_resources returns bytes(), so we’ll need to decode to unicode
+            default=openResource ('data/render-svg.css'),
+            # resources are opened as bytes(), so we’ll need to decode to unicode
             # ourselves
             type=argparse.FileType('rb'),
             help='Include external stylesheet into SVG')
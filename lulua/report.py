@@ -24,8 +24,6 @@ from decimal import Decimal
 from fractions import Fraction
 
 import yaml
-from jinja2 import Environment, PackageLoader
-from bokeh.resources import CDN as bokehres
 
 from .layout import LEFT, RIGHT, Direction, FingerType
 
@@ -67,6 +65,10 @@ def render ():
     logging.basicConfig (level=logging.INFO)
     args = parser.parse_args()
 
+    # slow to import
+    from jinja2 import Environment, PackageLoader
+    from bokeh.resources import CDN as bokehres
+
     env = Environment (
             loader=PackageLoader (__package__, 'data/report'),
             )
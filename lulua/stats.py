@@ -18,18 +18,20 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import sys, operator, pickle, argparse, logging, yaml, math, time
+import sys, operator, pickle, argparse, logging, yaml, math, time, contextlib, tempfile
 from operator import itemgetter
 from itertools import chain, groupby, product
 from collections import defaultdict
-from io import StringIO
+from types import MappingProxyType
+from io import StringIO, TextIOWrapper
+from multiprocessing import Pool
 
 from .layout import *
 from .keyboard import defaultKeyboards
 from .writer import SkipEvent, Writer
-from .carpalx import Carpalx, models
-from .plot import letterfreq, triadfreq, triadEffortPlot, triadEffortData
-from .util import displayText
+from .carpalx import Carpalx, CarpalxTables, models
+from .util import displayText, lazyFunction
+from . import statsfile
 
 def updateDictOp (a, b, op):
     """ Update dict a by adding items from b using op """
@@ -145,18 +147,26 @@ class TriadStats (Stats):
     """
     Button triad stats with an overlap of two.
 
-    Whitespace buttons are ignored.
+    Whitespace buttons are ignored. Triads are stored as a single integer,
+    which packs three 16 bit combination ids.
     """
 
-    __slots__ = ('_triad', 'triads', '_writer', '_ignored')
+    __slots__ = ('_triad', '_triadLen', '_counts', '_combinations',
+            '_combinationIds', '_writer', '_ignored', '_decoded')
 
     name = 'triads'
 
     def __init__ (self, writer):
         self._writer = writer
 
-        self._triad = []
-        self.triads = defaultdict (int)
+        self._triad = 0
+        self._triadLen = 0
+        self._counts = defaultdict (int)
+        # id → combination and vice versa
+        self._combinations = []
+        self._combinationIds = dict ()
+        # cached .triads
+        self._decoded = None
         keyboard = self._writer.layout.keyboard
         self._ignored = frozenset (keyboard[x] for x in ('Fl_space', 'Fr_space', 'CD_ret', 'Cl_tab'))
 
@@ -165,27 +175,83 @@ class TriadStats (Stats):
             return NotImplemented
         return self.triads == other.triads
 
+    def __getstate__ (self):
+        return dict (writer=self._writer, ignored=self._ignored,
+                combinations=self._combinations, counts=self._counts)
+
+    def __setstate__ (self, state):
+        self._triad = 0
+        self._triadLen = 0
+        self._decoded = None
+        if isinstance (state, tuple):
+            # old pickles with (None, slots)
+            state = state[1]
+            self._writer = state['_writer']
+            self._ignored = state['_ignored']
+            self._combinations = []
+            self._combinationIds = dict ()
+            self._counts = defaultdict (int)
+            for k, v in state['triads'].items ():
+                self.add (k, v)
+        else:
+            self._writer = state['writer']
+            self._ignored = state['ignored']
+            self._combinations = state['combinations']
+            self._combinationIds = dict ((c, i) for i, c in enumerate (self._combinations))
+            self._counts = state['counts']
+
+    @property
+    def triads (self):
+        """
+        Read-only triad counts, with triads as tuple of ButtonCombination.
+        Use .add () to modify them.
+        """
+        if self._decoded is None:
+            combs = self._combinations
+            self._decoded = MappingProxyType (dict (
+                    ((combs[k >> 32], combs[(k >> 16) & 0xffff], combs[k & 0xffff]), v)
+                    for k, v in self._counts.items ()))
+        return self._decoded
+
+    def _id (self, comb):
+        i = self._combinationIds.get (comb)
+        if i is None:
+            i = self._combinationIds[comb] = len (self._combinations)
+            assert i < 2**16
+            self._combinations.append (comb)
+        return i
+
+    def add (self, triad, count=1):
+        """ Add count to triad, a tuple of three ButtonCombination """
+        a, b, c = map (self._id, triad)
+        self._counts[(a << 32) | (b << 16) | c] += count
+        self._decoded = None
+
     def process (self, event):
         if isinstance (event, SkipEvent):
             # reset
-            self._triad = []
+            self._triad = 0
+            self._triadLen = 0
         elif isinstance (event, ButtonCombination):
             assert len (event.buttons) == 1
             btn = first (event.buttons)
             if btn not in self._ignored:
-                self._triad.append (event)
-
-                if len (self._triad) > 3:
-                    self._triad = self._triad[1:]
-                    assert len (self._triad) == 3
-                if len (self._triad) == 3:
-                    k = tuple (self._triad)
-                    self.triads[k] += 1
+                self._triad = ((self._triad << 16) | self._id (event)) & 0xffffffffffff
+                if self._triadLen == 2:
+                    self._counts[self._triad] += 1
+                    self._decoded = None
+                else:
+                    self._triadLen += 1
         else:
             raise ValueError ()
 
     def update (self, other):
-        updateDictOp (self.triads, other.triads, operator.add)
+        # remap other’s ids
+        ids = [self._id (c) for c in other._combinations]
+        counts = self._counts
+        for k, v in other._counts.items ():
+            counts[(ids[k >> 32] << 32) | (ids[(k >> 16) & 0xffff] << 16) | ids[k & 0xffff]] += v
+        self._decoded = None
 
 class WordStats (Stats):
     """
@@ -230,6 +296,374 @@ class WordStats (Stats):
 
 allStats = [SimpleStats, RunlenStats, TriadStats, WordStats]
 
+class FusedStats:
+    """
+    Single-pass accumulator for all of allStats
+
+    Consumes the event stream of Writer.type once, keeping per-combination
+    data (ids, hand/finger, text) in a cache. Use .stats () to get the
+    results as instances of allStats.
+    """
+
+    __slots__ = ('_writer', '_ignored', '_info', '_combinationList',
+            'combinations', 'unknown', 'perHandRunlenDist', 'fingerRunlenDist',
+            'triads', 'words', '_state')
+
+    def __init__ (self, writer):
+        self._writer = writer
+        keyboard = writer.layout.keyboard
+        self._ignored = frozenset (keyboard[x] for x in ('Fl_space', 'Fr_space', 'CD_ret', 'Cl_tab'))
+        # combination → (id, hand, finger key, ignored for triads, text,
+        # text is a word)
+        self._info = dict ()
+        self._combinationList = []
+
+        self.combinations = defaultdict (int)
+        self.unknown = defaultdict (int)
+        self.perHandRunlenDist = dict ((x, defaultdict (int)) for x in Direction)
+        self.fingerRunlenDist = dict (((x, y), defaultdict (int)) for x, y in product (iter (Direction), iter (FingerType)))
+        # three 16 bit combination ids per key, see .stats ()
+        self.triads = defaultdict (int)
+        self.words = defaultdict (int)
+        # lastHand, runlen, lastFinger, fingerRunlen, triad, triadLen, word
+        self._state = (None, 0, None, 0, 0, 0, '')
+
+    def _makeInfo (self, comb):
+        if not isinstance (comb, ButtonCombination):
+            raise ValueError ()
+        assert len (comb.buttons) == 1
+        btn = first (comb.buttons)
+        hand, finger = self._writer.getHandFinger (btn)
+        i = len (self._combinationList)
+        assert i < 2**16
+        self._combinationList.append (comb)
+        text = self._writer.layout.getText (comb)
+        isWord = all (unicodedata.category (t) in {'Lo', 'Mn'} for t in text)
+        return (i, hand, (hand, finger), btn in self._ignored, text, isWord)
+
+    def process (self, event):
+        """ Process a single event, like Stats.process """
+        if isinstance (event, SkipEvent):
+            self.consume ([(None, event)])
+        else:
+            self.consume ([(True, event)])
+
+    def consume (self, events, count=1):
+        """ Process all (match, event) pairs from Writer.type count times """
+        info = self._info
+        combinations = self.combinations
+        unknown = self.unknown
+        perHand = self.perHandRunlenDist
+        perFinger = self.fingerRunlenDist
+        triads = self.triads
+        words = self.words
+        lastHand, runlen, lastFinger, fingerRunlen, triad, triadLen, word = self._state
+
+        for match, event in events:
+            if match is None:
+                # SkipEvent, reset everything
+                unknown[event.char] += count
+                lastHand = None
+                runlen = 0
+                lastFinger = None
+                fingerRunlen = 0
+                triad = triadLen = 0
+                word = ''
+                continue
+
+            i = info.get (event)
+            if i is None:
+                i = info[event] = self._makeInfo (event)
+            combId, hand, fingerKey, ignored, text, isWord = i
+
+            combinations[event] += count
+
+            if lastHand and hand != lastHand:
+                perHand[lastHand][runlen] += count
+                runlen = 0
+            runlen += 1
+            lastHand = hand
+
+            if lastFinger and fingerKey != lastFinger:
+                perFinger[fingerKey][fingerRunlen] += count
+                fingerRunlen = 0
+            fingerRunlen += 1
+            lastFinger = fingerKey
+
+            if not ignored:
+                triad = ((triad << 16) | combId) & 0xffffffffffff
+                if triadLen == 2:
+                    triads[triad] += count
+                else:
+                    triadLen += 1
+
+            if isWord:
+                word += text
+            else:
+                for t in text:
+                    if unicodedata.category (t) in {'Lo', 'Mn'}:
+                        word += t
+                    elif word:
+                        words[word] += count
+                        word = ''
+
+        self._state = (lastHand, runlen, lastFinger, fingerRunlen, triad, triadLen, word)
+
+    def stats (self):
+        """ Get results as instances of allStats """
+        w = self._writer
+
+        simple = SimpleStats (w)
+        for comb, n in self.combinations.items ():
+            simple.combinations[comb] += n
+            for b in comb:
+                simple.buttons[b] += n
+        simple.unknown.update (self.unknown)
+
+        runlen = RunlenStats (w)
+        runlen.perHandRunlenDist = self.perHandRunlenDist
+        runlen.fingerRunlenDist = self.fingerRunlenDist
+
+        # uses the same packed triad representation
+        triads = TriadStats (w)
+        for comb in self._combinationList:
+            triads._id (comb)
+        triads._counts.update (self.triads)
+        triads._decoded = None
+
+        words = WordStats (w)
+        words.words.update (self.words)
+
+        ret = dict ((s.name, s) for s in (simple, runlen, triads, words))
+        return [ret[cls.name] for cls in allStats]
+
+class NgramStats:
+    """
+    Layout-independent character n-gram stats, which can be projected onto
+    any layout with .project ().
+
+    For every character of a text the window of order-1 characters before
+    it, the character itself and lookahead characters after it is counted,
+    since the layout may combine multiple characters into one button
+    combination. Words are counted with their delimiter, which decides
+    whether WordStats sees them.
+
+    Projection replays each window with a Writer and only counts the event
+    starting at the window’s center character. Simple stats are exact as
+    long as the context determines the Writer’s choices, triads if their
+    first combination is visible in the window too. Run lengths cannot be
+    recovered if a run starts before the window, so they are only projected
+    if all runs fit into the context.
+    """
+
+    __slots__ = ('order', 'lookahead', 'grams', 'words', '_context', '_lookahead', '_word')
+
+    name = 'ngrams'
+    # padding at the beginning and end of a text, never typed
+    sentinel = '\0'
+
+    def __init__ (self, order=4, lookahead=2):
+        assert order >= 1
+        self.order = order
+        self.lookahead = lookahead
+        self.grams = defaultdict (int)
+        # (word, delimiter) → count
+        self.words = defaultdict (int)
+        self._context = None
+
+    def __eq__ (self, other):
+        if not isinstance (other, NgramStats):
+            return NotImplemented
+        return self.order == other.order and self.lookahead == other.lookahead \
+                and self.grams == other.grams and self.words == other.words
+
+    def __getstate__ (self):
+        return dict (order=self.order, lookahead=self.lookahead,
+                grams=self.grams, words=self.words)
+
+    def __setstate__ (self, state):
+        self.order = state['order']
+        self.lookahead = state['lookahead']
+        self.grams = state['grams']
+        self.words = state['words']
+        self._context = None
+
+    def consume (self, chunks):
+        """ Process a single text, split into chunks """
+        self._context = self.sentinel*(self.order-1)
+        self._word = ''
+        for chunk in chunks:
+            self._process (chunk)
+        # words at the end of a text are never counted
+        self._word = ''
+        self._process (self.sentinel*self.lookahead)
+        self._context = None
+
+    def _process (self, chunk):
+        if not chunk:
+            return
+        # the last window in the previous chunk was lacking lookahead
+        text = self._context + chunk
+        n = self.order + self.lookahead
+        grams = self.grams
+        for i in range (len (text)-n+1):
+            grams[text[i:i+n]] += 1
+        self._context = text[max (len (text)-n+1, 0):]
+
+        word = self._word
+        for isWord, run in groupby (chunk, key=_isWordChar.__getitem__):
+            if isWord:
+                word += ''.join (run)
+            else:
+                if word:
+                    self.words[(word, next (run))] += 1
+                word = ''
+        self._word = word
+
+    def update (self, other):
+        if (self.order, self.lookahead) != (other.order, other.lookahead):
+            raise ValueError ('incompatible n-gram stats')
+        updateDictOp (self.grams, other.grams, operator.add)
+        updateDictOp (self.words, other.words, operator.add)
+
+    def project (self, layout, exact=True):
+        """
+        Create allStats for KeyboardLayout layout, like writing the texts
+        would. Raises InexactProjection if the order is too small to see
+        everything affecting the results. Otherwise, if not exact, simple
+        stats and triads are approximated and runlen is missing.
+        """
+        if layout.bufferLen-1 > self.lookahead:
+            raise ValueError (f'layout needs {layout.bufferLen-1} characters lookahead')
+        target = self.order-1
+        table = Writer (layout).table
+
+        # only warms up the state before a window’s center character
+        warmup = FusedStats (Writer (layout, table))
+        result = FusedStats (Writer (layout, table))
+        # state contains combination ids, which must be the same
+        warmup._info = result._info
+        warmup._combinationList = result._combinationList
+        initialState = result._state
+        # number of windows, whose event or triad may differ from the text
+        hidden = dict (simple=0, triads=0)
+        runsVisible = True
+        for gram, count in self.grams.items ():
+            w = Writer (layout, table)
+            pos = 0
+            prefix = []
+            # Events from index settled on are the same as for the text. The
+            # first event may be part of a longer match in the text, unless
+            # it is the text’s beginning, and choices depend on the previous
+            # combination (skips do not count) until there was only one.
+            writerSettled = gram[0] == self.sentinel
+            settled = 0
+            for match, event in w.type (StringIO (gram)):
+                ok = bool (prefix) or writerSettled
+                if match is not None:
+                    ok = ok and (writerSettled or len (table.sets[table.setIds[match]]) == 1)
+                    writerSettled = ok
+                if not ok:
+                    settled = len (prefix) + 1
+                if pos >= target and settled > len (prefix):
+                    # the text may have a different event here
+                    hidden['simple'] += count
+                    hidden['triads'] += count
+                    runsVisible = False
+                if pos == target:
+                    warmup._state = initialState
+                    warmup.consume (prefix)
+                    if match is not None and settled <= len (prefix):
+                        if runsVisible:
+                            runsVisible = not _runStartHidden (w, warmup._state,
+                                    len (prefix), settled, event)
+                        if first (event.buttons) not in result._ignored and \
+                                _triadStartHidden (prefix, settled, result._ignored):
+                            hidden['triads'] += count
+                    result._state = warmup._state
+                    result.consume ([(match, event)], count)
+                    break
+                elif pos > target:
+                    # center character is part of a longer match
+                    break
+                prefix.append ((match, event))
+                pos += 1 if match is None else len (match)
+
+        words = FusedStats (Writer (layout, table))
+        for (word, delim), count in self.words.items ():
+            words._state = initialState
+            words.consume (Writer (layout, table).type (StringIO (word + delim)), count)
+        result.words = words.words
+
+        hidden = dict ((k, v) for k, v in hidden.items () if v)
+        if not runsVisible:
+            hidden['runlen'] = None
+        if hidden:
+            e = InexactProjection (self, hidden)
+            if exact:
+                raise e
+            logging.warning (e)
+
+        ret = dict ((s.name, s) for s in result.stats ())
+        if not runsVisible:
+            del ret['runlen']
+        return ret
+
+class InexactProjection (ValueError):
+    """
+    NgramStats cannot be projected exactly. hidden maps the affected stats’
+    names to the number of windows, which may differ from the text, if known.
+    """
+
+    def __init__ (self, ngrams, hidden):
+        self.hidden = hidden
+        total = sum (ngrams.grams.values ())
+        sections = ', '.join (k if v is None else f'{k} ({v/total:.2%} of windows)'
+                for k, v in hidden.items ())
+        super ().__init__ (f'order {ngrams.order} is too small for exact {sections}')
+
+def _triadStartHidden (prefix, settled, ignored):
+    """
+    Check whether the triad ending with the event after (match, event) pairs
+    prefix starts before index settled, i.e. may differ from the text.
+    """
+    need = 2
+    for i in range (len (prefix)-1, -1, -1):
+        match, event = prefix[i]
+        if match is None:
+            # skips reset the triad
+            need = 0
+        elif first (event.buttons) not in ignored:
+            need -= 1
+        if need == 0:
+            return i < settled
+    return True
+
+def _runStartHidden (writer, state, numEvents, settled, event):
+    """
+    Check whether the window’s FusedStats state after numEvents events is
+    insufficient to tell whether and which hand or finger run event ends.
+    Events before index settled may differ from the text.
+    """
+    lastHand, runlen, lastFinger, fingerRunlen = state[:4]
+    hand, finger = writer.getHandFinger (first (event.buttons))
+    # the event before the run (or event) must be settled, i.e. a skip or
+    # change of hand/finger, which is also in the text
+    for last, current, n in ((lastHand, hand, runlen),
+            (lastFinger, (hand, finger), fingerRunlen)):
+        boundary = numEvents-n-1 if current != last else numEvents-1
+        if boundary < settled:
+            return True
+    return False
+
+class _WordChars (dict):
+    """ Cache of characters WordStats considers part of a word """
+    def __missing__ (self, c):
+        v = self[c] = unicodedata.category (c) in {'Lo', 'Mn'}
+        return v
+
+_isWordChar = _WordChars ()
+
 def unpickleAll (fd):
     while True:
         try:
@@ -243,16 +677,108 @@ def makeCombined (keyboard):
     w = Writer (layout)
     return dict ((cls.name, cls(w)) for cls in allStats)
 
+class LazyStats (dict):
+    """
+    Combined stats backed by columnar stats files, see makeCombined(). Each
+    stats object is created on first access, so subcommands only pay for the
+    sections they use.
+    """
+
+    __slots__ = ('files', 'keyboard', '_writer')
+
+    def __init__ (self, files, keyboard):
+        super ().__init__ ()
+        self.files = files
+        self.keyboard = keyboard
+        self._writer = None
+
+    def __missing__ (self, name):
+        cls = next ((cls for cls in allStats if cls.name == name), None)
+        if cls is None:
+            raise KeyError (name)
+        if self._writer is None:
+            self._writer = Writer (defaultLayouts['null'].specialize (self.keyboard))
+        s = self[name] = cls (self._writer)
+        for f in self.files:
+            f.toStats (self, self.keyboard, names=(name, ))
+        return s
+
+def loadStats (fd, keyboard):
+    """
+    Load combined stats from buffered reader fd, which is either a pickle or
+    a columnar stats file
+    """
+    columnar, fd = statsfile.sniff (fd)
+    if columnar:
+        return LazyStats (statsfile.openContainers (statsfile.mapFile (fd)), keyboard)
+    return pickle.load (fd)
+
+def readStats (args):
+    """ Stats for subcommand args, preloaded by batch or read from stdin """
+    stats = getattr (args, 'stats', None)
+    if stats is None:
+        stats = loadStats (sys.stdin.buffer, defaultKeyboards[args.keyboard])
+    return stats
+
+def writeCombined (files, fd, format, keyboard):
+    """ Merge statsfile containers files and write the result to fd in format """
+    if format == 'columnar':
+        statsfile.merge (files, fd)
+        return
+    # merge first, which is faster than updating the stats objects
+    with tempfile.TemporaryFile () as merged:
+        statsfile.merge (files, merged)
+        combined = makeCombined (keyboard)
+        for f in statsfile.openContainers (statsfile.mapFile (merged)):
+            f.toStats (combined, keyboard)
+    pickle.dump (combined, fd, pickle.HIGHEST_PROTOCOL)
+
 def combine (args):
     keyboard = defaultKeyboards[args.keyboard]
-    combined = makeCombined (keyboard)
-    for r in unpickleAll (sys.stdin.buffer):
-        for s in allStats:
-            combined[s.name].update (r[s.name])
-    pickle.dump (combined, sys.stdout.buffer, pickle.HIGHEST_PROTOCOL)
+    columnar, fd = statsfile.sniff (sys.stdin.buffer)
+    if columnar:
+        files = statsfile.openContainers (statsfile.mapFile (fd))
+        writeCombined (files, sys.stdout.buffer, args.format, keyboard)
+    else:
+        combined = makeCombined (keyboard)
+        ngrams = None
+        for r in unpickleAll (fd):
+            if isinstance (r, NgramStats):
+                if ngrams is None:
+                    ngrams = r
+                else:
+                    ngrams.update (r)
+                continue
+            for s in allStats:
+                combined[s.name].update (r[s.name])
+        if ngrams is not None:
+            # cannot be mixed with regular stats
+            pickle.dump (ngrams, sys.stdout.buffer, pickle.HIGHEST_PROTOCOL)
+        elif args.format == 'columnar':
+            statsfile.dump (combined, sys.stdout.buffer)
+        else:
+            pickle.dump (combined, sys.stdout.buffer, pickle.HIGHEST_PROTOCOL)
+
+def project (args):
+    """ Project n-gram stats onto a layout """
+    keyboard = defaultKeyboards[args.keyboard]
+    layout = defaultLayouts[args.layout].specialize (keyboard)
+    ngrams = pickle.load (sys.stdin.buffer)
+    try:
+        combined = ngrams.project (layout, exact=not args.approximate)
+    except InexactProjection as e:
+        logging.error (f'{e}, increase it or pass --approximate')
+        return 1
+    if args.format == 'columnar':
+        if 'runlen' not in combined:
+            logging.error ('columnar output requires run lengths, increase the n-gram order')
+            return 1
+        statsfile.dump (combined, sys.stdout.buffer)
+    else:
+        pickle.dump (combined, sys.stdout.buffer, pickle.HIGHEST_PROTOCOL)
 
 def pretty (args):
-    stats = pickle.load (sys.stdin.buffer)
+    stats = readStats (args)
 
     keyboard = defaultKeyboards[args.keyboard]
     layout = defaultLayouts[args.layout].specialize (keyboard)
@@ -288,7 +814,8 @@ def pretty (args):
         print (f'{k:2d} {v:10d} {v/total*100:5.1f}%')
 
     print ('triads')
-    for triad, count in sorted (stats['triads'].triads.items (), key=itemgetter (1)):
+    triads = stats['triads'].triads
+    for triad, count in sorted (triads.items (), key=itemgetter (1)):
         print (f'{triad} {count:10d}')
 
     totalWords = sum (stats['words'].words.values ())
@@ -296,12 +823,13 @@ def pretty (args):
     for word, count in sorted (stats['words'].words.items (), key=itemgetter (1)):
         print (f'{word:20s} {count/totalWords*100:2.5f} {count:10d}')
 
-    effort = Carpalx (models['mod01'], writer)
-    effort.addTriads (stats['triads'].triads)
+    model = models['mod01']
+    effort = Carpalx (model, writer, CarpalxTables (model, writer))
+    effort.addTriads (triads)
     print ('total effort (carpalx)', effort.effort)
 
 def keyHeatmap (args):
-    stats = pickle.load (sys.stdin.buffer)
+    stats = readStats (args)
 
     keyboard = defaultKeyboards[args.keyboard]
     layout = defaultLayouts[args.layout].specialize (keyboard)
@@ -321,7 +849,7 @@ def layoutstats (args):
     """
     Various statistics for the report
     """
-    stats = pickle.load (sys.stdin.buffer)
+    stats = readStats (args)
 
     keyboard = defaultKeyboards[args.keyboard]
     layout = defaultLayouts[args.layout].specialize (keyboard)
@@ -383,7 +911,7 @@ def latinImeDict (args):
         """
         return 255+int (round (math.log (p, 1.15)))
 
-    stats = pickle.load (sys.stdin.buffer)
+    stats = readStats (args)
     now = int (round (time.time ()))
 
     print ('# auto-generated by ' + __package__)
@@ -395,7 +923,7 @@ def latinImeDict (args):
 
 def corpusStats (args):
     """ Get corpus stats from stat files """
-    stats = pickle.load (sys.stdin.buffer)
+    stats = readStats (args)
     meta = yaml.safe_load (args.metadata)
 
     meta['stats'] = dict (characters=sum (stats['simple'].combinations.values ()),
@@ -406,6 +934,71 @@ def corpusStats (args):
     print ('---')
 
 
+# subcommands batch can run, i.e. those reading stats from stdin
+batchCommands = ('pretty', 'letterfreq', 'triadfreq', 'triadeffortdata',
+        'keyheatmap', 'layoutstats', 'latinime', 'corpusstats')
+# jobs of the current batch, inherited by forked workers
+_batchJobs = []
+
+def _runBatchJob (i):
+    jobArgs, output = _batchJobs[i]
+    try:
+        # like sys.stdout, text written with print () and binary data
+        # written to .buffer must end up in order
+        with open (output, 'wb') as raw, \
+                TextIOWrapper (raw, write_through=True) as fd, \
+                contextlib.redirect_stdout (fd):
+            ret = jobArgs.func (jobArgs)
+    except Exception:
+        logging.exception (f'{jobArgs.command} for {jobArgs.layout} failed')
+        ret = 1
+    return ret or 0
+
+def batch (args, parser):
+    """ Load stats once and run multiple subcommands on them """
+    global _batchJobs
+
+    if args.jobs < 1:
+        parser.error ('--jobs must be at least 1')
+
+    metadata = None
+    if args.metadata is not None:
+        try:
+            with open (args.metadata) as fd:
+                metadata = fd.read ()
+        except OSError as e:
+            parser.error (f'cannot read metadata: {e}')
+
+    _batchJobs = []
+    for command, layout, output in args.outputs:
+        if command not in batchCommands:
+            parser.error (f'{command} cannot be used with batch, choose from {", ".join (batchCommands)}')
+        if command == 'corpusstats':
+            if metadata is None:
+                parser.error ('corpusstats requires --metadata')
+            # placeholder, which is not opened by argparse
+            extra = ['-']
+        else:
+            extra = []
+        jobArgs = parser.parse_args (['-k', args.keyboard, '-l', layout, command] + extra)
+        jobArgs.command = command
+        if command == 'corpusstats':
+            # read once above, yaml accepts strings as well
+            jobArgs.metadata = metadata
+        _batchJobs.append ((jobArgs, output))
+
+    # only after checking the arguments, since this can take a while
+    stats = loadStats (sys.stdin.buffer, defaultKeyboards[args.keyboard])
+    for jobArgs, output in _batchJobs:
+        jobArgs.stats = stats
+
+    jobs = range (len (_batchJobs))
+    if args.jobs == 1:
+        return max (map (_runBatchJob, jobs), default=0)
+    # workers inherit stats via fork, instead of loading them again
+    with Pool (args.jobs) as pool:
+        return max (pool.imap (_runBatchJob, jobs), default=0)
+
 def main ():
     parser = argparse.ArgumentParser(description='Process statistics files.')
     parser.add_argument('-l', '--layout', metavar='LAYOUT', help='Keyboard layout name')
@@ -415,20 +1008,28 @@ def main ():
     sp = subparsers.add_parser('pretty')
     sp.set_defaults (func=pretty)
     sp = subparsers.add_parser('combine')
+    sp.add_argument('-f', '--format', choices=('pickle', 'columnar'),
+            default='pickle', help='Output file format')
     sp.set_defaults (func=combine)
+    sp = subparsers.add_parser('project')
+    sp.add_argument('-f', '--format', choices=('pickle', 'columnar'),
+            default='pickle', help='Output file format')
+    sp.add_argument('-a', '--approximate', action='store_true',
+            help='Allow approximate stats if the n-gram order is too small')
+    sp.set_defaults (func=project)
     sp = subparsers.add_parser('letterfreq')
-    sp.set_defaults (func=letterfreq)
+    sp.set_defaults (func=lazyFunction ('.plot', 'letterfreq'))
     sp = subparsers.add_parser('triadfreq')
     sp.add_argument('-c', '--cutoff', type=float, default=0.5, help='Only include the top x% of all triads')
     sp.add_argument('-r', '--reverse', action='store_true', help='Reverse sorting order')
     sp.add_argument('-s', '--sort', choices={'weight', 'effort', 'combined'}, default='weight', help='Sorter')
     sp.add_argument('-n', '--limit', type=int, default=0, help='Sorter')
-    sp.set_defaults (func=triadfreq)
+    sp.set_defaults (func=lazyFunction ('.plot', 'triadfreq'))
 
     sp = subparsers.add_parser('triadeffortdata')
-    sp.set_defaults (func=triadEffortData)
+    sp.set_defaults (func=lazyFunction ('.plot', 'triadEffortData'))
     sp = subparsers.add_parser('triadeffortplot')
-    sp.set_defaults (func=triadEffortPlot)
+    sp.set_defaults (func=lazyFunction ('.plot', 'triadEffortPlot'))
 
     sp = subparsers.add_parser('keyheatmap')
     sp.set_defaults (func=keyHeatmap)
@@ -439,6 +1040,14 @@ def main ():
     sp = subparsers.add_parser('corpusstats')
     sp.add_argument('metadata', type=argparse.FileType ('r'))
     sp.set_defaults (func=corpusStats)
+    sp = subparsers.add_parser('batch', help='Run multiple subcommands on the same stats')
+    sp.add_argument('-o', '--output', dest='outputs', nargs=3,
+            action='append', metavar=('SUBCOMMAND', 'LAYOUT', 'FILE'),
+            required=True, help='Write output of SUBCOMMAND for LAYOUT to FILE')
+    sp.add_argument('--metadata', metavar='FILE', help='Metadata file for corpusstats')
+    sp.add_argument('-j', '--jobs', metavar='NUM', type=int, default=1,
+            help='Run NUM subcommands in parallel')
+    sp.set_defaults (func=lambda args: batch (args, parser))
 
     logging.basicConfig (level=logging.INFO)
     args = parser.parse_args()
@@ -0,0 +1,444 @@
+# Copyright (c) 2019 lulua contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Columnar, mergeable statistics file format
+
+A stats file is a concatenation of one or more containers, each laid out as
+
+    MAGIC | columns | footer | trailer
+
+Columns are little-endian integer arrays aligned to 8 bytes, which can be
+used directly from a memory-mapped file. The JSON footer contains the button
+and combination tables as well as the location of each column. The
+fixed-size trailer points to the footer, so containers can be found by
+walking backwards from the end of the file.
+
+Tables are sorted by name and all key columns are sorted too. Mapping the ids
+of one container to the union of all tables is thus monotonic and keeps
+the key columns sorted, which allows merging them without decoding.
+"""
+
+import io, json, struct, mmap, heapq, shutil, tempfile
+from array import array
+from itertools import groupby
+from operator import itemgetter
+from typing import List, Tuple, Iterator, Dict
+
+from .layout import ButtonCombination, Direction, FingerType
+
+MAGIC = b'LULUSTAT'
+VERSION = 1
+# footer offset (relative to container start), footer length, magic
+_trailer = struct.Struct ('<QQ8s')
+
+# integer-keyed sections and key dtype
+intSections = (('buttons', '<u4'), ('combinations', '<u4'), ('runlen', '<u8'),
+        ('fingerrunlen', '<u8'), ('triads', '<u8'))
+# string-keyed sections
+stringSections = ('unknown', 'words')
+
+def combinationKey (comb: ButtonCombination) -> Tuple[Tuple[str], Tuple[str]]:
+    """ Sortable, keyboard-independent representation of comb """
+    return (tuple (sorted (b.name for b in comb.modifier)),
+            tuple (sorted (b.name for b in comb.buttons)))
+
+def _runlenKey (hand, runlen):
+    return (int (hand) << 32) | runlen
+
+def _fingerRunlenKey (hand, finger, runlen):
+    return (int (hand) << 40) | (int (finger) << 32) | runlen
+
+class StatsWriter:
+    """ Write a single container to a (possibly unseekable) file """
+
+    __slots__ = ('fd', 'offset', 'columns')
+
+    def __init__ (self, fd):
+        self.fd = fd
+        self.offset = 0
+        self.columns = dict ()
+        self._write (MAGIC)
+
+    def _write (self, b):
+        b = memoryview (b).cast ('B')
+        self.fd.write (b)
+        self.offset += len (b)
+
+    def _align (self):
+        pad = -self.offset % 8
+        if pad:
+            self._write (bytes (pad))
+
+    def column (self, name, a):
+        """ Write numpy array a as column name """
+        self.columnChunks (name, a.dtype, [a])
+
+    def columnChunks (self, name, dtype, chunks):
+        """ Write column name from an iterator of numpy arrays """
+        import numpy as np
+        dtype = np.dtype (dtype).newbyteorder ('<')
+        self._align ()
+        start = self.offset
+        count = 0
+        for a in chunks:
+            self._write (np.ascontiguousarray (a, dtype=dtype))
+            count += len (a)
+        self.columns[name] = (start, dtype.str, count)
+
+    def stringColumn (self, name, items: Iterator[Tuple[bytes, int]]):
+        """ Write utf-8 encoded keys and counts, which are streamed to disk """
+        import numpy as np
+        self._align ()
+        start = self.offset
+        offsets = array ('Q', [0])
+        counts = array ('Q')
+        for k, v in items:
+            self._write (k)
+            offsets.append (self.offset-start)
+            counts.append (v)
+        self.columns[f'{name}.data'] = (start, '|u1', self.offset-start)
+        self.column (f'{name}.offsets', np.frombuffer (offsets, dtype=np.uint64))
+        self.column (f'{name}.counts', np.frombuffer (counts, dtype=np.uint64))
+
+    def close (self, buttons: List[str], combinations: List[Tuple]):
+        footer = json.dumps (dict (
+                version=VERSION,
+                buttons=buttons,
+                combinations=combinations,
+                columns=self.columns,
+                )).encode ('utf-8')
+        footerOffset = self.offset
+        self._write (footer)
+        self._write (_trailer.pack (footerOffset, len (footer), MAGIC))
+
+class StatsFile:
+    """ A single container inside a buffer, usually a mmap """
+
+    __slots__ = ('buf', 'start', 'buttons', 'combinations', 'columns')
+
+    def __init__ (self, buf, start: int, footer: Dict):
+        self.buf = buf
+        self.start = start
+        self.buttons = footer['buttons']
+        self.combinations = [(tuple (m), tuple (b)) for m, b in footer['combinations']]
+        self.columns = footer['columns']
+
+    def column (self, name):
+        """ Get column as numpy array, without copying """
+        import numpy as np
+        offset, dtype, count = self.columns[name]
+        return np.frombuffer (self.buf, dtype=dtype, count=count,
+                offset=self.start+offset)
+
+    def strings (self, name) -> Iterator[Tuple[bytes, int]]:
+        """ Iterate over sorted (utf-8 key, count) pairs of string section """
+        # slicing bytes is much faster than slicing a numpy array
+        data = self.column (f'{name}.data').tobytes ()
+        offsets = self.column (f'{name}.offsets').tolist ()
+        counts = self.column (f'{name}.counts').tolist ()
+        return zip (map (data.__getitem__, map (slice, offsets, offsets[1:])), counts)
+
+    def texts (self, name) -> Iterator[Tuple[str, int]]:
+        """ Iterate over sorted (key, count) pairs of string section """
+        import numpy as np
+        raw = self.column (f'{name}.data')
+        offsets = self.column (f'{name}.offsets').astype (np.int64)
+        counts = self.column (f'{name}.counts').tolist ()
+        # Decoding the whole section at once is much faster than decoding
+        # each key. Byte offsets are turned into character offsets by
+        # subtracting the number of UTF-8 continuation bytes before them.
+        text = raw.tobytes ().decode ('utf-8', 'surrogatepass')
+        continuation = np.zeros (len (raw)+1, dtype=np.int64)
+        np.cumsum ((raw & 0xc0) == 0x80, out=continuation[1:])
+        offsets = (offsets - continuation[offsets]).tolist ()
+        return zip (map (text.__getitem__, map (slice, offsets, offsets[1:])), counts)
+
+    def toStats (self, combined, keyboard, names=None):
+        """
+        Add the contents of this container to stats objects in combined,
+        see stats.makeCombined(). Only stats in names are added, if given.
+        """
+        if names is None:
+            names = combined.keys ()
+        buttonByName = dict ((b.name, b) for b in keyboard.keys ())
+        buttons = [buttonByName[n] for n in self.buttons]
+        combinations = [ButtonCombination (
+                    frozenset (buttonByName[n] for n in m),
+                    frozenset (buttonByName[n] for n in b))
+                for m, b in self.combinations]
+
+        def items (name):
+            return zip (self.column (f'{name}.keys').tolist (),
+                    self.column (f'{name}.counts').tolist ())
+
+        if 'simple' in names:
+            simple = combined['simple']
+            for k, v in items ('buttons'):
+                simple.buttons[buttons[k]] += v
+            for k, v in items ('combinations'):
+                simple.combinations[combinations[k]] += v
+            for k, v in self.texts ('unknown'):
+                simple.unknown[k] += v
+
+        if 'runlen' in names:
+            runlen = combined['runlen']
+            for k, v in items ('runlen'):
+                runlen.perHandRunlenDist[Direction (k >> 32)][k & 0xffffffff] += v
+            for k, v in items ('fingerrunlen'):
+                key = (Direction (k >> 40), FingerType ((k >> 32) & 0xff))
+                runlen.fingerRunlenDist[key][k & 0xffffffff] += v
+
+        if 'triads' in names:
+            triads = combined['triads']
+            M = len (combinations)
+            for k, v in items ('triads'):
+                k, c = divmod (k, M)
+                a, b = divmod (k, M)
+                triads.add ((combinations[a], combinations[b], combinations[c]), v)
+
+        if 'words' in names:
+            words = combined['words'].words
+            if words:
+                for k, v in self.texts ('words'):
+                    words[k] += v
+            else:
+                # keys are unique within a container
+                words.update (self.texts ('words'))
+
+class _PrefixedReader (io.RawIOBase):
+    """ Raw reader returning prefix first, then the remainder of fd """
+
+    def __init__ (self, prefix, fd):
+        self.prefix = prefix
+        self.fd = fd
+
+    def readable (self):
+        return True
+
+    def readinto (self, b):
+        if self.prefix:
+            n = min (len (b), len (self.prefix))
+            b[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        return self.fd.readinto (b)
+
+def sniff (fd):
+    """
+    Check whether buffered reader fd contains a columnar stats file. Returns
+    the result and a reader starting at the current position of fd, which
+    must be used instead of fd.
+    """
+    # read() blocks until enough data is available, unlike peek(), which
+    # may return a partial pipe buffer
+    if fd.seekable ():
+        pos = fd.tell ()
+        prefix = fd.read (len (MAGIC))
+        fd.seek (pos)
+    else:
+        prefix = fd.read (len (MAGIC))
+        fd = io.BufferedReader (_PrefixedReader (prefix, fd))
+    return prefix == MAGIC, fd
+
+def mapFile (fd):
+    """
+    Memory-map fd for reading. Unseekable files (pipes) are spooled to a
+    temporary file first.
+    """
+    if not fd.seekable ():
+        spool = tempfile.TemporaryFile ()
+        shutil.copyfileobj (fd, spool, 1024*1024)
+        spool.flush ()
+        fd = spool
+    fd.seek (0, 2)
+    if fd.tell () == 0:
+        return b''
+    return mmap.mmap (fd.fileno (), 0, access=mmap.ACCESS_READ)
+
+def openContainers (buf) -> List[StatsFile]:
+    """ Find all containers in buf """
+    ret = []
+    end = len (buf)
+    while end > 0:
+        if end < len (MAGIC) + _trailer.size:
+            raise ValueError ('truncated stats file')
+        footerOffset, footerLen, magic = _trailer.unpack_from (buf, end-_trailer.size)
+        start = end - _trailer.size - footerLen - footerOffset
+        if magic != MAGIC or start < 0 or buf[start:start+len (MAGIC)] != MAGIC:
+            raise ValueError ('invalid stats file')
+        footer = json.loads (bytes (buf[start+footerOffset:start+footerOffset+footerLen]))
+        if footer['version'] != VERSION:
+            raise ValueError (f'unsupported stats file version {footer["version"]}')
+        ret.append (StatsFile (buf, start, footer))
+        end = start
+    ret.reverse ()
+    return ret
+
+def _sortedColumns (keys, counts, dtype):
+    import numpy as np
+    keys = np.array (keys, dtype=dtype)
+    counts = np.array (counts, dtype=np.uint64)
+    order = np.argsort (keys, kind='stable')
+    return keys[order], counts[order]
+
+def _sortedStrings (d):
+    return sorted ((k.encode ('utf-8', 'surrogatepass'), v) for k, v in d.items ())
+
+def dump (stats, fd):
+    """ Write stats dict (see stats.makeCombined()) as a single container """
+    simple = stats['simple']
+    runlen = stats['runlen']
+    triads = stats['triads'].triads
+
+    combinations = set (simple.combinations.keys ())
+    for t in triads.keys ():
+        combinations.update (t)
+    combinationTable = sorted (set (map (combinationKey, combinations)))
+    combinationIds = dict ((k, i) for i, k in enumerate (combinationTable))
+    combinationToId = dict ((c, combinationIds[combinationKey (c)]) for c in combinations)
+
+    buttonTable = set (b.name for b in simple.buttons.keys ())
+    for m, b in combinationTable:
+        buttonTable.update (m)
+        buttonTable.update (b)
+    buttonTable = sorted (buttonTable)
+    buttonIds = dict ((k, i) for i, k in enumerate (buttonTable))
+
+    columns = dict ()
+    columns['buttons'] = ([buttonIds[b.name] for b in simple.buttons.keys ()],
+            list (simple.buttons.values ()))
+    columns['combinations'] = ([combinationToId[c] for c in simple.combinations.keys ()],
+            list (simple.combinations.values ()))
+    columns['runlen'] = ([], [])
+    for hand, dist in runlen.perHandRunlenDist.items ():
+        for l, v in dist.items ():
+            columns['runlen'][0].append (_runlenKey (hand, l))
+            columns['runlen'][1].append (v)
+    columns['fingerrunlen'] = ([], [])
+    for (hand, finger), dist in runlen.fingerRunlenDist.items ():
+        for l, v in dist.items ():
+            columns['fingerrunlen'][0].append (_fingerRunlenKey (hand, finger, l))
+            columns['fingerrunlen'][1].append (v)
+    M = len (combinationTable)
+    if M**3 >= 2**64:
+        raise ValueError ('too many combinations')
+    columns['triads'] = ([(combinationToId[a]*M + combinationToId[b])*M + combinationToId[c] for a, b, c in triads.keys ()],
+            list (triads.values ()))
+
+    w = StatsWriter (fd)
+    for name, dtype in intSections:
+        keys, counts = _sortedColumns (*columns[name], dtype)
+        w.column (f'{name}.keys', keys)
+        w.column (f'{name}.counts', counts)
+    w.stringColumn ('unknown', _sortedStrings (simple.unknown))
+    w.stringColumn ('words', _sortedStrings (stats['words'].words))
+    w.close (buttonTable, combinationTable)
+
+def _mergeSorted (sources, dtype, chunk=1024*1024):
+    """
+    Merge sorted, unique key columns, summing up counts of identical keys.
+    sources are (keys, counts, remap) tuples, where remap maps a slice of
+    keys to the output id space monotonically, if not None. Yields merged
+    (keys, counts) chunks, using memory proportional to the chunk size only.
+    """
+    import numpy as np
+    pos = [0]*len (sources)
+    while True:
+        slices = []
+        bound = None
+        for i, (keys, counts, remap) in enumerate (sources):
+            if pos[i] >= len (keys):
+                continue
+            end = min (pos[i]+chunk, len (keys))
+            k = keys[pos[i]:end]
+            k = (remap (k) if remap else k).astype (dtype)
+            slices.append ((i, k))
+            # keys are unique within each source, so everything up to the
+            # smallest last key of all non-exhausted slices is complete
+            if end < len (keys) and (bound is None or k[-1] < bound):
+                bound = k[-1]
+        if not slices:
+            break
+
+        mergedKeys = []
+        mergedCounts = []
+        for i, k in slices:
+            n = len (k) if bound is None else int (np.searchsorted (k, bound, side='right'))
+            mergedKeys.append (k[:n])
+            mergedCounts.append (sources[i][1][pos[i]:pos[i]+n])
+            pos[i] += n
+        keys = np.concatenate (mergedKeys)
+        counts = np.concatenate (mergedCounts).astype (np.uint64)
+        # the input consists of sorted runs, which a stable sort (timsort) merges
+        order = np.argsort (keys, kind='stable')
+        keys = keys[order]
+        counts = counts[order]
+        starts = np.concatenate (([0], np.flatnonzero (np.diff (keys)) + 1))
+        yield keys[starts], np.add.reduceat (counts, starts)
+
+def _mergeStrings (files: List[StatsFile], name) -> Iterator[Tuple[bytes, int]]:
+    merged = heapq.merge (*(f.strings (name) for f in files), key=itemgetter (0))
+    for k, group in groupby (merged, key=itemgetter (0)):
+        yield k, sum (map (itemgetter (1), group))
+
+def merge (files: List[StatsFile], fd):
+    """ Merge containers files into a single one, written to fd """
+    import numpy as np
+
+    buttonTable = sorted (set ().union (*(f.buttons for f in files)))
+    buttonIds = dict ((k, i) for i, k in enumerate (buttonTable))
+    combinationTable = sorted (set ().union (*(f.combinations for f in files)))
+    combinationIds = dict ((k, i) for i, k in enumerate (combinationTable))
+    newM = len (combinationTable)
+    if newM**3 >= 2**64:
+        raise ValueError ('too many combinations')
+
+    def remapTriads (f, keys, combinationMap):
+        M = len (f.combinations)
+        a, rest = np.divmod (keys, np.uint64 (M*M))
+        b, c = np.divmod (rest, np.uint64 (M))
+        a, b, c = combinationMap[a], combinationMap[b], combinationMap[c]
+        return (a*np.uint64 (newM) + b)*np.uint64 (newM) + c
+
+    remaps = []
+    for f in files:
+        # monotonic, so remapped key columns stay sorted
+        buttonMap = np.array ([buttonIds[k] for k in f.buttons], dtype=np.uint32)
+        combinationMap = np.array ([combinationIds[k] for k in f.combinations], dtype=np.uint64)
+        remaps.append (dict (
+                buttons=lambda k, m=buttonMap: m[k],
+                combinations=lambda k, m=combinationMap: m[k],
+                triads=lambda k, f=f, m=combinationMap: remapTriads (f, k, m),
+                ))
+
+    w = StatsWriter (fd)
+    for name, dtype in intSections:
+        def merged ():
+            return _mergeSorted ([(f.column (f'{name}.keys'),
+                    f.column (f'{name}.counts'), remap.get (name))
+                    for f, remap in zip (files, remaps)], dtype)
+        # keys and counts are separate columns, so merge twice instead of
+        # buffering either of them
+        w.columnChunks (f'{name}.keys', dtype, (k for k, c in merged ()))
+        w.columnChunks (f'{name}.counts', np.uint64, (c for k, c in merged ()))
+    for name in stringSections:
+        w.stringColumn (name, _mergeStrings (files, name))
+    w.close (buttonTable, combinationTable)
@@ -18,9 +18,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import random
+from itertools import chain
+
 import pytest
 
-from .carpalx import Carpalx, models, ModelParams
+from .carpalx import Carpalx, CarpalxTables, models, ModelParams
 from .keyboard import defaultKeyboards
 from .layout import defaultLayouts, LEFT, RIGHT, INDEX, MIDDLE, RING, LITTLE
 from .writer import Writer
@@ -199,3 +202,56 @@ def test_carpalx ():
     #c.addTriads (x)
     assert c.effort == 0.0
 
+
+@pytest.mark.parametrize("layoutName", ['ar-linux', 'ar-lulua', 'ar-phonetic'])
+def test_carpalx_tables (layoutName):
+    """ Precompiled tables must yield the same effort as the reference """
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts[layoutName].specialize (keyboard)
+    writer = Writer (layout)
+    model = models['mod01']
+    tables = CarpalxTables (model, writer)
+
+    combinations = [c for c in chain.from_iterable (v for k, v in layout) \
+            if c in tables.combinationId]
+    assert combinations
+    r = random.Random (42)
+    reference = Carpalx (model, writer)
+    compiled = Carpalx (model, writer, tables)
+    for i in range (1000):
+        t = tuple (r.choice (combinations) for j in range (3))
+        assert compiled._triadEffort (t) == pytest.approx (reference._triadEffort (t))
+        n = r.randint (1, 10)
+        reference.addTriad (t, n)
+        compiled.addTriad (t, n)
+    assert compiled.effort == pytest.approx (reference.effort)
+    # reference cache is not used
+    assert not compiled._cache
+
+@pytest.mark.parametrize("layoutName", ['ar-linux', 'ar-lulua', 'ar-phonetic'])
+def test_carpalx_batch (layoutName):
+    """ Vectorized batch evaluation must match the scalar code path """
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts[layoutName].specialize (keyboard)
+    writer = Writer (layout)
+    model = models['mod01']
+    tables = CarpalxTables (model, writer)
+
+    r = random.Random (23)
+    triads = dict ()
+    for i in range (2000):
+        t = tuple (r.choice (tables.combinations) for j in range (3))
+        triads[t] = r.randint (1, 100)
+    ids, weights = tables.encodeTriads (triads)
+    assert ids.shape == (len (triads), 3)
+    total, effort = tables.batchEffort (ids, weights)
+
+    reference = Carpalx (model, writer)
+    for (t, n), e in zip (triads.items (), effort):
+        assert e == pytest.approx (reference._triadEffort (t))
+        reference.addTriad (t, n)
+    assert total == pytest.approx (reference.absEffort)
+
+    batch = Carpalx (model, writer, tables)
+    batch.addTriads (triads)
+    assert batch.effort == pytest.approx (reference.effort)
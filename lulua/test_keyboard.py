@@ -18,6 +18,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import pickle
+
 import pytest
 
 from .keyboard import defaultKeyboards, Button, dataDirectory
@@ -93,3 +95,16 @@ def test_serialize ():
     name = 'ibmpc105'
     assert defaultKeyboards[name].serialize () == rawKeyboards[name]
 
+
+def test_pickle ():
+    """ Buttons are pickled by name, ids are process-specific """
+    k = defaultKeyboards['ibmpc105']
+    newk = pickle.loads (pickle.dumps (k))
+    assert newk.name == k.name
+    assert newk.digest == k.digest
+    for btn in k.keys ():
+        newbtn = newk[btn.name]
+        assert newbtn == btn
+        assert newk.getRow (newbtn) == k.getRow (btn)
+    with pytest.raises (KeyError):
+        newk['nonexistent']
@@ -18,7 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import unicodedata
+import unicodedata, pickle
 from itertools import product
 
 import pytest
@@ -89,3 +89,42 @@ def test_buttoncomb_eq ():
     assert b in d
     assert c not in d
 
+def test_buttoncomb_interned ():
+    keyboard = defaultKeyboards['ibmpc105']
+    buttons = list (keyboard.keys ())
+    a = ButtonCombination (frozenset ([buttons[0]]), frozenset ([buttons[1]]))
+    b = ButtonCombination (frozenset ([buttons[0]]), frozenset ([buttons[1]]))
+    c = ButtonCombination (frozenset (), frozenset ([buttons[1]]))
+    assert a is b
+    assert a.i != c.i
+
+    # interned again after unpickling, every combination stored once
+    data = pickle.dumps ([a, b, c])
+    assert data.count (buttons[1].name.encode ()) == 1
+    assert pickle.loads (data) == [a, a, c]
+    assert pickle.loads (data)[0] is a
+
+    # pickles written before interning
+    old = ButtonCombination.__new__ (ButtonCombination)
+    old.__setstate__ ((a.modifier, a.buttons))
+    assert old == a and hash (old) == hash (a)
+
+
+def test_specialize_cache (tmp_path, monkeypatch):
+    monkeypatch.setenv ('XDG_CACHE_HOME', str (tmp_path))
+    keyboard = defaultKeyboards['ibmpc105']
+    generic = defaultLayouts['ar-lulua']
+    assert generic.digest is not None
+
+    a = generic.specialize (keyboard)
+    b = generic.specialize (keyboard)
+    assert a is not b
+    assert a == b
+    # keyboard is shared, not copied
+    assert b.keyboard is keyboard
+    assert list (a) == list (b)
+
+    # layouts without digest, like optimizer results, bypass the cache
+    fresh = GenericLayout.deserialize (generic.serialize ())
+    assert fresh.digest is None
+    assert fresh.specialize (keyboard) == a
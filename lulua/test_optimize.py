@@ -18,7 +18,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from .optimize import Annealer
+import random, os
+from io import StringIO
+
+import pytest
+
+from . import optimize
+from .optimize import Annealer, LayoutOptimizer, makeButtonMap, mapButton, \
+        replicaExchange, runChains
+from .carpalx import Carpalx, models
+from .keyboard import defaultKeyboards
+from .layout import defaultLayouts
+from .stats import TriadStats
+from .writer import Writer
 
 class NullAnnealer (Annealer):
     """ Simple dummy annealer for testing """
@@ -27,8 +39,12 @@ class NullAnnealer (Annealer):
 
     def mutate (self):
         prev = self.energy ()
+        undo = self.state
         self.state = [x-1 for x in self.state]
-        return self.energy () - prev
+        return self.energy () - prev, undo
+
+    def reject (self, undo):
+        self.state = undo
 
 def test_null_annealer ():
     dut = NullAnnealer ([1, 2, 3])
@@ -37,3 +53,72 @@ def test_null_annealer ():
     assert energy == sum ([0, 1, 2])-sum([1, 2, 3])
     assert dut.energy () == sum([0, 1, 2])
 
+
+def makeOptimizer ():
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts['ar-lulua'].specialize (keyboard)
+    writer = Writer (layout)
+    model = models['mod01']
+
+    stats = TriadStats (writer)
+    for match, event in writer.type (StringIO ('السلام عليكم ورحمة الله وبركاته، كيف حالك؟ ' * 3)):
+        stats.process (event)
+    triads = list (stats.triads.items ())
+
+    return LayoutOptimizer (makeButtonMap (layout), triads, layout, [], writer, model), layout, writer, model, triads
+
+def test_layout_optimizer ():
+    """ Delta evaluation must agree with the reference implementation """
+    random.seed (42)
+    opt, layout, writer, model, triads = makeOptimizer ()
+    opt._resetEnergy ()
+    energy = opt.energy ()
+    for i in range (100):
+        perm = opt.state.perm.copy ()
+        diff, undo = opt.mutate ()
+        if i%2 == 0:
+            opt.reject (undo)
+            assert opt.state.perm == perm
+        else:
+            energy += diff
+        assert energy == pytest.approx (opt.energy ())
+
+    # compute effort from scratch for the resulting button map
+    buttonMap = opt.buttonMap ()
+    reference = Carpalx (model, writer)
+    for t, v in triads:
+        reference.addTriad (tuple (mapButton (layout, buttonMap, x) for x in t), v)
+    assert opt.energy () == pytest.approx (reference.effort)
+
+def test_replica_exchange ():
+    # hotter chain has the better state, which it accepts giving away
+    assert replicaExchange ([2, 1], [0.1, 2], 0) == [(0, 1)]
+    assert replicaExchange ([2, 1], [0.1, 0.5], 0) == []
+    # colder chain has the better state, only exchanged if the increase is
+    # within its threshold
+    assert replicaExchange ([1, 2], [0.5, 2], 0) == []
+    assert replicaExchange ([1, 2], [1.5, 2], 0) == [(0, 1)]
+    # equal energies
+    assert replicaExchange ([1, 1], [0, 0], 0) == [(0, 1)]
+    # only pairs starting at parity
+    assert replicaExchange ([3, 2, 1], [1, 2, 3], 1) == [(1, 2)]
+
+def test_run_chains_dead_worker (monkeypatch):
+    """ A worker dying without result must not hang runChains """
+    opt, layout, writer, model, triads = makeOptimizer ()
+    monkeypatch.setattr (optimize, 'chainWorker', lambda *args: os._exit (3))
+    with pytest.raises (RuntimeError, match='exit code 3'):
+        runChains (opt, 2, 10)
+
+@pytest.mark.parametrize("exchange", [0, 50])
+def test_run_chains (exchange):
+    opt, layout, writer, model, triads = makeOptimizer ()
+    opt._resetEnergy ()
+    initial = opt.state.absEffort
+    best = runChains (opt, 3, 200, exchange=exchange, seed=1)
+    assert best.absEffort <= initial
+
+    # the energy of the returned state must be exact
+    opt.state = best.copy ()
+    opt._resetEnergy ()
+    assert opt.state.absEffort == pytest.approx (best.absEffort)
@@ -18,10 +18,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import operator
+from io import StringIO
+import operator, pickle, subprocess, sys
+from random import Random
 import pytest
 
-from .stats import updateDictOp, SimpleStats, TriadStats, allStats
+from .stats import updateDictOp, SimpleStats, RunlenStats, TriadStats, WordStats, FusedStats, \
+        NgramStats, InexactProjection, allStats
 from .keyboard import defaultKeyboards
 from .layout import defaultLayouts, ButtonCombination
 from .writer import Writer, SkipEvent
@@ -123,3 +126,222 @@ def test_stats_process_value (writer):
         assert s2 == s
         assert not s2 == 1
 
+
+@pytest.mark.parametrize("layout", ['ar-lulua', 'ar-linux', 'ar-phonetic'])
+def test_fusedstats (layout):
+    """ Fused stats must be compatible with allStats """
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts[layout].specialize (keyboard)
+    text = 'السلامُ عليكم، لا إله إلا الله\n\tx 123 ﻻ؟ ' * 5
+
+    w = Writer (layout)
+    expect = [cls (w) for cls in allStats]
+    for match, event in w.type (StringIO (text)):
+        for s in expect:
+            s.process (event)
+
+    w = Writer (layout)
+    fused = FusedStats (w)
+    events = list (w.type (StringIO (text)))
+    # state must be kept between calls
+    fused.consume (events[:7])
+    for match, event in events[7:10]:
+        fused.process (event)
+    fused.consume (events[10:])
+    result = fused.stats ()
+
+    assert [s.name for s in result] == [s.name for s in expect]
+    for a, b in zip (result, expect):
+        assert a == b
+    assert result[1].fingerRunlenDist == expect[1].fingerRunlenDist
+
+    with pytest.raises (ValueError):
+        fused.process (1)
+
+def test_triadstats_pickle (writer):
+    keyboard = writer.layout.keyboard
+    a = ButtonCombination (frozenset (), frozenset ([keyboard['Dl1']]))
+    b = ButtonCombination (frozenset (), frozenset ([keyboard['Dl2']]))
+
+    s = TriadStats (writer)
+    for comb in (a, b, a, a, b):
+        s.process (comb)
+    assert s.triads == {(a, b, a): 1, (b, a, a): 1, (a, a, b): 1}
+
+    s2 = pickle.loads (pickle.dumps (s))
+    assert s2 == s
+
+    # merging remaps ids
+    s3 = TriadStats (writer)
+    s3.add ((b, b, b), 2)
+    s3.update (s)
+    assert s3.triads == {(a, b, a): 1, (b, a, a): 1, (a, a, b): 1, (b, b, b): 2}
+
+    # read-only, cached view that follows modifications
+    view = s3.triads
+    assert s3.triads is view
+    with pytest.raises (TypeError):
+        view[(a, a, a)] = 1
+    s3.add ((a, a, a))
+    assert s3.triads[(a, a, a)] == 1
+    for comb in (a, a, a):
+        s3.process (comb)
+    assert s3.triads[(a, a, a)] == 2
+
+    # pickles using the old dict of tuples
+    old = TriadStats.__new__ (TriadStats)
+    old.__setstate__ ((None, dict (_writer=writer, _triad=[], _ignored=s._ignored,
+            triads=s.triads)))
+    assert old == s
+
+def test_ngramstats ():
+    """ Chunking does not matter, results can be combined and pickled """
+    text = 'السلامُ عليكم، لا إله إلا الله\n\tx 123 ﻻ؟ '
+    a = NgramStats (3)
+    a.consume ([text])
+    assert sum (a.grams.values ()) == len (text)
+    assert a.words[('السلامُ', ' ')] == 1
+    # words at the end are not counted
+    a.consume (['abc', ' عليكم'])
+
+    b = NgramStats (3)
+    b.consume ([text[:5], '', text[5:6], text[6:]])
+    b.consume (['ab', 'c عل', 'يكم'])
+    assert a == b
+    assert a.words[('عليكم', '،')] == 1
+
+    c = pickle.loads (pickle.dumps (a))
+    assert c == a
+    c.update (b)
+    assert c.words[('عليكم', '،')] == 2
+    with pytest.raises (ValueError):
+        c.update (NgramStats (4))
+
+@pytest.mark.parametrize("layout", ['ar-lulua', 'ar-linux'])
+def test_ngramstats_project (layout):
+    """ Projection matches writing the text, given enough context """
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts[layout].specialize (keyboard)
+    # runs of unknown characters longer than the context would hide the
+    # previous combination
+    texts = ['السلام عليكم، لا إله إلا الله\n\tx 1 ؟ ', 'ﻻ', '', 'كتاب هذا قال']
+
+    # the longest runs must fit into the context
+    ngrams = NgramStats (8)
+    short = NgramStats (4)
+    expect = dict ((cls.name, cls (None)) for cls in (SimpleStats, WordStats))
+    expect['triads'] = TriadStats (Writer (layout))
+    expect['runlen'] = RunlenStats (Writer (layout))
+    for text in texts:
+        ngrams.consume ([text])
+        short.consume ([text])
+        w = Writer (layout)
+        fused = FusedStats (w)
+        fused.consume (w.type (StringIO (text)))
+        for s in fused.stats ():
+            expect[s.name].update (s)
+            # not merged by .update ()
+            if s.name == 'runlen':
+                updateDictOp (expect[s.name].fingerRunlenDist, s.fingerRunlenDist, operator.add)
+
+    result = ngrams.project (layout)
+    for k, v in expect.items ():
+        assert result[k] == v
+    assert result['runlen'].fingerRunlenDist == expect['runlen'].fingerRunlenDist
+
+    # too little context is an error, unless approximate results are fine
+    with pytest.raises (InexactProjection) as e:
+        short.project (layout)
+    assert 'runlen' in e.value.hidden
+    # but run lengths are never guessed
+    result = short.project (layout, exact=False)
+    assert set (result.keys ()) == set (expect.keys ()) - {'runlen'}
+
+    with pytest.raises (ValueError):
+        NgramStats (2, lookahead=0).project (defaultLayouts['ar-linux'].specialize (keyboard))
+
+@pytest.mark.parametrize("order", [NgramStats ().order, 6, 8])
+@pytest.mark.parametrize("layout", ['ar-lulua', 'ar-linux'])
+def test_ngramstats_project_error (layout, order):
+    """ Triads differ from writing the text at most by the windows reported """
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts[layout].specialize (keyboard)
+    rand = Random (0)
+    words = ['السلام', 'عليكم', 'لا', 'ﻻ', 'في', 'من', 'إلى', 'كتاب', 'مدرسة',
+            '،', '؟', '123', '\n', 'x']
+    text = ' '.join (rand.choices (words, k=2000))
+
+    w = Writer (layout)
+    fused = FusedStats (w)
+    fused.consume (w.type (StringIO (text)))
+    expect = dict ((s.name, s) for s in fused.stats ())['triads'].triads
+
+    ngrams = NgramStats (order)
+    ngrams.consume ([text])
+    try:
+        ngrams.project (layout)
+        hidden = dict ()
+    except InexactProjection as e:
+        hidden = e.hidden
+    result = ngrams.project (layout, exact=False)['triads'].triads
+    error = sum (abs (expect.get (k, 0) - result.get (k, 0)) for k in expect.keys () | result.keys ())
+    # every hidden window may count a wrong triad instead of the right one
+    assert error <= 2*hidden.get ('triads', 0)
+
+def runAnalyze (args, stdin):
+    return subprocess.run ([sys.executable, '-c', 'import sys; from lulua.stats import main; sys.exit (main ())'] + args,
+            stdin=stdin, stdout=subprocess.PIPE, check=True).stdout
+
+def test_project_inexact (tmp_path):
+    """ project refuses inexact results unless asked for """
+    ngrams = NgramStats (2)
+    ngrams.consume (['السلام عليكم ورحمة الله وبركاته\n'])
+    path = tmp_path / 'ngrams.pickle'
+    with open (path, 'wb') as fd:
+        pickle.dump (ngrams, fd)
+
+    with open (path, 'rb') as fd:
+        with pytest.raises (subprocess.CalledProcessError):
+            runAnalyze (['-l', 'ar-lulua', 'project'], fd)
+    with open (path, 'rb') as fd:
+        result = pickle.loads (runAnalyze (['-l', 'ar-lulua', 'project', '--approximate'], fd))
+    assert 'runlen' not in result
+    with open (path, 'rb') as fd:
+        with pytest.raises (subprocess.CalledProcessError):
+            runAnalyze (['-l', 'ar-lulua', 'project', '--approximate', '-f', 'columnar'], fd)
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_batch (tmp_path, jobs):
+    """ batch must produce the same output as individual subcommands """
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts['ar-lulua'].specialize (keyboard)
+    w = Writer (layout)
+    stats = dict ((cls.name, cls (w)) for cls in allStats)
+    for match, event in w.type (StringIO ('السلام عليكم ورحمة الله وبركاته\n')):
+        for s in stats.values ():
+            s.process (event)
+    statsPath = tmp_path / 'stats.pickle'
+    with open (statsPath, 'wb') as fd:
+        pickle.dump (stats, fd)
+    metaPath = tmp_path / 'meta.yaml'
+    metaPath.write_text ('name: test\n')
+
+    commands = [('keyheatmap', 'ar-lulua', []), ('layoutstats', 'ar-linux', []),
+            ('latinime', 'ar-lulua', []), ('corpusstats', 'ar-lulua', [str (metaPath)]),
+            # binary output
+            ('triadeffortdata', 'ar-lulua', [])]
+    args = ['batch', '-j', str (jobs), '--metadata', str (metaPath)]
+    for command, l, extra in commands:
+        args += ['-o', command, l, str (tmp_path / command)]
+    with open (statsPath, 'rb') as fd:
+        assert runAnalyze (args, fd) == b''
+
+    for command, l, extra in commands:
+        with open (statsPath, 'rb') as fd:
+            expect = runAnalyze (['-l', l, command] + extra, fd)
+        result = (tmp_path / command).read_bytes ()
+        if command == 'latinime':
+            # contains a timestamp
+            expect = expect.split (b'\n', 2)[2]
+            result = result.split (b'\n', 2)[2]
+        assert result == expect
@@ -0,0 +1,178 @@
+# Copyright (c) 2019 lulua contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import pickle
+from io import StringIO, BytesIO, BufferedReader, RawIOBase
+
+import pytest
+
+from .keyboard import defaultKeyboards
+from .layout import defaultLayouts
+from .writer import Writer
+from .stats import allStats, makeCombined, loadStats, LazyStats
+from .statsfile import dump, merge, openContainers, sniff, _mergeSorted
+
+keyboard = defaultKeyboards['ibmpc105']
+
+def makeStats (layout, text):
+    layout = defaultLayouts[layout].specialize (keyboard)
+    w = Writer (layout)
+    stats = [cls(w) for cls in allStats]
+    for match, event in w.type (StringIO (text)):
+        for s in stats:
+            s.process (event)
+    combined = makeCombined (keyboard)
+    for s in stats:
+        combined[s.name].update (s)
+        # not merged by .update ()
+        if s.name == 'runlen':
+            combined[s.name].fingerRunlenDist = s.fingerRunlenDist
+    return combined
+
+def load (buf):
+    combined = makeCombined (keyboard)
+    for f in openContainers (buf):
+        f.toStats (combined, keyboard)
+    return combined
+
+texts = [
+        ('ar-lulua', 'السلام عليكم ورحمة الله وبركاته، كيف حالك؟ 123\n'),
+        ('ar-linux', 'لا إله إلا الله. ﷺ ¤ abc'),
+        ('ar-lulua', ''),
+        ]
+
+@pytest.mark.parametrize("layout,text", texts)
+def test_roundtrip (layout, text):
+    stats = makeStats (layout, text)
+    fd = BytesIO ()
+    dump (stats, fd)
+    assert sniff (BufferedReader (BytesIO (fd.getvalue ())))[0]
+
+    result = load (fd.getbuffer ())
+    for s in allStats:
+        assert result[s.name] == stats[s.name]
+    assert result['runlen'].fingerRunlenDist == stats['runlen'].fingerRunlenDist
+
+def test_merge ():
+    parts = [makeStats (layout, text) for layout, text in texts]
+    expected = makeCombined (keyboard)
+    fd = BytesIO ()
+    for p in parts:
+        dump (p, fd)
+        for s in allStats:
+            expected[s.name].update (p[s.name])
+
+    # concatenated containers
+    files = openContainers (fd.getbuffer ())
+    assert len (files) == len (parts)
+    assert load (fd.getbuffer ()) == expected
+
+    merged = BytesIO ()
+    merge (files, merged)
+    assert len (openContainers (merged.getbuffer ())) == 1
+    assert load (merged.getbuffer ()) == expected
+
+def test_mergeSorted ():
+    np = pytest.importorskip ('numpy')
+    rng = np.random.default_rng (1)
+    sources = []
+    expected = dict ()
+    for n in (0, 1, 50, 200, 1000):
+        keys = np.unique (rng.integers (0, 500, n)).astype (np.uint32)
+        counts = rng.integers (1, 10, len (keys)).astype (np.uint64)
+        sources.append ((keys, counts, None))
+        for k, v in zip (keys.tolist (), counts.tolist ()):
+            expected[k*2] = expected.get (k*2, 0) + v
+    sources = [(k, c, lambda k: k*2) for k, c, remap in sources]
+
+    chunks = list (_mergeSorted (sources, '<u4', chunk=7))
+    assert len (chunks) > 1
+    keys = np.concatenate ([k for k, c in chunks])
+    counts = np.concatenate ([c for k, c in chunks])
+    assert keys.dtype == np.uint32
+    assert keys.tolist () == sorted (expected.keys ())
+    assert dict (zip (keys.tolist (), counts.tolist ())) == expected
+
+class TrickleReader (RawIOBase):
+    """ Pipe-like reader, returning at most one byte per read """
+
+    def __init__ (self, data):
+        self.data = data
+
+    def readable (self):
+        return True
+
+    def readinto (self, b):
+        n = min (1, len (self.data), len (b))
+        b[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+def test_sniff ():
+    fd = BytesIO ()
+    dump (makeStats (*texts[0]), fd)
+    data = fd.getvalue ()
+
+    columnar, reader = sniff (BufferedReader (TrickleReader (data)))
+    assert columnar
+    assert reader.read () == data
+
+    data = pickle.dumps (1)
+    columnar, reader = sniff (BufferedReader (TrickleReader (data)))
+    assert not columnar
+    assert pickle.load (reader) == 1
+
+    columnar, reader = sniff (BufferedReader (TrickleReader (b'')))
+    assert not columnar
+
+def test_invalid ():
+    fd = BytesIO ()
+    dump (makeStats (*texts[0]), fd)
+    with pytest.raises (ValueError):
+        openContainers (fd.getvalue ()[1:])
+    with pytest.raises (ValueError):
+        openContainers (fd.getvalue ()[:-1])
+    assert not sniff (BufferedReader (BytesIO (b'\x80\x05')))[0]
+
+@pytest.mark.parametrize("format", ['columnar', 'pickle'])
+def test_loadStats (tmp_path, format):
+    stats = makeStats (*texts[0])
+    # lone surrogates from broken input must survive as well
+    stats['words'].words['\udcffس'] += 2
+    stats['simple'].unknown['€\ud800'] += 1
+    path = tmp_path / 'stats'
+    with open (path, 'wb') as fd:
+        if format == 'columnar':
+            dump (stats, fd)
+        else:
+            pickle.dump (stats, fd)
+
+    with open (path, 'rb') as fd:
+        result = loadStats (fd, keyboard)
+    if format == 'columnar':
+        assert isinstance (result, LazyStats)
+        # nothing is loaded until requested
+        assert len (result) == 0
+        assert result['words'] == stats['words']
+        assert list (result.keys ()) == ['words']
+        with pytest.raises (KeyError):
+            result['nonexistent']
+    for s in allStats:
+        assert result[s.name] == stats[s.name]
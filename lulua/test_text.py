@@ -18,11 +18,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import brotli
+import brotli, tarfile, gzip, lzma, bz2, sys, json, html, os, pickle, random
+from functools import partial
+import pytest
 from io import BytesIO, StringIO
 import html5lib
 
-from .text import charMap, mapChars, BrotliFile, HTMLSerializer, apply, iterchar
+from .text import charMap, mapChars, BrotliFile, HTMLSerializer, apply, iterchar, \
+        readRange, shardFiles, batchLines, filterAvail, htmlTokens, Select, f, \
+        PandocConverter, filterMediawikiMarkdown, streamOffsets, extractRange, \
+        iterRange, extractMediawiki, \
+        StatsCache, CharNormalizer, normalize, writeWorker, Writer, FusedStats, \
+        spaceCharacters, htmlNamespace, InvalidDocument
 
 def test_map_chars_mapped ():
     """ Make sure all chars in the map are mapped correctly """
@@ -50,6 +57,22 @@ def test_map_chars_not_mapped ():
     outText = mapChars (inText, charMap)
     assert outText == expectText
 
+@pytest.mark.parametrize("m", [charMap, {'a': 'bc', 'b': 'x', 'ﻻ': 'لا'}])
+def test_char_normalizer (m):
+    """ Normalizer is equivalent to mapChars, no matter how it works internally """
+    n = CharNormalizer (m)
+    assert (n.pairs is None) == (m is not charMap)
+    for text in ('', 'abc\r\n\r\rﻻ 123?\n', ''.join (charMap.keys ()) + '\r\n'):
+        assert n (text) == mapChars (text, m).replace ('\r\n', '\n')
+
+def test_char_normalizer_chained ():
+    """ Chained replacements use the translation table, which maps only once """
+    n = CharNormalizer ({'a': 'b', 'b': 'c', 'x': '\n'})
+    assert n.pairs is None
+    assert n ('ab\r\n\rx\r') == 'bc\n\n\r'
+    # tables are built once per map
+    assert CharNormalizer ().table is normalize.table
+
 def test_brotlifile ():
     compressed = brotli.compress (b'hello world')
     for chunk in (1, 2, 3, 1024, None):
@@ -85,3 +108,407 @@ def test_iterchar ():
     with StringIO (s) as fd:
         assert ''.join (iterchar (fd)) == s
 
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 100])
+def test_shard_files (tmp_path, size):
+    """ Every line must be read exactly once, regardless of shard size """
+    lines = ['a\n', '\n', 'bcd\n', 'السلام\n', 'e']
+    path = tmp_path / 'lines'
+    path.write_text (''.join (lines), encoding='utf-8')
+
+    shards = list (shardFiles ([str (path)], size))
+    assert shards[0][1] == 0
+    assert all (a[2] == b[1] for a, b in zip (shards, shards[1:]))
+    assert shards[-1][2] == path.stat ().st_size
+
+    result = []
+    for shard in shards:
+        result.extend (readRange (*shard))
+    assert result == lines
+
+def test_batch_lines ():
+    lines = ['a\n', 'bc\n', 'def\n', 'g\n']
+    assert list (batchLines (lines, 1, 100)) == [[x] for x in lines]
+    assert list (batchLines (lines, 3, 100)) == [lines[:3], lines[3:]]
+    assert list (batchLines (lines, 100, 5)) == [lines[:2], lines[2:]]
+    assert list (batchLines ([], 100, 5)) == []
+
+def makeTar (members):
+    fd = BytesIO ()
+    with tarfile.open (fileobj=fd, mode='w', format=tarfile.GNU_FORMAT) as tar:
+        for name, data in members:
+            info = tarfile.TarInfo (name)
+            info.size = len (data)
+            tar.addfile (info, BytesIO (data))
+    return fd.getvalue ()
+
+compressors = dict (brotli=brotli.compress, gzip=gzip.compress, xz=lzma.compress,
+        bzip2=bz2.compress)
+
+@pytest.mark.parametrize("compression", list (compressors.keys ()))
+def test_filter_tar (compression):
+    members = [('a', b'hello world'), ('empty', b''), ('b', 'السلام'.encode ('utf-8')*300),
+            ('c', b'x'*512), ('d', b'y'*1025)]
+    data = compressors[compression] (makeTar (members))
+
+    funcs = [filterAvail[compression], filterAvail['tar'], filterAvail['text']]
+    result = list (apply (funcs, [BytesIO (data)]))
+    assert result == [d.decode ('utf-8') for name, d in members if d]
+
+    # members become invalid when the next one is read
+    funcs = [filterAvail[compression], filterAvail['tar']]
+    it = apply (funcs, [BytesIO (data)])
+    first = next (it)
+    assert first.read (5) == b'hello'
+    second = next (it)
+    with pytest.raises (ValueError):
+        first.read ()
+    assert second.read () == members[2][1]
+
+class TrickleBytesIO (BytesIO):
+    """ Returns at most three bytes per read, like a slow pipe """
+    def read (self, n=-1):
+        return super ().read (3 if n is None or n < 0 else min (n, 3))
+
+@pytest.mark.parametrize("compression", ['gzip', 'xz', 'bzip2'])
+@pytest.mark.parametrize("fdClass", [BytesIO, TrickleBytesIO])
+def test_filter_multistream (compression, fdClass):
+    """ Concatenated streams (cat a.gz b.gz, pbzip2) are read entirely """
+    parts = [b'first member\n', b'', 'السلام'.encode ('utf-8')*300]
+    data = b''.join (map (compressors[compression], parts))
+    result = list (apply ([filterAvail[compression], filterAvail['text']], [fdClass (data)]))
+    assert result == [b''.join (parts).decode ('utf-8')]
+
+htmlDocs = [
+    '<html><head><title>x</title><script>var a="<div id=\'DynamicContentContainer\'>";</script></head>'
+        '<body><div id="DynamicContentContainer"><p>مرحبا &amp; <b>عالم</b></p>\n<p>سطر  ثاني<br>ثالث</p>'
+        '<div>  داخل  </div>\n\n</div><p>خارج</p></body></html>',
+    '<div id="DynamicContentContainer"><p>بدون اغلاق<p>ثاني<div>ثالث</div>نص</div> بعد',
+    '<div id="DynamicContentContainer"><ul><li>واحد<li>اثنين</ul><style>p{}</style>\r\n'
+        '<!-- c -->نص<!--x-->  اخر</span></p></div>',
+    '<div id="DynamicContentContainer"><pre>\nabc\n</pre><h1>a<h2>b</h2><img src=x/><div/>x</div>y</div>',
+    '<meta charset="utf-8"><div property="articleBody"><p>نص</p><div property="articleBody">nested</div>after</div>tail',
+    '<meta charset="utf-8"><div id="DynamicContentContainer">&notanentity; &lt;x&gt; &#1575; &nbsp; ok</div>',
+    ]
+
+@pytest.mark.parametrize("doc", htmlDocs)
+@pytest.mark.parametrize("name", ['aljazeera', 'bbcarabic'])
+def test_filter_html_stream (doc, name):
+    """ The streaming HTML filter must produce the same output as html5lib """
+    doc = doc.encode ('utf-8')
+    expect = list (filterAvail[name] (BytesIO (doc)))
+    assert list (filterAvail[f'{name}-stream'] (BytesIO (doc))) == expect
+    # chunk boundaries are irrelevant
+    s = HTMLSerializer ()
+    assert [''.join (s.serialize (Select (htmlTokens (BytesIO (doc), 3), f[name])))] == expect
+
+def test_html_constants ():
+    """ Copies of html5lib’s constants, which is imported lazily """
+    assert set (spaceCharacters) == html5lib.constants.spaceCharacters
+    assert htmlNamespace == html5lib.constants.namespaces['html']
+
+xmlDocs = [
+    ('tei2', '<TEI.2><teiHeader><s>head</s></teiHeader><text><body>'
+        '<p id="1"><s>واحد</s><s>اثنين <b>x</b> بعد</s></p>\n'
+        '<p><s>  ثلاثة\n</s></p><p></p></body></text></TEI.2>'),
+    ('tei2', '<TEI.2><text><front><p><s>no</s></p></front></text></TEI.2>'),
+    ('opensubtitles', '<?xml version="1.0" encoding="utf-8"?>\n<document>\n'
+        '<s id="1">\n<time id="T1S" value="00:00:01"/>\n  مرحبا\n'
+        '<time id="T1E" value="00:00:02"/>\n</s>\n<s id="2">اهلا &amp; سهلا</s>\n'
+        '<s id="3"/></document>'),
+    ('opensubtitles', '<document></document>'),
+    # truncated documents are discarded, even if some elements are complete
+    ('tei2', '<TEI.2><text><body><p><s>واحد</s></p><p><s>اثنين'),
+    ('opensubtitles', '<document><s id="1">مرحبا</s>\n<s id="2">اهلا'),
+    ]
+
+@pytest.mark.parametrize("name,doc", xmlDocs)
+def test_filter_xml_stream (name, doc):
+    """ Streaming XML filters must produce the same text as the DOM-based ones """
+    doc = doc.encode ('utf-8')
+    expect = list (apply ([filterAvail['xml'], filterAvail[name]], [BytesIO (doc)]))
+    result = []
+    for chunks in filterAvail[name] (BytesIO (doc)):
+        consumed = []
+        try:
+            for chunk in chunks:
+                consumed.append (chunk)
+        except InvalidDocument:
+            # consumers discard what they got so far
+            continue
+        result.append (''.join (consumed))
+    assert result == expect
+
+# stand-in for data/pandoc-convert.lua
+converterScript = '''
+import sys, os
+while True:
+    header = sys.stdin.buffer.readline ()
+    if not header:
+        break
+    text = sys.stdin.buffer.read (int (header)).decode ('utf-8')
+    if 'crash' in text:
+        sys.exit (1)
+    status, reply = ('error', 'rejected') if 'fail' in text else ('ok', f'{os.getpid ()} {text.upper ()}')
+    reply = reply.encode ('utf-8')
+    sys.stdout.buffer.write (b'%s %d\\n%s' % (status.encode (), len (reply), reply))
+    sys.stdout.buffer.flush ()
+'''
+
+def test_pandoc_converter ():
+    """ Converter process is reused, failures are isolated per document """
+    c = PandocConverter ([sys.executable, '-c', converterScript])
+    docs = ['abc', 'fail', 'ناص\nx', '', 'crash', 'def']
+    result = list (apply ([partial (filterMediawikiMarkdown, converter=c)], docs))
+    pids = [r.split (' ', 1)[0] for r in result]
+    assert [r.split (' ', 1)[1] for r in result] == ['ABC', 'ناص\nX', '', 'DEF']
+    # restarted after crashing
+    assert pids[0] == pids[1] == pids[2] != pids[3]
+    c.close ()
+    assert c.proc is None
+
+def makeMultistream (tmp_path, pages, perStream):
+    """ Create multistream mediawiki dump and its index, like Wikimedia’s """
+    streams = ['<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xml:lang="ar">\n'
+            '  <siteinfo><sitename>ويكيبيديا</sitename></siteinfo>\n'.encode ('utf-8')]
+    index = []
+    offset = len (bz2.compress (streams[0]))
+    for i in range (0, len (pages), perStream):
+        s = b''
+        for j, text in enumerate (pages[i:i+perStream], i):
+            index.append (f'{offset}:{j}:title {j}\n')
+            s += (f'  <page><title>title {j}</title><ns>0</ns><revision>'
+                    f'<text bytes="1" xml:space="preserve">{text}</text></revision></page>\n').encode ('utf-8')
+        streams.append (s)
+        offset += len (bz2.compress (s))
+    streams.append (b'</mediawiki>\n')
+
+    dump = tmp_path / 'dump.xml.bz2'
+    dump.write_bytes (b''.join (map (bz2.compress, streams)))
+    indexPath = tmp_path / 'index.txt.bz2'
+    indexPath.write_bytes (bz2.compress (''.join (index).encode ('utf-8')))
+    return dump, indexPath
+
+def test_extract_mediawiki (tmp_path):
+    pages = ['مرحبا &amp; [[رابط]]', '', "'''bold'''\n\n== h ==\n", 'x'*100000] + [f'{i}' for i in range (20)]
+    dump, index = makeMultistream (tmp_path, pages, 3)
+
+    offsets = streamOffsets (dump)
+    # the index does not cover the closing stream
+    assert offsets[:-1] == streamOffsets (dump, index)
+    assert len (offsets) == 1+8+1
+
+    ends = offsets[1:] + [dump.stat ().st_size]
+    expect = [json.dumps (html.unescape (p), ensure_ascii=False) + '\n' for p in pages]
+    assert ''.join (extractRange (dump, s, e) for s, e in zip (offsets, ends)) == ''.join (expect)
+    # ranges spanning multiple streams and tiny reads work too
+    assert extractRange (dump, 0, ends[-1], 7) == ''.join (expect)
+
+def test_extract_mediawiki_single_stream (tmp_path, monkeypatch, capsys):
+    """ Text of a single-stream dump is written as soon as it is parsed """
+    from . import text
+
+    # bzip2 emits whole blocks only, so the dump must span several
+    rand = random.Random (0)
+    pages = [''.join (rand.choices ('ابتثجحخدذرزسشصضطظعغفقكلمنهوي ', k=2000)) for i in range (100)]
+    dump = tmp_path / 'dump.xml.bz2'
+    dump.write_bytes (bz2.compress (('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">\n'
+            + ''.join (f'<page><title>{i}</title><revision><text>{p}</text></revision></page>\n'
+                    for i, p in enumerate (pages))
+            + '</mediawiki>\n').encode ('utf-8'), 1))
+    size = dump.stat ().st_size
+    expect = [json.dumps (p, ensure_ascii=False) + '\n' for p in pages]
+
+    assert streamOffsets (dump) == [0]
+    opened = []
+    def trackingOpen (*args, **kwargs):
+        fd = open (*args, **kwargs)
+        opened.append (fd)
+        return fd
+    monkeypatch.setattr (text, 'open', trackingOpen, raising=False)
+    lines = iterRange (dump, 0, size, 4096)
+    assert next (lines) == expect[0]
+    assert opened[0].tell () < size
+    assert [expect[0]] + list (lines) == expect
+
+    monkeypatch.setattr (sys, 'argv', ['lulua-extract-mediawiki', '-j', '2', str (dump)])
+    extractMediawiki ()
+    assert capsys.readouterr ().out == ''.join (expect)
+
+def test_stats_cache (tmp_path):
+    from .keyboard import defaultKeyboards
+    from .layout import defaultLayouts
+    from .stats import makeCombined
+
+    keyboard = defaultKeyboards['ibmpc105']
+    a = tmp_path / 'a.txt'
+    a.write_text ('نص')
+    b = tmp_path / 'b.txt'
+    b.write_text ('نص')
+
+    cache = StatsCache (str (tmp_path / 'cache'), defaultLayouts['ar-lulua'], keyboard, ['file', 'text'])
+    key = cache.key (f'{a}\n')
+    # content, not file name matters
+    assert key == cache.key (str (b))
+    # but everything else does
+    assert key != StatsCache (cache.path, defaultLayouts['ar-linux'], keyboard, ['file', 'text']).key (str (a))
+    assert key != StatsCache (cache.path, defaultLayouts['ar-lulua'], keyboard, ['file', 'lines']).key (str (a))
+    a.write_text ('نص اخر')
+    assert key != cache.key (str (a))
+    # other filters hash the item itself
+    lines = StatsCache (cache.path, defaultLayouts['ar-lulua'], keyboard, ['json'])
+    assert lines.key ('"a"\n') != lines.key ('"b"\n')
+
+    combined = makeCombined (keyboard)
+    assert not cache.load (key, combined)
+    stored = makeCombined (keyboard)
+    stored['simple'].unknown['x'] += 3
+    cache.store (key, stored)
+    assert cache.load (key, combined)
+    assert combined == stored
+
+    # the keyboard’s contents matter too
+    other = pickle.loads (pickle.dumps (keyboard))
+    other.digest = 'other'
+    assert key != StatsCache (cache.path, defaultLayouts['ar-lulua'], other, ['file', 'text']).key (str (a))
+
+    # corrupt entries are a miss and removed
+    path = cache._path (key)
+    with open (path, 'r+b') as fd:
+        fd.truncate (10)
+    combined = makeCombined (keyboard)
+    assert not cache.load (key, combined)
+    assert combined == makeCombined (keyboard)
+    assert not os.path.exists (path)
+
+    # failed stores leave no temporary files behind
+    with pytest.raises (KeyError):
+        cache.store (key, dict ())
+    assert os.listdir (os.path.dirname (path)) == []
+
+def _footerOnly (footer):
+    from .statsfile import MAGIC, _trailer
+    footer = json.dumps (footer).encode ('utf-8')
+    return MAGIC + footer + _trailer.pack (len (MAGIC), len (footer), MAGIC)
+
+@pytest.mark.parametrize("corrupt", [
+        lambda data: b'',
+        lambda data: data[:len (data)//2],
+        lambda data: data[len (data)//2:],
+        lambda data: data[:-1],
+        lambda data: _footerOnly ({}),
+        lambda data: _footerOnly ({'version': 1}),
+        ], ids=['empty', 'head', 'tail', 'trailer', 'noversion', 'nocolumns'])
+def test_stats_cache_corrupt (tmp_path, corrupt, caplog):
+    """ Damaged entries are a miss and removed """
+    from .keyboard import defaultKeyboards
+    from .layout import defaultLayouts
+    from .stats import makeCombined
+
+    keyboard = defaultKeyboards['ibmpc105']
+    cache = StatsCache (str (tmp_path), defaultLayouts['ar-lulua'], keyboard, ['json'])
+    key = cache.key ('"نص"\n')
+    stored = makeCombined (keyboard)
+    stored['simple'].unknown['x'] += 3
+    cache.store (key, stored)
+    path = cache._path (key)
+    with open (path, 'rb') as fd:
+        data = fd.read ()
+    with open (path, 'wb') as fd:
+        fd.write (corrupt (data))
+
+    combined = makeCombined (keyboard)
+    assert not cache.load (key, combined)
+    assert combined == makeCombined (keyboard)
+    assert not os.path.exists (path)
+    assert 'removing corrupt cache entry' in caplog.text
+
+@pytest.mark.parametrize("flush", [dict (), dict (flushItems=2), dict (flushMemory=1024**3)])
+def test_write_worker_flush (tmp_path, flush):
+    """ Partial flushes do not change the results """
+    import queue
+    from .keyboard import defaultKeyboards
+    from .layout import defaultLayouts
+    from .stats import makeCombined
+    from . import statsfile
+
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts['ar-lulua'].specialize (keyboard)
+    texts = ['"السلام عليكم"\n', '"لا إله إلا الله"\n', '"كتاب"\n', '"هذا قال"\n', '"x"\n']
+
+    inq = queue.Queue ()
+    for i in range (0, len (texts), 2):
+        inq.put (texts[i:i+2])
+    inq.put (None)
+    outq = queue.Queue ()
+    handoff = tmp_path / 'handoff'
+    spool = tmp_path / 'spool'
+    handoff.mkdir ()
+    spool.mkdir ()
+    writeWorker (layout, [filterAvail['json']], inq, outq, queue.Queue (), False,
+            str (handoff), spooldir=str (spool), **flush)
+    shards = outq.get ()
+    assert len (shards) == (3 if 'flushItems' in flush else 1)
+    # only the last shard is handed over in memory
+    assert [os.path.dirname (p) for p in shards] == [str (spool)]*(len (shards)-1) + [str (handoff)]
+
+    result = makeCombined (keyboard)
+    for path in shards:
+        with open (path, 'rb') as fd:
+            for f in statsfile.openContainers (fd.read ()):
+                f.toStats (result, keyboard)
+    expect = makeCombined (keyboard)
+    for t in texts:
+        w = Writer (layout)
+        stats = FusedStats (w)
+        stats.consume (w.type (StringIO (normalize (json.loads (t)))))
+        for s in stats.stats ():
+            expect[s.name].update (s)
+    for k, v in expect.items ():
+        assert result[k] == v, k
+
+@pytest.mark.parametrize("ngram", [None, 3])
+def test_write_worker_invalid_xml (tmp_path, ngram):
+    """ Text typed before a streamed document turns out invalid is discarded """
+    import queue
+    from .keyboard import defaultKeyboards
+    from .layout import defaultLayouts
+    from .stats import makeCombined, NgramStats
+    from . import statsfile
+
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts['ar-lulua'].specialize (keyboard)
+    valid = tmp_path / 'valid.xml'
+    valid.write_text ('<document><s>مرحبا</s><s>اهلا</s></document>')
+    truncated = tmp_path / 'truncated.xml'
+    truncated.write_text ('<document><s>السلام عليكم</s><s>كتاب')
+
+    inq = queue.Queue ()
+    inq.put ([f'{truncated}\n', f'{valid}\n'])
+    inq.put (None)
+    outq = queue.Queue ()
+    writeWorker (layout, [filterAvail['file'], filterAvail['opensubtitles']],
+            inq, outq, queue.Queue (), False, str (tmp_path), ngram=ngram)
+    shards = outq.get ()
+    assert len (shards) == 1
+
+    text = 'مرحبا\nاهلا'
+    if ngram:
+        with open (shards[0], 'rb') as fd:
+            result = pickle.load (fd)
+        expect = NgramStats (ngram)
+        expect.consume ([text])
+        assert result == expect
+    else:
+        result = makeCombined (keyboard)
+        with open (shards[0], 'rb') as fd:
+            for f in statsfile.openContainers (fd.read ()):
+                f.toStats (result, keyboard)
+        expect = makeCombined (keyboard)
+        w = Writer (layout)
+        stats = FusedStats (w)
+        stats.consume (w.type (StringIO (text)))
+        for s in stats.stats ():
+            expect[s.name].update (s)
+        for k, v in expect.items ():
+            assert result[k] == v, k
@@ -18,9 +18,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import sys, subprocess, logging, pickle
+
 import pytest
 
-from .util import displayText, limit, first
+from .util import displayText, limit, first, loadCached, cacheKey, \
+        resourcePath, openResource, lazyFunction, sourceDigest
+from . import util
 
 @pytest.mark.parametrize("s,expected", [
     ('foobar', False),
@@ -49,3 +53,76 @@ def test_first ():
     with pytest.raises (StopIteration):
         first ([])
 
+
+def test_loadCached (tmp_path, monkeypatch, caplog):
+    monkeypatch.setenv ('XDG_CACHE_HOME', str (tmp_path))
+    shared = object ()
+    calls = []
+    def make ():
+        calls.append (1)
+        return [1, shared]
+
+    key = cacheKey ('test', b'data')
+    assert key != cacheKey ('test', b'dat', 'a')
+    for i in range (2):
+        assert loadCached (key, make, shared=dict (s=shared)) == [1, shared]
+    assert len (calls) == 1
+
+    # corrupt entries are replaced
+    for p in (tmp_path / 'lulua').iterdir ():
+        p.write_bytes (b'garbage')
+    with caplog.at_level (logging.WARNING):
+        assert loadCached (key, make, shared=dict (s=shared)) == [1, shared]
+    assert len (calls) == 2
+    assert 'corrupt' in caplog.text
+
+    # so are stale ones, which reference classes that do not exist any more
+    for p in (tmp_path / 'lulua').iterdir ():
+        p.write_bytes (pickle.dumps (StaleEntry ()))
+    monkeypatch.delattr (sys.modules[__name__], 'StaleEntry')
+    caplog.clear ()
+    with caplog.at_level (logging.WARNING):
+        assert loadCached (key, make, shared=dict (s=shared)) == [1, shared]
+    assert len (calls) == 3
+    assert 'AttributeError' in caplog.text
+
+    # changes to the pickled classes’ source invalidate keys
+    monkeypatch.setattr (util, '_sourceDigest', b'changed')
+    assert cacheKey ('test', b'data') != key
+
+def test_sourceDigest (monkeypatch):
+    """ Versions of third-party modules with pickled classes matter """
+    import pygtrie
+    digest = sourceDigest ()
+    monkeypatch.setattr (util, '_sourceDigest', None)
+    assert sourceDigest () == digest
+    monkeypatch.setattr (util, '_sourceDigest', None)
+    monkeypatch.setattr (pygtrie, '__version__', '0.0', raising=False)
+    assert sourceDigest () != digest
+
+class StaleEntry:
+    pass
+
+def test_resources ():
+    with openResource ('data/render-svg.css') as fd:
+        assert fd.read ()
+    assert resourcePath ('data/keyboards').endswith ('keyboards')
+
+def test_lazyFunction ():
+    f = lazyFunction ('.util', 'limit')
+    assert f.__name__ == 'limit'
+    assert list (f (range (3), 2)) == [0, 1]
+
+@pytest.mark.parametrize("module,heavy", [
+    ('lulua.stats', ['bokeh', 'lulua.plot', 'html5lib', 'ebooklib', 'tqdm', 'pkg_resources']),
+    ('lulua.text', ['html5lib', 'ebooklib', 'brotli', 'tqdm', 'pkg_resources']),
+    ('lulua.render', ['svgwrite', 'pkg_resources']),
+    ('lulua.report', ['bokeh', 'jinja2', 'pkg_resources']),
+    ])
+def test_lazy_imports (module, heavy):
+    """ Console scripts must not pay for dependencies they may not use """
+    code = f'import sys, {module}; print (" ".join (sys.modules))'
+    modules = subprocess.run ([sys.executable, '-c', code], check=True,
+            capture_output=True, text=True).stdout.split ()
+    for m in heavy:
+        assert m not in modules
@@ -22,7 +22,7 @@ from io import StringIO
 
 import pytest
 
-from .writer import Writer, SkipEvent
+from .writer import Writer, SkipEvent, defaultFingermap
 from .layout import *
 from .keyboard import defaultKeyboards
 
@@ -123,3 +123,67 @@ def test_writer_chooseComb (combs, expect, prev):
 
     if len (result) == 2:
         assert w.getHandFinger (first (result.modifier))[0] != w.getHandFinger (first (result.buttons))[0]
+
+@pytest.mark.parametrize("chunkSize", [1, 2, 3, 1024])
+def test_writer_type_chunks (chunkSize, monkeypatch):
+    """ Multi-character matches must not depend on chunk boundaries """
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts['ar-linux'].specialize (keyboard)
+    assert layout.bufferLen > 1
+    text = 'لا إله إلا الله، لألأ x لآ' * 3
+
+    expect = list (Writer (layout).type (StringIO (text)))
+    monkeypatch.setattr (Writer, 'chunkSize', chunkSize)
+    table = Writer (layout).table
+    for i in range (2):
+        # table and memoized choices can be shared between writers
+        w = Writer (layout, table)
+        assert list (w.type (StringIO (text))) == expect
+    assert any (m and len (m) > 1 for m, c in expect)
+
+def test_writer_type_null ():
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts['null'].specialize (keyboard)
+    assert list (Writer (layout).type (StringIO ('abc'))) == []
+
+@pytest.mark.parametrize("layout", ['ar-linux', 'ar-lulua', 'ar-phonetic', 'ar-asmo663'])
+def test_writer_decision_table (layout):
+    """ Precomputed decisions must match .chooseCombination () """
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts[layout].specialize (keyboard)
+    w = Writer (layout)
+    table = w.table
+
+    prevs = set ([None])
+    for combinations in table.sets:
+        prevs.update (combinations)
+    for prev in prevs:
+        w.lastCombination = prev
+        row = table.row (w._prevScore (prev))
+        for combinations, (comb, nextRow) in zip (table.sets, row):
+            assert comb == w.chooseCombination (combinations)
+            assert nextRow is table.row (w._prevScore (comb))
+
+def test_writer_type_unmapped (monkeypatch):
+    """ Combinations with buttons lacking a finger are skipped """
+    keyboard = defaultKeyboards['ibmpc105']
+    layout = defaultLayouts['ar-linux'].specialize (keyboard)
+    monkeypatch.delitem (defaultFingermap, 'El_shift')
+    text = ''.join (k for k, v in layout if len (k) == 1) * 2
+
+    w = Writer (layout)
+    expect = []
+    buf = text
+    while buf:
+        try:
+            match, combinations = layout (buf)
+            comb = w.chooseCombination (combinations)
+            expect.append ((match, comb))
+            w.press (comb)
+            buf = buf[len (match):]
+        except KeyError:
+            expect.append ((None, SkipEvent (buf[0])))
+            buf = buf[1:]
+    assert any (isinstance (c, SkipEvent) for m, c in expect)
+
+    assert list (Writer (layout).type (StringIO (text))) == expect
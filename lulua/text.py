@@ -22,23 +22,28 @@
 Text/corpus handling tools
 """
 
-import sys, argparse, pickle, json, logging, xml.dom.minidom, queue
-from io import StringIO, BytesIO
+import sys, os, argparse, pickle, json, logging, xml.dom.minidom, queue, tempfile
+import zlib, lzma, bz2, codecs, re, mmap, hashlib, contextlib, struct
+from io import StringIO, BytesIO, RawIOBase
 from functools import partial
 from itertools import chain
-from multiprocessing import Process, Queue, cpu_count, current_process
+from multiprocessing import Process, Queue, Pool, cpu_count, current_process
 from subprocess import Popen, PIPE
+from xml.etree.ElementTree import iterparse, ParseError, XMLPullParser
 
-from tqdm import tqdm
-import ebooklib
-from ebooklib import epub
-import html5lib
-from html5lib.filters.base import Filter
-import brotli
+from html.parser import HTMLParser
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
 
 from .keyboard import defaultKeyboards
 from .layout import defaultLayouts
 from .writer import Writer
+from .util import resourcePath
 
 def iterchar (fd):
     batchsize = 1*1024*1024
@@ -48,15 +53,17 @@ def iterchar (fd):
             break
         yield from c
 
-class Select (Filter):
+class Select:
+    """ html5lib token filter, selecting elements matching f """
+
     def __init__ (self, source, f):
-        Filter.__init__ (self, source)
+        self.source = source
         self.inside = None
         self.f = f
 
     def __iter__(self):
         isScript = None
-        for token in Filter.__iter__(self):
+        for token in self.source:
             ttype = token['type']
             if ttype == 'StartTag':
                 tname = token['name']
@@ -103,85 +110,390 @@ class HTMLSerializer(object):
             elif type == "Entity":
                 name = token["name"]
                 key = name + ";"
+                import html5lib
                 if key not in html5lib.constants.entities:
                     self.serializeError("Entity %s not recognized" % name)
                 yield html5lib.constants.entities[key]
             else:
                 assert False
 
-class BrotliFile:
-    __slots__ = ('decompressor', 'readchunk', 'fd', 'buf')
+class DecompressorFile (RawIOBase):
+    """
+    Read-only file for a streaming decompressor.
 
-    def __init__ (self, fd, readchunk=100*1024):
+    decompress is called with chunks of compressed data and returns
+    decompressed data, isFinished returns True after the end of the stream.
+    Decompressed data is kept in a bytearray, which is consumed from the
+    front.
+    """
+
+    def __init__ (self, fd, decompress, isFinished, readchunk=1024*1024):
         self.fd = fd
         self.readchunk = readchunk
-        self.decompressor = brotli.Decompressor ()
-        self.buf = b''
-
-    def __enter__ (self):
-        return self
+        self.decompress = decompress
+        self.isFinished = isFinished
+        self.buf = bytearray ()
+
+    def _fill (self, num):
+        """ Decompress until at least num bytes are available """
+        buf = self.buf
+        while (num is None or len (buf) < num) and not self.isFinished ():
+            data = self.fd.read (self.readchunk)
+            if not data:
+                # truncated stream
+                break
+            buf += self.decompress (data)
 
-    def __exit__ (self, exc_type, exc_val, exc_tb):
+    def readable (self):
         return True
 
-    def read (self, num=None):
-        while not self.decompressor.is_finished ():
-            if num is not None and len (self.buf) >= num:
-                break
-            self.buf += self.decompressor.process (self.fd.read (self.readchunk))
-        if num is not None:
-            b = self.buf[0:num]
-            self.buf = self.buf[num:]
+    def readinto (self, b):
+        with memoryview (b) as view:
+            num = len (view)
+            self._fill (num)
+            num = min (num, len (self.buf))
+            # release the export before resizing, which fails otherwise
+            with memoryview (self.buf) as src:
+                view[:num] = src[:num]
+        del self.buf[:num]
+        return num
+
+    def read (self, num=-1):
+        if num is None or num < 0:
+            num = None
+        self._fill (num)
+        if num is None:
+            b = bytes (self.buf)
+            self.buf.clear ()
         else:
-            b = self.buf
-            self.buf = b''
+            b = bytes (self.buf[:num])
+            del self.buf[:num]
         return b
 
-    def seekable (self):
+    readall = read
+
+class BrotliFile (DecompressorFile):
+    def __init__ (self, fd, readchunk=100*1024):
+        import brotli
+        d = brotli.Decompressor ()
+        super ().__init__ (fd, d.process, d.is_finished, readchunk)
+
+def filterBrotli (fd):
+    yield BrotliFile (fd)
+
+class MultiStreamDecompressor:
+    """
+    Decompress concatenated streams (gzip members, xz streams, bzip2
+    streams), like the gzip, lzma and bz2 modules do, using a new
+    decompressor from make () for each of them.
+    """
+
+    __slots__ = ('make', 'd')
+
+    def __init__ (self, make):
+        self.make = make
+        self.d = make ()
+
+    def decompress (self, data):
+        out = []
+        while data:
+            if self.d.eof:
+                self.d = self.make ()
+            out.append (self.d.decompress (data))
+            data = self.d.unused_data if self.d.eof else b''
+        return b''.join (out)
+
+    def isFinished (self):
+        # another stream may follow, only the end of the input tells
         return False
 
+def _multiStreamFile (fd, make):
+    d = MultiStreamDecompressor (make)
+    return DecompressorFile (fd, d.decompress, d.isFinished)
+
+def filterGzip (fd):
+    # decompress gzip members (wbits 16+)
+    yield _multiStreamFile (fd, lambda: zlib.decompressobj (16+zlib.MAX_WBITS))
+
+def filterXz (fd):
+    yield _multiStreamFile (fd, lzma.LZMADecompressor)
+
+def filterBzip2 (fd):
+    yield _multiStreamFile (fd, bz2.BZ2Decompressor)
+
+def filterZstd (fd):
+    if hasattr (zstd, 'ZstdDecompressor') and hasattr (zstd.ZstdDecompressor (), 'eof'):
+        # Python 3.14’s compression.zstd
+        d = zstd.ZstdDecompressor ()
+        yield DecompressorFile (fd, d.decompress, lambda: d.eof)
+    else:
+        # zstandard package
+        yield zstd.ZstdDecompressor ().stream_reader (fd)
+
+class MemoryFile (RawIOBase):
+    """ Read-only file backed by a memoryview, which is not copied """
+
+    def __init__ (self, view):
+        self.view = view
+        self.pos = 0
+
+    def readable (self):
+        return True
+
+    def readinto (self, b):
+        with memoryview (b) as dest:
+            num = min (len (dest), len (self.view)-self.pos)
+            dest[:num] = self.view[self.pos:self.pos+num]
+        self.pos += num
+        return num
+
+    def read (self, num=-1):
+        end = len (self.view) if num is None or num < 0 else self.pos+num
+        b = self.view[self.pos:end].tobytes ()
+        self.pos += len (b)
+        return b
+
+    readall = read
+
     def close (self):
-        self.decompressor = None
+        # release the view, so the underlying buffer can be reused
+        self.view.release ()
+        super ().close ()
+
+def readFully (fd, view):
+    """ Fill view from fd, returns number of bytes read (short only at EOF) """
+    pos = 0
+    while pos < len (view):
+        if hasattr (fd, 'readinto'):
+            n = fd.readinto (view[pos:])
+        else:
+            data = fd.read (len (view)-pos)
+            n = len (data)
+            view[pos:pos+n] = data
+        if not n:
+            break
+        pos += n
+    return pos
 
 def filterTar (fd):
     # Python’s tarfile module is painfully slow. We can do better.
-    pos = 0
     blocksize = 512
-    emptyblock = b'\0'*blocksize
+    header = bytearray (blocksize)
+    # member data, reused for every member
+    buf = bytearray ()
+    member = None
 
     while True:
         # read header
-        header = fd.read (blocksize)
-        pos += blocksize
-        if header == b'' or header == emptyblock:
+        with memoryview (header) as view:
+            n = readFully (fd, view)
+        if n == 0 or header.count (0) == blocksize:
             break
         assert header[256:256+8] == b'\0ustar  ', (header[256:256+8])
         size = int (header[124:124+12].rstrip (b'\0'), base=8)
 
-        # read body
+        # make sure the previous member is not used any more
+        if member is not None:
+            member.close ()
+            member = None
+
+        # read body, aligned to the next 512 byte block
+        padded = -(-size//blocksize)*blocksize
+        if len (buf) < padded:
+            buf = bytearray (padded)
+        with memoryview (buf) as view:
+            readFully (fd, view[:padded])
         if size > 0:
-            yield BytesIO (fd.read (size))
-            pos += size
-
-        # align to next 512 byte block
-        into = pos%blocksize
-        if into != 0:
-            pad = blocksize-into
-            fd.read (pad)
-            pos += pad
-
-def filterBrotli (fd):
-    yield BrotliFile (fd)
+            member = MemoryFile (memoryview (buf)[:size])
+            yield member
 
 def filterHtml (selectFunc, fd):
+    import html5lib
     document = html5lib.parse (fd)
     walker = html5lib.getTreeWalker("etree")
     stream = walker (document)
     s = HTMLSerializer()
     yield ''.join (s.serialize(Select (stream, selectFunc)))
 
+# elements without end tag
+voidElements = frozenset (['area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+        'input', 'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+# start tags closing an open p element
+closesP = frozenset (['address', 'article', 'aside', 'blockquote', 'center',
+        'details', 'dialog', 'dir', 'div', 'dl', 'fieldset', 'figcaption',
+        'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header',
+        'hgroup', 'hr', 'li', 'dd', 'dt', 'listing', 'main', 'menu', 'nav', 'ol',
+        'p', 'pre', 'section', 'summary', 'table', 'ul'])
+# same as html5lib.constants.spaceCharacters and .namespaces['html'], which
+# are not imported here, because html5lib is slow to import
+spaceCharacters = '\t\n\x0c \r'
+htmlNamespace = 'http://www.w3.org/1999/xhtml'
+headings = frozenset (['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+# list item → elements limiting the search for an open list item
+listItemScope = dict (li=frozenset (['ul', 'ol']), dd=frozenset (['dl']),
+        dt=frozenset (['dl']))
+
+class HtmlTokenizer (HTMLParser):
+    """
+    Incremental tokenizer producing the same token stream as html5lib’s tree
+    walker, without building a tree. Only the most common tree construction
+    rules (void elements, implied end tags, stray end tags) are implemented.
+    """
+
+    def __init__ (self):
+        super ().__init__ (convert_charrefs=True)
+        self.tokens = []
+        self.stack = []
+        self.text = []
+        self.skipNewline = False
+
+    def _flushText (self):
+        if not self.text:
+            return
+        data = ''.join (self.text)
+        self.text = []
+        # html5lib’s tree walker splits leading and trailing whitespace
+        middle = data.lstrip (spaceCharacters)
+        left = data[:len (data)-len (middle)]
+        if left:
+            self.tokens.append (dict (type='SpaceCharacters', data=left))
+        data = middle
+        middle = data.rstrip (spaceCharacters)
+        right = data[len (middle):]
+        if middle:
+            self.tokens.append (dict (type='Characters', data=middle))
+        if right:
+            self.tokens.append (dict (type='SpaceCharacters', data=right))
+
+    def _emit (self, ttype, name, attrs=None):
+        self._flushText ()
+        self.skipNewline = False
+        token = dict (type=ttype, name=name, namespace=htmlNamespace)
+        if attrs is not None:
+            data = dict ()
+            for k, v in attrs:
+                # first one wins
+                data.setdefault ((None, k), v or '')
+            token['data'] = data
+        self.tokens.append (token)
+
+    def _close (self, name):
+        """ Pop elements up to and including name """
+        while self.stack:
+            top = self.stack.pop ()
+            self._emit ('EndTag', top)
+            if top == name:
+                break
+
+    def handle_starttag (self, tag, attrs):
+        scope = listItemScope.get (tag)
+        if scope is not None:
+            for name in reversed (self.stack):
+                if name in listItemScope:
+                    self._close (name)
+                    break
+                if name in scope:
+                    break
+        if tag in closesP and 'p' in self.stack:
+            self._close ('p')
+        if tag in headings and self.stack and self.stack[-1] in headings:
+            self._close (self.stack[-1])
+
+        if tag in voidElements:
+            self._emit ('EmptyTag', tag, attrs)
+        else:
+            self._emit ('StartTag', tag, attrs)
+            self.stack.append (tag)
+            # a newline directly after these is ignored
+            self.skipNewline = tag in {'pre', 'listing', 'textarea'}
+
+    def handle_startendtag (self, tag, attrs):
+        # the self-closing flag is ignored for non-void elements
+        self.handle_starttag (tag, attrs)
+
+    def handle_endtag (self, tag):
+        if tag == 'br':
+            self._emit ('EmptyTag', tag, [])
+        elif tag in self.stack:
+            self._close (tag)
+        elif tag == 'p':
+            # </p> without open p creates an empty one
+            self._emit ('StartTag', tag, [])
+            self._emit ('EndTag', tag)
+
+    def handle_data (self, data):
+        if self.skipNewline and data.startswith ('\n'):
+            data = data[1:]
+        self.skipNewline = False
+        self.text.append (data)
+
+    def handle_comment (self, data):
+        # comments split text nodes
+        self._flushText ()
+
+    handle_pi = handle_comment
+
+    def close (self):
+        super ().close ()
+        while self.stack:
+            self._emit ('EndTag', self.stack.pop ())
+        self._flushText ()
+
+def sniffEncoding (data):
+    """ Guess encoding of HTML document starting with data, like html5lib """
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'),
+            (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')):
+        if data.startswith (bom):
+            return encoding
+    m = re.search (rb'<meta[^>]*charset\s*=\s*["\']?\s*([a-zA-Z0-9_:.-]+)', data[:1024], re.I)
+    if m:
+        try:
+            encoding = codecs.lookup (m.group (1).decode ('ascii')).name
+            # labels replaced by the WHATWG encoding standard
+            return dict (ascii='cp1252', latin_1='cp1252', iso8859_1='cp1252').get (encoding, encoding)
+        except LookupError:
+            pass
+    return 'cp1252'
+
+def htmlTokens (fd, chunkSize=64*1024):
+    """ Tokenize HTML document read from binary file fd incrementally """
+    tokenizer = HtmlTokenizer ()
+    decoder = None
+    pending = ''
+    while True:
+        data = fd.read (chunkSize)
+        if decoder is None:
+            # the encoding declaration is searched in the first 1024 bytes
+            while data and len (data) < 1024:
+                more = fd.read (chunkSize)
+                if not more:
+                    break
+                data += more
+            decoder = codecs.getincrementaldecoder (sniffEncoding (data)) (errors='replace')
+        text = pending + decoder.decode (data, final=not data)
+        # a \r\n sequence may be split between chunks
+        if data and text.endswith ('\r'):
+            text, pending = text[:-1], '\r'
+        else:
+            pending = ''
+        tokenizer.feed (text.replace ('\r\n', '\n').replace ('\r', '\n'))
+        if not data:
+            tokenizer.close ()
+        tokens = tokenizer.tokens
+        tokenizer.tokens = []
+        yield from tokens
+        if not data:
+            break
+
+def filterHtmlStream (selectFunc, fd):
+    """ Same as filterHtml, but without building a DOM """
+    s = HTMLSerializer()
+    yield ''.join (s.serialize (Select (htmlTokens (fd), selectFunc)))
+
 def filterEpub (item):
     """ epub reader """
+    import ebooklib, html5lib
+    from ebooklib import epub
     book = epub.read_epub (item.rstrip ())
     logging.debug (f'reading ebook {item}')
     for item in book.get_items_of_type (ebooklib.ITEM_DOCUMENT):
@@ -226,16 +538,79 @@ def getText (nodelist):
             rc.append(node.data)
     return ''.join(rc)
 
+def _directText (elem):
+    """ Text of elem’s direct text nodes, like getText (elem.childNodes) """
+    return (elem.text or '') + ''.join (child.tail or '' for child in elem)
+
+def _hasPath (names, path):
+    """ Check whether list of tag names contains path as a subsequence """
+    it = iter (names)
+    return all (p in it for p in path)
+
+def iterXml (fd, paths):
+    """
+    Incrementally parse XML document fd and yield (tag, element) for every
+    element whose tag is in paths and whose ancestors contain paths[tag].
+    Elements are cleared afterwards, so memory usage does not depend on the
+    document size. Raises ParseError for invalid documents.
+    """
+    stack = []
+    names = []
+    for event, elem in iterparse (fd, ['start', 'end']):
+        if event == 'start':
+            stack.append (elem)
+            names.append (elem.tag)
+            continue
+
+        stack.pop ()
+        names.pop ()
+        path = paths.get (elem.tag)
+        if path is not None and _hasPath (names, path):
+            yield elem.tag, elem
+        # keep text of children until their parent s is done
+        if 's' not in names:
+            elem.clear ()
+            if stack:
+                del stack[-1][-1]
+
+class InvalidDocument (Exception):
+    """ Raised by text chunks of streaming filters for invalid documents """
+
+def _documentChunks (fd, chunks):
+    """
+    Text chunks of XML document fd, which are produced while parsing. If
+    the document turns out to be invalid (e.g. truncated) InvalidDocument is
+    raised and chunks consumed so far must be discarded, like filterXml
+    yields nothing.
+    """
+    try:
+        yield from chunks
+    except ParseError as e:
+        logging.error (f'invalid xml document {fd}')
+        raise InvalidDocument (fd) from e
+
+def joinChunks (items):
+    """ Yield items as chunks of '\n'.join (items) """
+    first = True
+    for item in items:
+        yield item if first else '\n' + item
+        first = False
+
 def filterTEI2 (doc):
     """ TEI.2 format used for United Nations parallel corpus """
-    out = []
-    for text in doc.getElementsByTagName ('text'):
-        for body in text.getElementsByTagName ('body'):
-            for p in body.getElementsByTagName ('p'):
-                for s in p.getElementsByTagName ('s'):
-                    out.append (getText (s.childNodes))
-                out.append ('')
-    yield '\n'.join (out)
+    if isinstance (doc, xml.dom.minidom.Document):
+        out = []
+        for text in doc.getElementsByTagName ('text'):
+            for body in text.getElementsByTagName ('body'):
+                for p in body.getElementsByTagName ('p'):
+                    for s in p.getElementsByTagName ('s'):
+                        out.append (getText (s.childNodes))
+                    out.append ('')
+        yield '\n'.join (out)
+    else:
+        paths = {'s': ('text', 'body', 'p'), 'p': ('text', 'body')}
+        yield _documentChunks (doc, joinChunks (_directText (elem) if tag == 's' else ''
+                for tag, elem in iterXml (doc, paths)))
 
 def filterOpenSubtitles (doc):
     """
@@ -243,29 +618,91 @@ def filterOpenSubtitles (doc):
     http://opus.nlpl.eu/OpenSubtitles-v2018.php
     """
 
-    out = []
-    for s in doc.getElementsByTagName ('s'):
-        # strip newlines, which are mostly unintentional due to
-        # pretty-printed xml structure
-        out.append (getText (s.childNodes).strip ())
-    yield '\n'.join (out)
+    if isinstance (doc, xml.dom.minidom.Document):
+        out = []
+        for s in doc.getElementsByTagName ('s'):
+            # strip newlines, which are mostly unintentional due to
+            # pretty-printed xml structure
+            out.append (getText (s.childNodes).strip ())
+        yield '\n'.join (out)
+    else:
+        # strip newlines, see above
+        yield _documentChunks (doc, joinChunks (_directText (elem).strip ()
+                for tag, elem in iterXml (doc, {'s': ()})))
+
+class PandocConverter:
+    """
+    Long-lived converter process, which converts documents one after another.
+
+    Requests and replies are framed by their length (see
+    data/pandoc-convert.lua), so a document rejected by the converter does
+    not affect any other document. If the converter dies it is restarted for
+    the next document.
+    """
 
-def filterMediawikiMarkdown (text):
+    __slots__ = ('command', 'proc')
+
+    def __init__ (self, command=None):
+        if command is None:
+            script = resourcePath ('data/pandoc-convert.lua')
+            command = ['pandoc', 'lua', script]
+        self.command = command
+        self.proc = None
+
+    def close (self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close ()
+            except OSError:
+                # data may still be buffered for a dead process
+                pass
+            self.proc.stdout.close ()
+            self.proc.wait ()
+            self.proc = None
+
+    def convert (self, text):
+        """ Convert text, returns None if the converter rejected it """
+        if self.proc is None or self.proc.poll () is not None:
+            self.close ()
+            self.proc = Popen (self.command, stdin=PIPE, stdout=PIPE)
+
+        data = text.encode ('utf-8')
+        try:
+            self.proc.stdin.write (b'%d\n' % len (data))
+            self.proc.stdin.write (data)
+            self.proc.stdin.flush ()
+            status, length = self.proc.stdout.readline ().split ()
+            length = int (length)
+            result = self.proc.stdout.read (length)
+            if len (result) != length:
+                raise ValueError ('short read')
+        except (OSError, ValueError) as e:
+            logging.error (f'converter {self.command} failed: {e}')
+            self.proc.kill ()
+            self.close ()
+            return None
+
+        result = result.decode ('utf-8')
+        if status != b'ok':
+            logging.error (f'converter rejected document: {result}')
+            return None
+        return result
+
+# one converter per worker process, started on first use
+pandocConverter = None
+
+def filterMediawikiMarkdown (text, converter=None):
     """
     Convert mediawiki to markdown
     """
-    p = subprocess.Popen (['pandoc', '-f', 'mediawiki', '-t', 'markdown'],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    p.stdin.write (text.encode ('utf-8'))
-    p.stdin.close ()
-    text = p.stdout.read ().decode ('utf-8')
-    ret = p.wait ()
-    # make sure we’re not leaking fd’s
-    p.stdout.close ()
-    del p
-    if ret != 0:
-        logging.error ('pandoc rejected document')
-    else:
+    global pandocConverter
+    if converter is None:
+        if pandocConverter is None:
+            pandocConverter = PandocConverter ()
+        converter = pandocConverter
+
+    text = converter.convert (text)
+    if text is not None:
         yield text
 
 f = dict(
@@ -276,6 +713,8 @@ f = dict(
 filterAvail = dict(
     aljazeera=partial(filterHtml, f['aljazeera']),
     bbcarabic=partial(filterHtml, f['bbcarabic']),
+    **{'aljazeera-stream': partial(filterHtmlStream, f['aljazeera']),
+    'bbcarabic-stream': partial(filterHtmlStream, f['bbcarabic'])},
     text=filterText,
     json=filterJson,
     epub=filterEpub,
@@ -287,7 +726,12 @@ filterAvail = dict(
     tar=filterTar,
     mediawikimarkdown=filterMediawikiMarkdown,
     brotli=filterBrotli,
+    gzip=filterGzip,
+    xz=filterXz,
+    bzip2=filterBzip2,
     )
+if zstd is not None:
+    filterAvail['zstd'] = filterZstd
 
 charMap = {
     'ﻻ': 'لا',
@@ -316,9 +760,53 @@ charMap = {
     '\u00a0': ' ',
     }
 
+# id (m) → (m, translation table), keeps m alive, so ids are not reused
+_translateTables = dict ()
+
+def _translateTable (m):
+    """ Cached str.translate table for map m, which must not be modified """
+    cached = _translateTables.get (id (m))
+    if cached is None or cached[0] is not m:
+        cached = _translateTables[id (m)] = (m, str.maketrans (m))
+    return cached[1]
+
 def mapChars (text, m):
     """ For all characters in text, replace if found in map m or keep as-is """
-    return ''.join (map (lambda x: m.get (x, x), text))
+    return text.translate (_translateTable (m))
+
+class CharNormalizer:
+    """
+    Normalize text before writing: Map characters (possibly to multiple
+    characters) using map m and use unix line endings, which are only one
+    character.
+
+    Replacing one character after another with str.replace is much faster
+    than str.translate, which looks up every single character, or a regular
+    expression. It is only equivalent if no replacement contains a character
+    to be replaced, so the translation table is used otherwise.
+    """
+
+    __slots__ = ('table', 'pairs')
+
+    def __init__ (self, m=charMap):
+        assert all (len (k) == 1 and '\r' not in v for k, v in m.items ())
+        self.table = _translateTable (m)
+        independent = not any (k in v for k in m for v in m.values ())
+        # line endings last, replacements may add a \n
+        self.pairs = list (m.items ()) + [('\r\n', '\n')] if independent else None
+
+    def __call__ (self, text):
+        if self.pairs is None:
+            text = text.translate (self.table)
+            if '\r' in text:
+                text = text.replace ('\r\n', '\n')
+            return text
+        for k, v in self.pairs:
+            if k in text:
+                text = text.replace (k, v)
+        return text
+
+normalize = CharNormalizer ()
 
 def apply (fs, items):
     """ Apply the first function fs[0] to all items, flatten the result and repeat """
@@ -327,56 +815,268 @@ def apply (fs, items):
     else:
         return apply (fs[1:], chain.from_iterable (map (fs[0], items)))
 
-from .stats import allStats, makeCombined
+from .stats import FusedStats, NgramStats, allStats, makeCombined, writeCombined
+from . import statsfile
+
+def readRange (path, start, end):
+    """
+    Read lines from byte range [start, end) of file path. Lines belong to the
+    range they start in.
+    """
+    with open (path, 'rb') as fd:
+        if start > 0:
+            fd.seek (start-1)
+            if fd.read (1) != b'\n':
+                # skip partial line
+                fd.readline ()
+        while fd.tell () < end:
+            l = fd.readline ()
+            if not l:
+                break
+            yield l.decode ('utf-8')
+
+def shardFiles (paths, size):
+    """ Split files into byte ranges (path, start, end) of size bytes """
+    for path in paths:
+        total = os.path.getsize (path)
+        for start in range (0, total, size):
+            yield (path, start, min (start+size, total))
+
+def batchLines (fd, maxItems, maxBytes):
+    """ Group lines of fd into lists of at most maxItems items or maxBytes characters """
+    batch = []
+    size = 0
+    for l in fd:
+        batch.append (l)
+        size += len (l)
+        if len (batch) >= maxItems or size >= maxBytes:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+class StatsCache:
+    """
+    On-disk cache of per-item stats.
+
+    Items are keyed by their content, i.e. the file contents for the file
+    filter and the line itself otherwise, and everything else affecting the
+    result: layout, keyboard, filters and character map. Shards are stored
+    in the columnar format.
+    """
+
+    __slots__ = ('path', 'context', 'isFile', 'keyboard')
+
+    # increment when changing how stats are created
+    version = 1
+    # filters reading the file named by the item
+    fileFilters = {'file', 'epub'}
+
+    def __init__ (self, path, layout, keyboard, filters):
+        self.path = path
+        self.keyboard = keyboard
+        self.isFile = filters[0] in self.fileFilters
+        context = [self.version, layoutDigest (layout), keyboard.name,
+                keyboard.digest, filters, charMap]
+        self.context = hashlib.sha256 (json.dumps (context, sort_keys=True).encode ('utf-8')).digest ()
+
+    def key (self, item):
+        h = hashlib.sha256 (self.context)
+        if self.isFile:
+            with open (item.rstrip (), 'rb') as fd:
+                while True:
+                    data = fd.read (1024*1024)
+                    if not data:
+                        break
+                    h.update (data)
+        else:
+            h.update (item.encode ('utf-8'))
+        return h.hexdigest ()
+
+    def _path (self, key):
+        return os.path.join (self.path, key[:2], key + '.stats')
+
+    def load (self, key, combined):
+        """
+        Add cached stats for key to combined, returns False on cache miss.
+        Corrupt entries are removed and count as a miss.
+        """
+        path = self._path (key)
+        # do not touch combined until the entry is known to be intact
+        itemCombined = makeCombined (self.keyboard)
+        try:
+            with open (path, 'rb') as fd:
+                containers = statsfile.openContainers (statsfile.mapFile (fd))
+                # store() always writes a container, even for empty stats
+                if not containers:
+                    raise ValueError ('empty stats file')
+                for f in containers:
+                    f.toStats (itemCombined, self.keyboard)
+        except FileNotFoundError:
+            return False
+        except (ValueError, struct.error, KeyError, IndexError) as e:
+            logging.warning (f'removing corrupt cache entry {path}: {e}')
+            with contextlib.suppress (FileNotFoundError):
+                os.unlink (path)
+            return False
+        for s in allStats:
+            combined[s.name].update (itemCombined[s.name])
+        return True
 
-def writeWorker (layout, funcs, inq, outq, statusq, benchmark):
+    def store (self, key, combined):
+        path = self._path (key)
+        os.makedirs (os.path.dirname (path), exist_ok=True)
+        # atomically replace, other processes may read it concurrently
+        fd, tmp = tempfile.mkstemp (dir=os.path.dirname (path), suffix='.tmp')
+        try:
+            with open (fd, 'wb') as fd:
+                statsfile.dump (combined, fd)
+            os.replace (tmp, path)
+        except BaseException:
+            os.unlink (tmp)
+            raise
+
+def layoutDigest (layout):
+    """ Stable digest of GenericLayout layout’s contents """
+    data = layout.serialize ()
+    for l in data['layout']:
+        l['modifier'] = sorted (sorted (m) for m in l['modifier'])
+    data = json.dumps (data, sort_keys=True, ensure_ascii=False).encode ('utf-8')
+    return hashlib.sha256 (data).hexdigest ()
+
+def residentMemory ():
+    """ Resident set size of this process in bytes, None if unknown """
+    try:
+        with open ('/proc/self/statm') as fd:
+            return int (fd.read ().split ()[1]) * os.sysconf ('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def writeWorker (layout, funcs, inq, outq, statusq, benchmark, handoffdir,
+        cache=None, ngram=None, flushItems=None, flushMemory=None, spooldir=None):
     try:
         keyboard = defaultKeyboards['ibmpc105']
         combined = makeCombined (keyboard)
-        itemsProcessed = 0
-
-        while True:
-            item = inq.get ()
-            if item is None:
-                break
-
-            # extract (can be multiple texts per item)
+        # layout-independent stats instead of writing
+        ngrams = NgramStats (ngram) if ngram else None
+        # lookup tables are shared by all writers
+        table = Writer (layout).table
+
+        # results are handed over via files instead of the queue, the last
+        # one via handoffdir (shared memory) and partial ones via spooldir,
+        # since they are flushed to limit memory usage
+        shards = []
+        itemsUnflushed = 0
+        baseMemory = residentMemory ()
+
+        def flush (final=False):
+            """ Write partial results to a new shard and start over """
+            nonlocal combined, ngrams, itemsUnflushed, baseMemory
+            fd, path = tempfile.mkstemp (suffix='.stats',
+                    dir=handoffdir if final or spooldir is None else spooldir)
+            with open (fd, 'wb') as fd:
+                if ngrams is not None:
+                    pickle.dump (ngrams, fd, pickle.HIGHEST_PROTOCOL)
+                    ngrams = NgramStats (ngram)
+                else:
+                    statsfile.dump (combined, fd)
+                    combined = makeCombined (keyboard)
+            shards.append (path)
+            itemsUnflushed = 0
+            # freed memory is not necessarily returned to the OS
+            baseMemory = residentMemory ()
+
+        def process (items, combined):
+            """ Create stats for all texts extracted from items """
             i = 0
-            for text in apply (funcs, [item]):
+            for text in apply (funcs, items):
+                # streaming filters yield a generator of text chunks
+                # and raise InvalidDocument if it turns out to be invalid
+                chunks = (text, ) if isinstance (text, str) else text
                 if benchmark:
+                    try:
+                        for chunk in chunks:
+                            pass
+                    except InvalidDocument:
+                        continue
+                    i += 1
+                    continue
+                if ngrams is not None:
+                    if isinstance (text, str):
+                        ngrams.consume (map (normalize, chunks))
+                    else:
+                        # keep partial results separate
+                        docNgrams = NgramStats (ngram)
+                        try:
+                            docNgrams.consume (map (normalize, chunks))
+                        except InvalidDocument:
+                            continue
+                        ngrams.update (docNgrams)
                     i += 1
                     continue
 
-                # map chars; make sure we’re using unix line endings, which is
-                # only one character
-                text = mapChars (text, charMap).replace ('\r\n', '\n')
+                # init a new writer for every item
+                w = Writer (layout, table)
+                # stats, which are discarded for invalid documents
+                stats = FusedStats (w)
+                try:
+                    for chunk in chunks:
+                        chunk = normalize (chunk)
 
-                logging.debug (text)
+                        logging.debug (chunk)
 
-                # init a new writer for every item
-                w = Writer (layout)
-                # stats
-                stats = [cls(w) for cls in allStats]
-                for match, event in w.type (StringIO (text)):
-                    for s in stats:
-                        s.process (event)
-
-                for s in stats:
+                        stats.consume (w.type (StringIO (chunk)))
+                except InvalidDocument:
+                    continue
+
+                for s in stats.stats ():
                     combined[s.name].update (s)
 
                 i += 1
+            return i
+
+        while True:
+            item = inq.get ()
+            if item is None:
+                break
+
+            # a batch of items or a byte range of a file
+            items = item if isinstance (item, list) else readRange (*item)
+
+            # extract (can be multiple texts per item)
+            if cache is None or benchmark:
+                i = process (items, combined)
+            else:
+                i = 0
+                for item in items:
+                    key = cache.key (item)
+                    if cache.load (key, combined):
+                        i += 1
+                        continue
+                    itemCombined = makeCombined (keyboard)
+                    i += process ([item], itemCombined)
+                    cache.store (key, itemCombined)
+                    for s in allStats:
+                        combined[s.name].update (itemCombined[s.name])
             # only update ocasionally, this is an expensive operation
             statusq.put (i)
-            itemsProcessed += i
-        if itemsProcessed > 0:
-            outq.put (combined)
-        else:
-            outq.put (None)
+            itemsUnflushed += i
+
+            if itemsUnflushed > 0 and not benchmark and \
+                    ((flushItems and itemsUnflushed >= flushItems) or \
+                    (flushMemory and baseMemory is not None and \
+                    residentMemory () - baseMemory >= flushMemory)):
+                flush ()
+        if itemsUnflushed > 0 and not benchmark:
+            flush (final=True)
+        outq.put (shards)
     except Exception as e:
         # async exceptions
         outq.put (e)
 
 def statusWorker (statusq):
+    from tqdm import tqdm
     with tqdm (unit='item', smoothing=0) as bar:
         while True:
             try:
@@ -397,10 +1097,34 @@ def write ():
     parser.add_argument('-k', '--keyboard', metavar='KEYBOARD',
             default='ibmpc105', help='Physical keyboard name')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable debugging output')
+    parser.add_argument('-f', '--format', choices=('pickle', 'columnar'),
+            default='pickle', help='Output file format')
+    parser.add_argument('--batch-items', dest='batchItems', metavar='NUM',
+            default=1, type=int, help='Max number of input lines per task')
+    parser.add_argument('--batch-bytes', dest='batchBytes', metavar='NUM',
+            default=1024*1024, type=int, help='Max size of input lines or input file shards per task')
+    parser.add_argument('-i', '--input', metavar='FILE', action='append',
+            help='Read lines from FILE instead of stdin, which is split between workers')
+    parser.add_argument('--cache', metavar='DIR',
+            help='Cache stats per input line/file in DIR and reuse them')
+    parser.add_argument('--flush-items', dest='flushItems', metavar='NUM', type=int,
+            help='Write partial results of a worker after NUM texts')
+    parser.add_argument('--flush-memory', dest='flushMemory', metavar='MB', type=int,
+            help='Write partial results of a worker once its memory grew by MB')
+    parser.add_argument('--spool-dir', dest='spoolDir', metavar='DIR',
+            help='Write partial results to DIR (default: system temporary directory)')
+    parser.add_argument('--ngram', metavar='ORDER', type=int,
+            help='Create layout-independent n-gram stats instead, see lulua-analyze project')
     parser.add_argument('layout', metavar='LAYOUT', help='Keyboard layout name')
     parser.add_argument('filter', metavar='FILTER', choices=filterAvail.keys(), nargs='+', help='Data filter')
 
     args = parser.parse_args()
+    if args.cache and args.input:
+        parser.error ('--cache cannot be used with --input')
+    if args.ngram is not None and (args.cache or args.format != 'pickle'):
+        parser.error ('--ngram only supports uncached pickle output')
+    if args.ngram is not None and args.ngram < 1:
+        parser.error ('--ngram must be at least 1')
 
     if args.verbose:
         logging.basicConfig (level=logging.DEBUG)
@@ -408,19 +1132,30 @@ def write ():
         logging.basicConfig (level=logging.INFO)
 
     keyboard = defaultKeyboards[args.keyboard]
-    layout = defaultLayouts[args.layout].specialize (keyboard)
+    genericLayout = defaultLayouts[args.layout]
+    layout = genericLayout.specialize (keyboard)
     filterSel = [filterAvail[x] for x in args.filter]
+    cache = StatsCache (args.cache, genericLayout, keyboard, args.filter) if args.cache else None
 
     # limit queue sizes to limit memory usage
     inq = Queue (args.jobs*2)
     outq = Queue (args.jobs+1)
     statusq = Queue (args.jobs+1)
 
+    # results are passed through files, preferably in memory, but partial
+    # results can add up to more than that
+    handoffdir = tempfile.TemporaryDirectory (prefix='lulua-write-',
+            dir='/dev/shm' if os.path.isdir ('/dev/shm') else None)
+    spooldir = tempfile.TemporaryDirectory (prefix='lulua-write-', dir=args.spoolDir)
+
     logging.info (f'using {args.jobs} workers')
     workers = []
     for i in range (args.jobs):
         p = Process(target=writeWorker,
-                args=(layout, filterSel, inq, outq, statusq, args.benchmark),
+                args=(layout, filterSel, inq, outq, statusq, args.benchmark,
+                        handoffdir.name, cache, args.ngram, args.flushItems,
+                        args.flushMemory and args.flushMemory*1024*1024,
+                        spooldir.name),
                 daemon=True,
                 name=f'worker-{i}')
         p.start()
@@ -432,9 +1167,13 @@ def write ():
             name=f'status')
     statusp.start()
 
+    if args.input:
+        items = shardFiles (args.input, args.batchBytes)
+    else:
+        items = batchLines (sys.stdin, args.batchItems, args.batchBytes)
     try:
-        for l in sys.stdin:
-            inq.put (l)
+        for batch in items:
+            inq.put (batch)
 
             # something is wrong
             if not outq.empty ():
@@ -444,14 +1183,34 @@ def write ():
 
     # exit workers
     # every one of them will consume exactly one item and write one in return
+    shards = []
     for w in workers:
         inq.put (None)
         item = outq.get ()
         if isinstance (item, Exception):
             raise item
-        if item is not None:
-            pickle.dump (item, sys.stdout.buffer, pickle.HIGHEST_PROTOCOL)
+        shards.extend (item)
     assert outq.empty ()
+    if shards and args.ngram:
+        ngrams = None
+        for path in shards:
+            with open (path, 'rb') as fd:
+                r = pickle.load (fd)
+            os.unlink (path)
+            if ngrams is None:
+                ngrams = r
+            else:
+                ngrams.update (r)
+        pickle.dump (ngrams, sys.stdout.buffer, pickle.HIGHEST_PROTOCOL)
+    elif shards:
+        # memory-mapped, so merging does not need to hold all of them
+        results = []
+        for path in shards:
+            with open (path, 'rb') as fd:
+                results.extend (statsfile.openContainers (statsfile.mapFile (fd)))
+        writeCombined (results, sys.stdout.buffer, args.format, keyboard)
+    handoffdir.cleanup ()
+    spooldir.cleanup ()
 
     statusq.put (None)
     statusp.join ()
@@ -462,17 +1221,96 @@ def write ():
 
     return 0
 
-import bz2, sys, json, subprocess
-from xml.etree.ElementTree import iterparse
+# start of a bzip2 stream, followed by the first block’s magic number
+bz2StreamStart = re.compile (rb'BZh[1-9]1AY&SY')
+
+def streamOffsets (path, index=None):
+    """
+    Get start offsets of the bzip2 streams in multistream dump path, either
+    from the dump’s (compressed) index file or by scanning the file itself.
+    """
+    if index is not None:
+        offsets = {0}
+        with bz2.open (index, 'rb') as fd:
+            for l in fd:
+                offsets.add (int (l.split (b':', 1)[0]))
+        return sorted (offsets)
+    else:
+        with open (path, 'rb') as fd, mmap.mmap (fd.fileno (), 0, access=mmap.ACCESS_READ) as m:
+            return [0] + [x.start () for x in bz2StreamStart.finditer (m, 1)]
+
+def iterRange (path, start, end, readchunk=1024*1024):
+    """
+    Extract wikitext from the bzip2 streams in byte range [start, end) of
+    mediawiki dump path. Yields one JSON line per text as soon as it is
+    parsed.
+    """
+    out = []
+    parser = XMLPullParser (['start', 'end'])
+    # streams after the first one lack the root element
+    parser.feed (b'<root>' if start == 0 else b'<root><mediawiki>')
+    stack = []
+
+    def handleEvents ():
+        for event, elem in parser.read_events ():
+            if event == 'start':
+                stack.append (elem)
+                continue
+
+            stack.pop ()
+            # only the first stream declares a namespace
+            if elem.tag.rsplit ('}', 1)[-1] == 'text':
+                text = ''.join (elem.itertext ())
+                out.append (json.dumps (text, ensure_ascii=False) + '\n')
+            elem.clear ()
+            if stack:
+                del stack[-1][-1]
+
+    with open (path, 'rb') as fd:
+        fd.seek (start)
+        remaining = end - start
+        d = bz2.BZ2Decompressor ()
+        while remaining > 0:
+            data = fd.read (min (readchunk, remaining))
+            if not data:
+                break
+            remaining -= len (data)
+            while data:
+                parser.feed (d.decompress (data))
+                handleEvents ()
+                yield from out
+                out.clear ()
+                if d.eof:
+                    data = d.unused_data
+                    d = bz2.BZ2Decompressor ()
+                else:
+                    data = None
+
+def extractRange (path, start, end, readchunk=1024*1024):
+    """ Like iterRange, but return all JSON lines at once """
+    return ''.join (iterRange (path, start, end, readchunk))
+
+def _extractRange (args):
+    return extractRange (*args)
+
 def extractMediawiki ():
     parser = argparse.ArgumentParser(description='Extract raw wikitext from mediawiki dump.')
+    parser.add_argument('-j', '--jobs', metavar='NUM',
+            default=cpu_count (), type=int, help='Number of parallel jobs')
+    parser.add_argument('-i', '--index', metavar='FILE',
+            help='Multistream index, scan the dump for streams if missing')
     parser.add_argument('file', metavar='FILE', help='bzip2-compressed dump')
     args = parser.parse_args()
 
-    with bz2.open (args.file, 'r') as fd:
-        for event, elem in iterparse (fd, ['start', 'end']):
-            if event == 'end' and elem.tag == '{http://www.mediawiki.org/xml/export-0.10/}text':
-                text = ''.join (elem.itertext ())
-                json.dump (text, sys.stdout, ensure_ascii=False)
-                sys.stdout.write ('\n')
-
+    offsets = streamOffsets (args.file, args.index)
+    size = os.path.getsize (args.file)
+    ranges = [(args.file, start, end) for start, end in zip (offsets, offsets[1:] + [size])]
+    if len (ranges) == 1:
+        # a single-stream dump cannot be split among workers, so stream it
+        # instead of holding all of its text in memory
+        for line in iterRange (*ranges[0]):
+            sys.stdout.write (line)
+        return
+    with Pool (args.jobs) as pool:
+        for lines in pool.imap (_extractRange, ranges, chunksize=4):
+            sys.stdout.write (lines)
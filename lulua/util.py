@@ -22,7 +22,12 @@
 Misc utilities
 """
 
-import os, yaml, pkg_resources, unicodedata, re
+import os, yaml, unicodedata, re, hashlib, pickle, tempfile, importlib, logging
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError: # pragma: no cover
+    from yaml import SafeLoader
 
 first = lambda x: next (iter (x))
 
@@ -35,10 +40,111 @@ def limit (l, n):
         except StopIteration:
             break
 
+# pkg_resources is slow to import, and resources are always installed as
+# regular files (see package_data in setup.py)
+packageDirectory = os.path.dirname (os.path.abspath (__file__))
+
+def resourcePath (name):
+    """ File system path of package resource name """
+    return os.path.join (packageDirectory, *name.split ('/'))
+
+def openResource (name):
+    """ Open package resource name in binary mode """
+    return open (resourcePath (name), 'rb')
+
+def lazyFunction (module, name):
+    """
+    Function name from module, which is only imported when called. Used for
+    subcommands with heavy dependencies.
+    """
+    def f (*args, **kwargs):
+        func = getattr (importlib.import_module (module, __package__), name)
+        return func (*args, **kwargs)
+    f.__name__ = f.__qualname__ = name
+    return f
+
+# increment when changing the pickled classes
+cacheVersion = 2
+# modules defining the pickled classes and pickling them, changes to their
+# source invalidate the cache as well
+cacheModules = ('layout', 'keyboard', 'util')
+# third-party modules defining pickled classes, their version matters
+cacheDependencies = ('pygtrie', )
+_sourceDigest = None
+
+def sourceDigest ():
+    """ Digest of the source code of cacheModules and cacheDependencies’ versions """
+    global _sourceDigest
+    if _sourceDigest is None:
+        h = hashlib.sha256 ()
+        for m in cacheModules:
+            with open (os.path.join (packageDirectory, f'{m}.py'), 'rb') as fd:
+                h.update (fd.read ())
+        for m in cacheDependencies:
+            version = getattr (importlib.import_module (m), '__version__', '')
+            h.update (f'{m}={version}\n'.encode ('utf-8'))
+        _sourceDigest = h.digest ()
+    return _sourceDigest
+
+def cacheDir ():
+    """ Directory for cached, compiled data """
+    base = os.environ.get ('XDG_CACHE_HOME') or os.path.join (os.path.expanduser ('~'), '.cache')
+    return os.path.join (base, 'lulua')
+
+def cacheKey (*parts):
+    """ Cache key for parts, which are bytes or str """
+    h = hashlib.sha256 (str (cacheVersion).encode ())
+    h.update (sourceDigest ())
+    for p in parts:
+        if isinstance (p, str):
+            p = p.encode ('utf-8')
+        # length-prefixed, so parts cannot run into each other
+        h.update (b'%d:' % len (p))
+        h.update (p)
+    return h.hexdigest ()
+
+def loadCached (key, make, shared=None):
+    """
+    Load object for key from the on-disk cache or create it using make () and
+    store it.
+
+    Objects in shared are not stored, but referenced by name.
+    """
+    shared = shared or {}
+    path = os.path.join (cacheDir (), key + '.pickle')
+    try:
+        with open (path, 'rb') as fd:
+            unpickler = pickle.Unpickler (fd)
+            unpickler.persistent_load = shared.__getitem__
+            return unpickler.load ()
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        # corrupt or stale (referencing changed classes), (re)create it
+        logging.warning (f'ignoring corrupt cache entry {path}: {e!r}')
+
+    obj = make ()
+    try:
+        os.makedirs (os.path.dirname (path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp (dir=os.path.dirname (path), suffix='.tmp')
+        with open (fd, 'wb') as fd:
+            pickler = pickle.Pickler (fd, pickle.HIGHEST_PROTOCOL)
+            names = dict ((id (v), k) for k, v in shared.items ())
+            pickler.persistent_id = lambda x: names.get (id (x))
+            pickler.dump (obj)
+        os.replace (tmp, path)
+    except OSError:
+        # caching is optional
+        pass
+    return obj
+
 class YamlLoader:
     """
     Simple YAML loader that searches the current path and the package’s
     resources (for defaults)
+
+    Objects deserialized by a named function are cached on disk, keyed by
+    the file’s contents, and get its key as attribute digest.
     """
 
     __slots__ = ('defaultDir', 'deserialize')
@@ -47,26 +153,40 @@ class YamlLoader:
         self.defaultDir = defaultDir
         self.deserialize = deserialize
 
+    def _load (self, data):
+        name = self.deserialize.__qualname__
+        if '<' in name:
+            # lambdas and local functions cannot be told apart, do not cache
+            return self.deserialize (yaml.load (data, Loader=SafeLoader))
+        digest = cacheKey (self.defaultDir, self.deserialize.__module__, name, data)
+        def make ():
+            obj = self.deserialize (yaml.load (data, Loader=SafeLoader))
+            obj.digest = digest
+            return obj
+        return loadCached (digest, make)
+
     def __getitem__ (self, k, onlyRes=False):
         openfunc = []
         if not onlyRes:
-            openfunc.append (lambda k: open (k, 'r'))
+            openfunc.append (lambda k: open (k, 'rb'))
         # try with and without appending extension
-        openfunc.append (lambda k: pkg_resources.resource_stream (__package__, os.path.join (self.defaultDir, k + '.yaml')))
-        openfunc.append (lambda k: pkg_resources.resource_stream (__package__, os.path.join (self.defaultDir, k)))
+        openfunc.append (lambda k: openResource (f'{self.defaultDir}/{k}.yaml'))
+        openfunc.append (lambda k: openResource (f'{self.defaultDir}/{k}'))
         for f in openfunc:
             try:
                 with f (k) as fd:
-                    return self.deserialize (yaml.safe_load (fd))
+                    data = fd.read ()
             except FileNotFoundError:
-                pass
+                continue
+            try:
+                return self._load (data)
             except yaml.reader.ReaderError:
                 pass
 
         raise KeyError (k)
 
     def __iter__ (self):
-        for res in pkg_resources.resource_listdir (__package__, self.defaultDir):
+        for res in sorted (os.listdir (resourcePath (self.defaultDir))):
             # ignore dotfiles, only include yaml
             if not res.startswith ('.') and res.endswith ('.yaml'):
                 yield self.__getitem__ (res, onlyRes=True)
@@ -122,12 +122,83 @@ class SkipEvent:
     def __repr__ (self):
         return f'SkipEvent({self.char!r})'
 
+dirToScore = {LEFT: 1, RIGHT: -1}
+# hand balance of combinations with buttons not in the finger map
+_unknownScore = object ()
+
+class TypingTable:
+    """
+    Precomputed lookup tables for Writer.type. Can be shared between writers
+    of the same layout.
+
+    Writer.chooseCombination only depends on the hand balance of the previous
+    combination, so its decisions are stored in one row of candidate set
+    id → (combination, next row) per balance.
+    """
+
+    __slots__ = ('single', 'multiStart', 't', 'bufferLen', 'setIds', 'sets',
+            'rows', 'writer')
+
+    def __init__ (self, writer):
+        layout = writer.layout
+        self.writer = writer
+        # single characters map directly to their candidate set id
+        self.single = dict ()
+        # first character of multi-character sequences, which need the trie
+        self.multiStart = set ()
+        self.t = layout.t
+        self.bufferLen = layout.bufferLen
+        # candidate sets
+        self.setIds = dict ()
+        self.sets = []
+        for k, v in layout:
+            self.setIds[k] = len (self.sets)
+            self.sets.append (v)
+            if len (k) == 1:
+                self.single[k] = self.setIds[k]
+            else:
+                self.multiStart.add (k[0])
+
+        # decision rows for every hand balance of the previous combination
+        self.rows = dict ()
+        self.row (None)
+        for v in self.sets:
+            for comb in v:
+                self.row (self._prevScore (comb))
+
+    def _prevScore (self, comb):
+        try:
+            return self.writer._prevScore (comb)
+        except KeyError:
+            # finger unknown, .chooseCombination() will fail if required
+            return _unknownScore
+
+    def row (self, score):
+        """ Get decision row for score, see Writer._prevScore () """
+        row = self.rows.get (score)
+        if row is not None:
+            return row
+        row = self.rows[score] = [None]*len (self.sets)
+        for i, v in enumerate (self.sets):
+            try:
+                if len (v) > 1 and score is _unknownScore:
+                    continue
+                comb = self.writer._choose (v, score)
+            except KeyError:
+                # let Writer.type fall back to .chooseCombination ()
+                continue
+            row[i] = (comb, self.row (self._prevScore (comb)))
+        return row
+
 class Writer:
     """ The magical being whose commands the machine obeys """
 
-    __slots__ = ('hands', 'lastCombination', 'layout')
+    __slots__ = ('hands', 'lastCombination', 'layout', 'table')
 
-    def __init__ (self, layout: KeyboardLayout):
+    # characters read at once by .type ()
+    chunkSize = 64*1024
+
+    def __init__ (self, layout: KeyboardLayout, table: TypingTable = None):
         self.layout = layout
         # assuming 10 finger typing
         self.hands = {
@@ -135,6 +206,7 @@ class Writer:
                 RIGHT: Hand (RIGHT, [Finger (x) for x in reversed (FingerType)]),
                 }
         self.lastCombination = None
+        self.table = table or TypingTable (self)
 
     def __getitem__ (self, k):
         return self.hands[k]
@@ -142,70 +214,103 @@ class Writer:
     def getHandFinger (self, button: Button):
         return defaultFingermap[button.name]
 
-    def chooseCombination (self, combinations):
-        """
-        Choose the best button combination from the ones given.
+    def _score (self, buttons):
+        return sum (dirToScore[self.getHandFinger (b)[0]] for b in buttons)
 
-        Return the actual button combination used.
+    def _prevScore (self, prev):
+        """ The part of prev relevant to .chooseCombination () """
+        if prev is None:
+            return None
+        return self._score (prev.modifier or prev.buttons)
 
-        For instance:
-        - A key on the right is usually combined with the shift button on the
-          left and vice versa.
-        - The spacebar is usually hit by the thumb of the previously unused
-          hand. If two hands were used the one pressing the key (not the
-          modifier) is chosen, since it’ll usually be closer.
-        - The combination with the minimum amount of fingers required is chosen
-          if multiple options are available
-        """
+    def _choose (self, combinations, prevScore):
         if len (combinations) == 1:
             return combinations[0]
 
-        dirToScore = {LEFT: 1, RIGHT: -1}
         def calcEffort (comb):
-            prev = self.lastCombination
-
-            if prev is not None:
-                prevBalance = 0
-                for b in chain (prev.modifier or prev.buttons, comb.buttons):
-                    pos = self.getHandFinger (b)[0]
-                    prevBalance += dirToScore[pos]
+            if prevScore is not None:
+                prevBalance = prevScore + self._score (comb.buttons)
             else:
                 # prefer the left side (arbitrary decision)
                 prevBalance = dirToScore[RIGHT]
 
-            balance = 0
-            for b in comb:
-                pos = self.getHandFinger (b)[0]
-                balance += dirToScore[pos]
+            balance = self._score (comb)
 
             return (len (comb) << 16) | (abs (balance) << 8) | (abs (prevBalance) << 0)
 
         m = min (zip (map (calcEffort, combinations), combinations), key=itemgetter (0))
         return m[1]
 
+    def chooseCombination (self, combinations):
+        """
+        Choose the best button combination from the ones given.
+
+        Return the actual button combination used.
+
+        For instance:
+        - A key on the right is usually combined with the shift button on the
+          left and vice versa.
+        - The spacebar is usually hit by the thumb of the previously unused
+          hand. If two hands were used the one pressing the key (not the
+          modifier) is chosen, since it’ll usually be closer.
+        - The combination with the minimum amount of fingers required is chosen
+          if multiple options are available
+        """
+        return self._choose (combinations, self._prevScore (self.lastCombination))
+
     def press (self, comb):
         self.lastCombination = comb
 
     def type (self, fd):
+        table = self.table
+        bufferLen = table.bufferLen
+        if bufferLen == 0:
+            return
+        single = table.single
+        multiStart = table.multiStart
+        setIds = table.setIds
+        row = table.row (table._prevScore (self.lastCombination))
+
         buf = ''
-        while True:
-            buf += fd.read (self.layout.bufferLen-len (buf))
-            if not buf:
-                break
+        pos = 0
+        eof = False
+        while not eof:
+            chunk = fd.read (self.chunkSize)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            # make sure there’s always enough lookahead for multi-char matches
+            end = len (buf) if eof else len (buf)-bufferLen+1
 
-            try:
-                match, combinations = self.layout (buf)
-                assert len (match) > 0, (match, combinations, buf)
+            while pos < end:
+                c = buf[pos]
+                if c in multiStart:
+                    p = table.t.longest_prefix (buf[pos:pos+bufferLen])
+                    match = p.key if p else None
+                    setId = setIds.get (match)
+                else:
+                    match = c
+                    setId = single.get (c)
+                if setId is None:
+                    # ignore unknown characters
+                    yield None, SkipEvent (c)
+                    pos += 1
+                    continue
 
-                comb = self.chooseCombination (combinations)
+                decision = row[setId]
+                if decision is None:
+                    try:
+                        comb = self.chooseCombination (table.sets[setId])
+                    except KeyError:
+                        # finger unknown, skip like unknown characters
+                        yield None, SkipEvent (c)
+                        pos += 1
+                        continue
+                    row = table.row (table._prevScore (comb))
+                else:
+                    comb, row = decision
 
                 yield match, comb
 
                 self.press (comb)
-                buf = buf[len (match):]
-            except KeyError:
-                # ignore unknown characters
-                yield None, SkipEvent (buf[0])
-                buf = buf[1:]
-                continue
-
+                pos += len (match)
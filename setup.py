@@ -41,6 +41,7 @@ setup(
         'ebooklib',
         'jinja2',
         'brotli',
+        'numpy',
     ],
     entry_points={
     'console_scripts': [
@@ -51,6 +52,7 @@ setup(
             'lulua-optimize = lulua.optimize:optimize',
             'lulua-write = lulua.text:write',
             'lulua-extract-mediawiki = lulua.text:extractMediawiki',
+            'lulua-benchmark = lulua.benchmark:main',
             ],
     },
     package_data = {